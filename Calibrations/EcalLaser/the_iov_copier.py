@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
 from datetime import datetime, timedelta
+import bisect
 import os
 import re
 import sqlite3
+import ssl
 import subprocess
 import sys
 import json
+import urllib.request
 
 TAG_MAIN = "EcalLaserAPDPNRatios_prompt_v3"
 TAG_REF = "EcalLaserAPDPNRatios_prompt_v3_inRunLSIoVs"
-LS_DURATION = 23.3  # seconds
+LS_DURATION = 23.3  # seconds, only when OMS can't give us the real LS boundaries
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# The runs (and LS boundaries) seen by the previous executions: the closed
+# runs never change, so only the new ones are asked to conddb. It lives next
+# to the script, whatever the working directory of the cron job.
+RUNS_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "the_iov_copier_runs.json")
+RUNS_PER_QUERY = 1000
+# Where to get the real LS boundaries from, empty to always use LS_DURATION
+OMS_URL = os.environ.get("OMS_URL", "https://cmsoms.cms/agg/api/v1")
+# Set OMS_VERIFY_TLS=0 to skip the verification of the OMS certificate
+OMS_VERIFY_TLS = os.environ.get("OMS_VERIFY_TLS", "1") != "0"
 
 def pack(high, low):
     """Pack run,ls (both 32-bit) into a 64-bit integer."""
@@ -124,26 +138,160 @@ def parse_runs(output):
 
     return runs
 
-def find_run_and_ls(timestamp, runs):
-    """Find the run and approximate LS corresponding to a timestamp.
-    If the run has no end time, assume it's still open and include any later timestamps.
+def load_runs_cache(path):
     """
-    for run, start, end in runs:
-        # handle open-ended run (end may be None)
-        if end is None:
-            #print("end is NONE")
-            #print("start: ",start,"- end:",end,"  | timestamp",timestamp)
-            if timestamp >= start:
-                dt = (timestamp - start).total_seconds()
-                ls = int(round(dt / LS_DURATION))
-                return run, max(1, ls)
+    Load the runs cached by the previous executions:
+    {"since": first time covered, "runs": {run: (start_time, end_time)},
+     "lumisections": {run: [(ls, start_time)]}}
+    """
+    cache = {"since": None, "runs": {}, "lumisections": {}}
+    if not os.path.exists(path):
+        print(f"No runs cache {path} found, all the runs will come from conddb.")
+        return cache
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("since"):
+            cache["since"] = datetime.strptime(data["since"], TIME_FORMAT)
+        for run, start, end in data.get("runs", []):
+            cache["runs"][int(run)] = (
+                datetime.strptime(start, TIME_FORMAT),
+                datetime.strptime(end, TIME_FORMAT) if end else None,
+            )
+        for run, lumisections in data.get("lumisections", {}).items():
+            cache["lumisections"][int(run)] = [(int(ls), datetime.strptime(start, TIME_FORMAT)) for ls, start in lumisections]
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        print(f"Could not read the runs cache {path} ({e}), starting from scratch.")
+        return {"since": None, "runs": {}, "lumisections": {}}
+    print(f"Loaded {len(cache['runs'])} run(s) from {path}")
+    return cache
+
+def save_runs_cache(cache, path):
+    """Write the runs cache, atomically so an interrupted execution can't leave half of it."""
+    data = {
+        "since": cache["since"].strftime(TIME_FORMAT) if cache["since"] else None,
+        "runs": [
+            [run, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT) if end else None]
+            for run, (start, end) in sorted(cache["runs"].items())
+        ],
+        "lumisections": {
+            str(run): [[ls, start.strftime(TIME_FORMAT)] for ls, start in lumisections]
+            for run, lumisections in sorted(cache["lumisections"].items())
+        },
+    }
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def update_runs_cache(cache, earliest):
+    """
+    Ask conddb for the runs the cache doesn't know yet, down to the earliest
+    timestamp to place in a run. The runs still going on at the last execution
+    are asked again, for their end time.
+    """
+    runs = cache["runs"]
+    if cache["since"] is None or earliest < cache["since"]:
+        start_from = f'"{earliest.strftime(TIME_FORMAT)}"'
+        cache["since"] = earliest
+    else:
+        ongoing = [run for run, (_, end) in runs.items() if end is None]
+        start_from = min(ongoing) if ongoing else max(runs, default=0)
+
+    while True:
+        fetched = parse_runs(run_cmd(f"conddb listRuns --from {start_from} --limit {RUNS_PER_QUERY}"))
+        for run, start, end in fetched:
+            runs[run] = (start, end)
+        print(f"Fetched {len(fetched)} run(s) from conddb, starting from {start_from}")
+        # A full page: there may be more
+        if len(fetched) < RUNS_PER_QUERY:
+            break
+        start_from = max(run for run, _, _ in fetched)
+
+def build_run_index(runs):
+    """Sort the runs by start time, for the bisect lookups of find_run."""
+    entries = sorted((start, run, end) for run, (start, end) in runs.items())
+    return [start for start, _, _ in entries], entries
+
+def find_run(timestamp, run_index):
+    """
+    Find the run going on at timestamp, in O(log n): the last run that started
+    before it, if it didn't end before it. A run without an end time is still open
+    and takes any later timestamp.
+    """
+    starts, entries = run_index
+    i = bisect.bisect_right(starts, timestamp) - 1
+    if i < 0:
+        return None
+    start, run, end = entries[i]
+    if end is None or timestamp <= end:
+        return run
+    return None
+
+def oms_ssl_context():
+    """The TLS context of the OMS requests, verifying the certificate unless OMS_VERIFY_TLS=0."""
+    context = ssl.create_default_context()
+    if not OMS_VERIFY_TLS:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+def fetch_lumisections(run, oms):
+    """
+    Ask OMS for the start time of every LS of the run: [(ls, start_time)], or None.
+    oms holds the URL to ask, which is dropped after the first failure.
+    """
+    if not oms["url"]:
+        return None
+    url = (
+        f"{oms['url']}/lumisections?filter[run_number][EQ]={run}"
+        f"&fields=lumisection_number,start_time&sort=lumisection_number&page[limit]=100000"
+    )
+    try:
+        with urllib.request.urlopen(url, timeout=30, context=oms["context"]) as response:
+            records = json.load(response)["data"]
+        lumisections = sorted(
+            (
+                int(record["attributes"]["lumisection_number"]),
+                datetime.strptime(record["attributes"]["start_time"][:19], "%Y-%m-%dT%H:%M:%S"),
+            )
+            for record in records
+        )
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        # Not worth waiting for it again for every run
+        print(f"Could not get the LS boundaries from OMS ({e}), using LS_DURATION = {LS_DURATION} s from now on")
+        oms["url"] = None
+        return None
+    return lumisections or None
+
+def run_lumisections(run, cache, oms):
+    """The LS boundaries of the run, from the cache or from OMS. Only the closed runs are cached."""
+    if run in cache["lumisections"]:
+        return cache["lumisections"][run]
+    lumisections = fetch_lumisections(run, oms)
+    if lumisections and cache["runs"][run][1] is not None:
+        cache["lumisections"][run] = lumisections
+    return lumisections
+
+def find_ls(timestamp, run, cache, boundaries, oms):
+    """
+    Find the LS of the run that timestamp falls in, from the real LS boundaries
+    when OMS has them, from LS_DURATION otherwise. Past the last LS OMS knows of
+    (the run is still going on), we count on from there with LS_DURATION.
+    boundaries keeps the bisect arrays of the runs already looked at, and oms
+    the OMS settings of fetch_lumisections.
+    """
+    if run not in boundaries:
+        lumisections = run_lumisections(run, cache, oms)
+        if lumisections:
+            boundaries[run] = ([start for _, start in lumisections], [ls for ls, _ in lumisections])
         else:
-            #print("start: ",start,"- end:",end,"  | timestamp",timestamp)
-            if start <= timestamp <= end:
-                dt = (timestamp - start).total_seconds()
-                ls = int(round(dt / LS_DURATION))
-                return run, max(1, ls)
-    return None, None
+            boundaries[run] = ([cache["runs"][run][0]], [1])
+    starts, numbers = boundaries[run]
+    i = max(0, bisect.bisect_right(starts, timestamp) - 1)
+    ls = numbers[i]
+    if i == len(starts) - 1:
+        ls += max(0, int((timestamp - starts[i]).total_seconds() // LS_DURATION))
+    return ls
 
 
 ########################################################################
@@ -196,39 +344,54 @@ else:
 
 print(f"Found {len(new_iovs)} new payload(s) after the last matched hash.")
 
-# Step 4: get recent runs
-runs_output = run_cmd("conddb listRuns --limit 500")
-runs = parse_runs(runs_output)
-
-# Step 5: Import payload into local SQLite
-
-for ts_str, since_iov, payload_hash in new_iovs:
-    print(f"\nProcessing payload {payload_hash} (since {since_iov})")
-
-    ts = datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-
+# Step 4: index the runs: those cached by the previous executions, plus what conddb has new
+payload_times = [datetime.strptime(ts_str, TIME_FORMAT) for ts_str, _, _ in new_iovs]
+runs_cache = load_runs_cache(RUNS_CACHE_FILE)
+if payload_times:
+    update_runs_cache(runs_cache, min(payload_times))
+run_index = build_run_index(runs_cache["runs"])
+
+# Step 5: Import the new payloads into local SQLite, all in one go
+
+# First place every payload in a run and LS
+resolved = []  # (since_iov, payload_hash, run, ls)
+unresolved = []  # since_iov
+ls_boundaries = {}
+oms = {"url": OMS_URL, "context": oms_ssl_context()}
+for (ts_str, since_iov, payload_hash), ts in zip(new_iovs, payload_times):
     # Find run and LS corresponding to this timestamp
-    run, ls = find_run_and_ls(ts, runs)
+    run = find_run(ts, run_index)
     if run is None:
-        print(f"  No matching run found for timestamp {ts_str}")
+        print(f"  No matching run found for timestamp {ts_str} (payload {payload_hash}, since {since_iov})")
+        unresolved.append(int(since_iov))
         continue
 
-    print(f"  Closest run: {run}, LS ~ {ls}")
-
-    cmd = (
-        f"conddb --yes copy "
-        f"--destdb {sqlite_file} "
-        f"--from {since_iov} "
-        f"--to {since_iov} "
-        f"--type tag "
-        f"{TAG_MAIN} {TAG_REF}"
-    )
-
-    print(f"  Importing payload from PromptProd into {sqlite_file} ...")
-    print(f"{cmd}")
-    result = run_cmd(cmd)
+    ls = find_ls(ts, run, runs_cache, ls_boundaries, oms)
+    print(f"  Payload {payload_hash} (since {since_iov}): run {run}, LS {ls}")
+    resolved.append((int(since_iov), payload_hash, run, ls))
+
+save_runs_cache(runs_cache, RUNS_CACHE_FILE)
+
+if not resolved:
+    print("No new payload could be placed in a run, nothing to import. Exiting gracefully.")
+    sys.exit(0)
+
+# A single conddb session copies the whole range of new IOVs: one Python
+# startup, one DB connection and one authentication instead of one per payload
+first_since = min(since for since, _, _, _ in resolved)
+last_since = max(since for since, _, _, _ in resolved)
+cmd = (
+    f"conddb --yes copy "
+    f"--destdb {sqlite_file} "
+    f"--from {first_since} "
+    f"--to {last_since} "
+    f"--type tag "
+    f"{TAG_MAIN} {TAG_REF}"
+)
 
-    print(f"  Imported {payload_hash} (IOV={since_iov}) corresponding to Run {run}, LS {ls}")
+print(f"\n  Importing {len(resolved)} payload(s) from PromptProd into {sqlite_file} ...")
+print(f"{cmd}")
+result = run_cmd(cmd)
 
 #### final touch re-derive the iovs
 
@@ -246,31 +409,29 @@ if os.path.getsize(sqlite_file) == 0:
 conn = sqlite3.connect(sqlite_file)
 cur = conn.cursor()
 
-# 1. Change TIME_TYPE
-cur.execute("UPDATE TAG SET TIME_TYPE='Lumi' WHERE TIME_TYPE='Time';")
-
-# 2. For each imported payload, compute packed IOV and update SINCE
-for ts_str, since_iov, payload_hash in new_iovs:
-    ts = datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-    run, ls = find_run_and_ls(ts, runs)
-    if run is None:
-        print(f"  Skipping {payload_hash}: could not find matching run.")
-        continue
-
-    packed_iov = pack(run, ls)
-    print(f"  Updating IOV {since_iov} -> Run {run}, LS {ls} -> packed {packed_iov}")
-
-    query = "UPDATE IOV SET SINCE=? WHERE SINCE=?;"
-    params = (packed_iov, since_iov)
-
-    print("Executing SQL:", query, "with parameters:", params)
-    cur.execute(query, params)
-    if cur.rowcount == 0:
-        print(f" No rows updated for IOV {since_iov}")
-    else:
-        print(f" Updated {cur.rowcount} row(s)")
+# Everything below goes in a single transaction
+with conn:
+    # 1. Change TIME_TYPE
+    cur.execute("UPDATE TAG SET TIME_TYPE='Lumi' WHERE TIME_TYPE='Time';")
+
+    # 2. Rewrite the SINCE of every imported payload to its packed run/LS
+    updates = []
+    for since_iov, payload_hash, run, ls in resolved:
+        packed_iov = pack(run, ls)
+        print(f"  Updating IOV {since_iov} -> Run {run}, LS {ls} -> packed {packed_iov}")
+        updates.append((packed_iov, since_iov))
+    cur.executemany("UPDATE IOV SET SINCE=? WHERE SINCE=?;", updates)
+    print(f" Updated {cur.rowcount} row(s) for {len(updates)} IOV(s)")
+    if cur.rowcount < len(updates):
+        print(f" Some IOVs were not found in {sqlite_file}")
+
+    # 3. The payloads of the range that we could not place in a run keep
+    #    their time-based SINCE: they don't belong in a run-lumi tag
+    skipped = [(since,) for since in unresolved if first_since <= since <= last_since]
+    if skipped:
+        cur.executemany("DELETE FROM IOV WHERE SINCE=?;", skipped)
+        print(f" Removed {cur.rowcount} IOV(s) that could not be placed in a run")
 
-conn.commit()
 conn.close()
 
 print("\n All IOVs updated to Run-LS format and TIME_TYPE changed to 'Lumi'.")
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Batching policy for the step 2 jobs of the NGT calibration loop.
+#
+# Instead of one job per file, or one giant job with everything pending, the
+# files are grouped into jobs that target a number of events (taken from the
+# LS inventory) or a wall time per job. A job gets between minFiles and
+# maxFiles files, and a batch that is not full yet is still flushed once its
+# oldest file has waited longer than the latency deadline.
+#
+# In the streaming mode, the files are grouped by LS instead, into blocks
+# that are launched as soon as they are closed.
+#
+# The statistics gate of step 4 holds the harvests of a run back until its
+# step 3 outputs add up to enough events.
+
+import logging
+import time
+
+BATCHING_DEFAULTS = {
+    "target_events": 50000,
+    "target_wall_time_seconds": None,
+    "min_files": 1,
+    "max_files": 5,
+    "max_latency_seconds": 300,
+}
+
+# Streaming mode ("streaming" block of step_2_config): instead of batches,
+# the files are grouped into blocks of ls_per_block consecutive LS, each with
+# its own output and witness file, and a job processes up to
+# max_blocks_per_job blocks one after the other
+STREAMING_DEFAULTS = {
+    "enabled": False,
+    "ls_per_block": 1,
+    "max_blocks_per_job": 1,
+}
+
+# Fan-out of the step 3 ALCA jobs ("fan_out" block of step_3_config): a pass
+# is split into at most max_jobs parallel jobs of at least min_events_per_job
+FANOUT_DEFAULTS = {
+    "max_jobs": 1,
+    "min_events_per_job": 20000,
+}
+
+# Statistics gate of the step 4 harvests ("statistics_gate" block of
+# step_4_config): the first harvest of a run waits for min_events, the
+# next ones for backoff_factor times more events than the one before
+STATISTICS_GATE_DEFAULTS = {
+    "min_events": 0,
+    "backoff_factor": 2.0,
+}
+
+
+class BatchPolicy(object):
+
+    def __init__(
+        self,
+        targetEvents=BATCHING_DEFAULTS["target_events"],
+        targetWallTimeInSeconds=BATCHING_DEFAULTS["target_wall_time_seconds"],
+        minFiles=BATCHING_DEFAULTS["min_files"],
+        maxFiles=BATCHING_DEFAULTS["max_files"],
+        maxLatencyInSeconds=BATCHING_DEFAULTS["max_latency_seconds"],
+    ):
+        self.targetEvents = targetEvents
+        self.targetWallTimeInSeconds = targetWallTimeInSeconds
+        self.minFiles = max(1, minFiles)
+        self.maxFiles = max(self.minFiles, maxFiles)
+        self.maxLatencyInSeconds = maxLatencyInSeconds
+        # Processing rate of our jobs, learnt from the jobs that finished
+        self.eventsPerSecond = None
+
+    @classmethod
+    def FromConfig(cls, config):
+        # config is the "batching" block of step_2_config, missing keys get the defaults
+        config = dict(BATCHING_DEFAULTS, **(config or {}))
+        return cls(
+            targetEvents=config["target_events"],
+            targetWallTimeInSeconds=config["target_wall_time_seconds"],
+            minFiles=config["min_files"],
+            maxFiles=config["max_files"],
+            maxLatencyInSeconds=config["max_latency_seconds"],
+        )
+
+    def ObserveJob(self, nEvents, wallTimeInSeconds):
+        # We keep a running average of the rate, so that a wall time target
+        # can be turned into a number of events
+        if nEvents <= 0 or wallTimeInSeconds <= 0:
+            return
+        rate = nEvents / wallTimeInSeconds
+        if self.eventsPerSecond is None:
+            self.eventsPerSecond = rate
+        else:
+            self.eventsPerSecond = 0.7 * self.eventsPerSecond + 0.3 * rate
+
+    def TargetEvents(self):
+        # The wall time target wins once we know how fast the jobs go
+        if self.targetWallTimeInSeconds and self.eventsPerSecond:
+            return int(self.targetWallTimeInSeconds * self.eventsPerSecond)
+        return self.targetEvents
+
+    def IsFull(self, nFiles, nEvents):
+        if nFiles >= self.maxFiles:
+            return True
+        target = self.TargetEvents()
+        return bool(target) and nEvents >= target and nFiles >= self.minFiles
+
+    def FormBatches(self, pendingFiles, final=False, now=None):
+        # pendingFiles is a list of (path, nEvents, firstSeen), in the order
+        # they should be processed (i.e. by LS). Returns a list of batches,
+        # each a list of paths. What is not returned stays pending.
+        # With final=True everything pending is returned.
+        now = time.time() if now is None else now
+        batches = []
+        batch, batchEvents = [], 0
+        for path, nEvents, firstSeen in pendingFiles:
+            batch.append((path, firstSeen))
+            batchEvents += nEvents
+            if self.IsFull(len(batch), batchEvents):
+                batches.append([p for p, _ in batch])
+                batch, batchEvents = [], 0
+
+        if batch:
+            oldest = min(firstSeen for _, firstSeen in batch)
+            if final:
+                batches.append([p for p, _ in batch])
+            elif now - oldest >= self.maxLatencyInSeconds:
+                logging.info(
+                    f"Flushing a partial batch of {len(batch)} file(s) with {batchEvents} events, "
+                    f"its oldest file waited {now - oldest:.0f} s"
+                )
+                batches.append([p for p, _ in batch])
+            else:
+                logging.info(
+                    f"Holding a partial batch of {len(batch)} file(s) with {batchEvents} events "
+                    f"(target {self.TargetEvents()} events, {self.minFiles}-{self.maxFiles} files)"
+                )
+        return batches
+
+
+class StreamingPolicy(object):
+    # A block is launched as soon as it is closed: all its LS are on EOS, or
+    # a later LS is, and there is no target number of events to wait for.
+    # The files are assigned to the block of their first LS.
+
+    def __init__(
+        self,
+        lsPerBlock=STREAMING_DEFAULTS["ls_per_block"],
+        maxBlocksPerJob=STREAMING_DEFAULTS["max_blocks_per_job"],
+        maxLatencyInSeconds=BATCHING_DEFAULTS["max_latency_seconds"],
+    ):
+        self.lsPerBlock = max(1, lsPerBlock)
+        self.maxBlocksPerJob = max(1, maxBlocksPerJob)
+        self.maxLatencyInSeconds = maxLatencyInSeconds
+
+    @classmethod
+    def FromConfig(cls, config, maxLatencyInSeconds=BATCHING_DEFAULTS["max_latency_seconds"]):
+        # config is the "streaming" block of step_2_config. Returns None
+        # unless the streaming mode is enabled.
+        config = dict(STREAMING_DEFAULTS, **(config or {}))
+        if not config["enabled"]:
+            return None
+        return cls(
+            lsPerBlock=config["ls_per_block"],
+            maxBlocksPerJob=config["max_blocks_per_job"],
+            maxLatencyInSeconds=maxLatencyInSeconds,
+        )
+
+    def BlockRange(self, ls):
+        # The first and last LS of the block of this LS
+        first = (ls - 1) // self.lsPerBlock * self.lsPerBlock + 1
+        return first, first + self.lsPerBlock - 1
+
+    def IsClosed(self, blockRange, presentLS):
+        first, last = blockRange
+        if all(ls in presentLS for ls in range(first, last + 1)):
+            return True
+        return max(presentLS, default=0) > last
+
+    def FormJobs(self, pendingFiles, presentLS, final=False, now=None):
+        # pendingFiles is a list of (path, lumisections, firstSeen), presentLS
+        # the LS of the run found on EOS so far. Returns a list of jobs, each
+        # a list of blocks, each a list of paths. What is not returned stays
+        # pending. With final=True everything pending is returned.
+        now = time.time() if now is None else now
+        blocks = {}
+        for path, lumisections, firstSeen in pendingFiles:
+            blockRange = self.BlockRange(min(lumisections, default=1))
+            blocks.setdefault(blockRange, []).append((path, firstSeen))
+
+        closed = []
+        for blockRange, files in sorted(blocks.items()):
+            oldest = min(firstSeen for _, firstSeen in files)
+            if final or self.IsClosed(blockRange, presentLS):
+                closed.append([p for p, _ in files])
+            elif now - oldest >= self.maxLatencyInSeconds:
+                logging.info(
+                    f"Flushing the open block of LS {blockRange[0]}-{blockRange[1]}, "
+                    f"its oldest file waited {now - oldest:.0f} s"
+                )
+                closed.append([p for p, _ in files])
+            else:
+                logging.info(
+                    f"Holding the open block of LS {blockRange[0]}-{blockRange[1]} ({len(files)} file(s))"
+                )
+        return [
+            closed[i : i + self.maxBlocksPerJob] for i in range(0, len(closed), self.maxBlocksPerJob)
+        ]
+
+
+def SplitByEvents(files, nShards):
+    # files is a list of (path, nEvents). Returns nShards lists of paths with
+    # about the same number of events each: the biggest files go first, each
+    # to the shard with the fewest events so far.
+    shards = [[] for _ in range(nShards)]
+    shardEvents = [0] * nShards
+    for path, nEvents in sorted(files, key=lambda f: (-f[1], str(f[0]))):
+        i = shardEvents.index(min(shardEvents))
+        shards[i].append(path)
+        shardEvents[i] += nEvents
+    return [shard for shard in shards if shard]
+
+
+class StatisticsGate(object):
+
+    def __init__(
+        self,
+        minEvents=STATISTICS_GATE_DEFAULTS["min_events"],
+        backoffFactor=STATISTICS_GATE_DEFAULTS["backoff_factor"],
+    ):
+        self.minEvents = minEvents
+        self.backoffFactor = max(1.0, backoffFactor)
+
+    @classmethod
+    def FromConfig(cls, config):
+        # config is the "statistics_gate" block of step_4_config. Returns None
+        # without one, i.e. every new step 3 output gets a harvest.
+        if not config:
+            return None
+        config = dict(STATISTICS_GATE_DEFAULTS, **config)
+        return cls(minEvents=config["min_events"], backoffFactor=config["backoff_factor"])
+
+    def Threshold(self, harvestsDone):
+        # The events the run needs for its next harvest: min_events for the
+        # first one, then min_events * backoff_factor^n
+        return int(self.minEvents * self.backoffFactor**harvestsDone)
+
+    def IsOpen(self, events, harvestsDone):
+        # events is None if we could not count the events of every output:
+        # we don't hold the payloads back on a guess
+        if events is None:
+            return True
+        return events >= self.Threshold(harvestsDone)
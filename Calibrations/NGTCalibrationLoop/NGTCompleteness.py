@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Completeness of the runs followed by the step 2 loop.
+#
+# Once a run has ended, step 2 has to decide when to form its final batch:
+# too early and the LS still on their way to EOS are lost, too late and the
+# payload waits for nothing. The tracker is told about the files as they
+# appear, and knows from the LS inventory exactly which LS of the run are on
+# EOS and which are missing: only the new files are looked at. The run
+# is complete when the coverage crosses a threshold (every LS, by default),
+# or when the missing LS stopped arriving: nothing new came for a while, and
+# they are overdue according to the Tier-0 latency (from the end of a LS to
+# its file on EOS) of the previous files.
+#
+# It is configured in the step_2_config of the calibration YAML, e.g.
+#   completeness:
+#     coverage_threshold: 1.0        # fraction of the LS of the run
+#     stall_seconds: 120             # nothing new for that long...
+#     latency_percentile: 0.95       # ...and the missing LS are overdue
+#     default_latency_seconds: 900   # the Tier-0 latency until we know better
+
+import json
+import logging
+import os
+import threading
+import time
+
+from NGTTrace import Percentile
+
+# A lumisection is 2^18 LHC orbits
+LS_DURATION_SECONDS = 2**18 / 11245.5
+
+
+class Tier0LatencyHistory(object):
+    # The most recent Tier-0 latencies, kept across runs in a small JSON file
+
+    def __init__(self, historyFile, maxEntries=2000):
+        self.historyFile = historyFile
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.Load()
+
+    def Load(self):
+        if not self.historyFile or not os.path.exists(self.historyFile):
+            return
+        try:
+            with open(self.historyFile, "r") as f:
+                self.latencies = json.load(f)[-self.maxEntries :]
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read the Tier-0 latency history {self.historyFile}: {e}")
+            self.latencies = []
+
+    def Save(self):
+        if not self.historyFile:
+            return
+        # Write-then-rename, so that a crash never leaves a truncated history behind
+        tmpFile = self.historyFile + ".tmp"
+        with self.lock:
+            with open(tmpFile, "w") as f:
+                json.dump(self.latencies, f)
+        os.replace(tmpFile, self.historyFile)
+
+    def Add(self, latencies):
+        if not latencies:
+            return
+        with self.lock:
+            self.latencies = (self.latencies + list(latencies))[-self.maxEntries :]
+        self.Save()
+
+    def Percentile(self, fraction):
+        with self.lock:
+            values = list(self.latencies)
+        return Percentile(values, fraction)
+
+
+class CompletenessTracker(object):
+
+    def __init__(
+        self,
+        runStartTime,
+        history=None,
+        coverageThreshold=1.0,
+        stallSeconds=120,
+        latencyPercentile=0.95,
+        defaultLatencySeconds=900,
+    ):
+        # Seconds since the epoch
+        self.runStartTime = runStartTime
+        self.history = history
+        self.coverageThreshold = coverageThreshold
+        self.stallSeconds = stallSeconds
+        self.latencyPercentile = latencyPercentile
+        self.defaultLatencySeconds = defaultLatencySeconds
+        self.knownFiles = set()
+        self.presentLS = set()
+        # When we last saw a LS we did not have yet
+        self.lastNewLSTime = time.time()
+        # The number of present LS up to lastLS, updated as the LS come in
+        self.lastLS = 0
+        self.coveredLS = 0
+
+    @classmethod
+    def FromConfig(cls, config, runStartTime, history=None):
+        # config is the "completeness" block of step_2_config, if any
+        config = config or {}
+        return cls(
+            runStartTime,
+            history=history,
+            coverageThreshold=config.get("coverage_threshold", 1.0),
+            stallSeconds=config.get("stall_seconds", 120),
+            latencyPercentile=config.get("latency_percentile", 0.95),
+            defaultLatencySeconds=config.get("default_latency_seconds", 900),
+        )
+
+    def LSEndTime(self, ls):
+        return self.runStartTime + ls * LS_DURATION_SECONDS
+
+    def Add(self, files, inventory, arrivalTime=None, now=None):
+        # Only the files we have not seen yet are looked at. arrivalTime(path)
+        # gives the time the file appeared on EOS (its mtime), if we know it.
+        now = time.time() if now is None else now
+        latencies = []
+        for path in files:
+            if path in self.knownFiles:
+                continue
+            self.knownFiles.add(path)
+            lumisections = inventory.LSForFiles([path])
+            newLS = lumisections - self.presentLS
+            if not newLS:
+                continue
+            self.presentLS |= newLS
+            self.coveredLS += sum(1 for ls in newLS if ls <= self.lastLS)
+            self.lastNewLSTime = now
+            arrival = arrivalTime(path) if arrivalTime is not None else None
+            if arrival is not None:
+                latency = arrival - self.LSEndTime(max(lumisections))
+                if latency >= 0:
+                    latencies.append(latency)
+        if self.history is not None:
+            self.history.Add(latencies)
+
+    def SetLastLS(self, lastLS):
+        # OMS tells us how many LS the run has: this only moves forward
+        # while the run is going on. 0 is OMS not knowing, not an empty run
+        if lastLS > 0 and lastLS != self.lastLS:
+            self.lastLS = lastLS
+            self.coveredLS = sum(1 for ls in self.presentLS if ls <= lastLS)
+
+    def Coverage(self):
+        if self.lastLS <= 0:
+            return 0.0
+        return self.coveredLS / self.lastLS
+
+    def MissingLS(self):
+        return sorted(set(range(1, self.lastLS + 1)) - self.presentLS)
+
+    def Tier0Latency(self):
+        latency = self.history.Percentile(self.latencyPercentile) if self.history is not None else None
+        return self.defaultLatencySeconds if latency is None else latency
+
+    def ExpectedArrival(self, ls):
+        # When the file of this LS should be on EOS, at the latency percentile
+        return self.LSEndTime(ls) + self.Tier0Latency()
+
+    def IsComplete(self, lastLS, now=None):
+        now = time.time() if now is None else now
+        if lastLS <= 0:
+            # Without the number of LS from OMS, we can't tell what is missing
+            logging.info("The run has no LS according to OMS yet, waiting for the files")
+            return False
+        self.SetLastLS(lastLS)
+        coverage = self.Coverage()
+        if coverage >= self.coverageThreshold:
+            logging.info(
+                f"{self.coveredLS}/{lastLS} LS on EOS ({100 * coverage:.1f}%), "
+                f"the threshold is {100 * self.coverageThreshold:.1f}%"
+            )
+            return True
+
+        missing = self.MissingLS()
+        quietFor = now - self.lastNewLSTime
+        expected = self.ExpectedArrival(missing[-1]) if missing else now
+        if quietFor >= self.stallSeconds and now >= expected:
+            logging.info(
+                f"{self.coveredLS}/{lastLS} LS on EOS ({100 * coverage:.1f}%), nothing new for "
+                f"{quietFor:.0f} s and the missing ones are overdue: giving up on {len(missing)} LS"
+            )
+            return True
+
+        logging.info(
+            f"{self.coveredLS}/{lastLS} LS on EOS ({100 * coverage:.1f}%), waiting for {len(missing)} more "
+            f"(first missing {missing[:10]}), expected by {time.strftime('%H:%M:%S', time.localtime(expected))}"
+        )
+        return False
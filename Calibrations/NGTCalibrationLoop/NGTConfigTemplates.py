@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# cmsRun configuration templates for the NGT calibration loop.
+#
+# cmsDriver only runs once per (calibration, run, CMSSW version, GT) to
+# produce a template configuration. Each job then gets a small override
+# configuration, that loads the template and only changes the input files
+# and the output file name.
+
+
+def TemplateFileName(runNumber, affix, cmsswVersion, globalTag):
+    return f"run{runNumber}{affix}_template_{cmsswVersion}_{globalTag}.py"
+
+
+def WriteTemplateGeneration(f, templateFile, cmsDriverCommand):
+    # Writes the shell lines that generate the template, unless it exists.
+    # The first job to get the lock generates it, the others wait for it.
+    f.write("# cmsDriver runs once, the first job generates the template config\n")
+    f.write(f"if [ ! -f {templateFile} ]; then\n")
+    f.write("  (\n")
+    f.write("    flock 9\n")
+    f.write(f"    if [ ! -f {templateFile} ]; then\n")
+    f.write(f"      {cmsDriverCommand} --python_filename {templateFile}.tmp\n")
+    f.write(f"      mv {templateFile}.tmp {templateFile}\n")
+    f.write("    fi\n")
+    f.write(f"  ) 9>{templateFile}.lock\n")
+    f.write("fi\n\n")
+
+
+def WriteOverrideConfig(configFile, templateFile, fileNames, outputFileName=None, splitOutputs=None):
+    with open(configFile, "w") as f:
+        f.write("# Generated by the NGT calibration loop: template + overrides\n")
+        f.write("import FWCore.ParameterSet.Config as cms\n\n")
+        f.write(f"exec(open({str(templateFile)!r}).read())\n\n")
+        f.write("process.source.fileNames = cms.untracked.vstring(\n")
+        for fileName in sorted(fileNames):
+            f.write(f"    {fileName!r},\n")
+        f.write(")\n")
+        # The step 2 templates have a single output module. The ALCA ones
+        # keep their output names, each job runs in its own directory.
+        if outputFileName is not None:
+            f.write("for outputModule in process.outputModules_().values():\n")
+            f.write(f"    outputModule.fileName = cms.untracked.string({outputFileName!r})\n")
+        if splitOutputs:
+            WriteSplitOutputs(f, splitOutputs)
+
+
+def WriteSplitOutputs(f, splitOutputs):
+    # When several calibrations share a step 2 pass, the single output module
+    # of the template becomes one output module per calibration. splitOutputs
+    # is a list of (fileName, paths): each output only keeps the events that
+    # passed the given (ALCAPRODUCER) paths.
+    f.write("\n# One output per calibration sharing this pass\n")
+    f.write("baseOutput = list(process.outputModules_().values())[0]\n")
+    for i, (fileName, paths) in enumerate(splitOutputs):
+        selectEvents = f"cms.untracked.PSet(SelectEvents=cms.vstring({', '.join(repr(p) for p in paths)}))"
+        if i == 0:
+            f.write(f"baseOutput.fileName = cms.untracked.string({fileName!r})\n")
+            f.write(f"baseOutput.SelectEvents = {selectEvents}\n")
+        else:
+            f.write(
+                f"process.splitOutput{i} = baseOutput.clone(\n"
+                f"    fileName=cms.untracked.string({fileName!r}),\n"
+                f"    SelectEvents={selectEvents},\n"
+                ")\n"
+            )
+            f.write(f"process.splitOutput{i}EndPath = cms.EndPath(process.splitOutput{i})\n")
+            f.write(f"process.schedule.append(process.splitOutput{i}EndPath)\n")
+
+
+def WriteShardsAndMerge(f, shardDirs, configFile, mergePattern):
+    # Writes the shell lines that run the same cmsRun configuration in each
+    # of the shard directories in parallel, and then merges the outputs
+    # matching mergePattern (e.g. "PromptCalibProd*.root") of all the shards
+    # into the current directory, with the Tier-0 merge configuration.
+    f.write("# Fan-out: one cmsRun per shard, all in parallel\n")
+    f.write("pids=()\n")
+    for shardDir in shardDirs:
+        f.write(f"(cd {shardDir} && cmsRun {configFile} > cmsRun.log 2>&1) &\n")
+        f.write("pids+=($!)\n")
+    f.write("failed=0\n")
+    f.write('for pid in "${pids[@]}"; do wait $pid || failed=1; done\n')
+    f.write('if [ "$failed" != 0 ]; then echo "A shard failed"; exit 1; fi\n\n')
+
+    inputs = ", ".join(f'"file:{shardDir}/$name"' for shardDir in shardDirs)
+    f.write("# Merge: the shard outputs are combined before harvesting\n")
+    f.write(f"for output in {shardDirs[0]}/{mergePattern}; do\n")
+    f.write('  name=$(basename $output)\n')
+    f.write('  cat <<@EOF> merge_${name%.root}.py\n')
+    f.write("from Configuration.DataProcessing.Merge import mergeProcess\n")
+    f.write(f'process = mergeProcess({inputs}, output_file="$name")\n')
+    f.write("@EOF\n")
+    f.write('  cmsRun merge_${name%.root}.py > merge_${name%.root}.log 2>&1 || exit 1\n')
+    f.write("done\n\n")
+
+
+def WriteHistogramConversionConfig(configFile, inputFiles, metoedmProducer, outputFileName):
+    # Incremental harvesting: converts the histograms the PCL workers stored
+    # in the step 3 outputs (the MEtoEDM run products of metoedmProducer)
+    # into a DQMIO file. Its size only depends on the histograms, not on the
+    # number of files or LS that went into them.
+    with open(configFile, "w") as f:
+        f.write("# Generated by the NGT calibration loop: step 3 outputs to DQMIO\n")
+        f.write("import FWCore.ParameterSet.Config as cms\n\n")
+        f.write('process = cms.Process("NGTTODQM")\n')
+        f.write('process.source = cms.Source("PoolSource", fileNames=cms.untracked.vstring(\n')
+        for fileName in sorted(str(p) for p in inputFiles):
+            f.write(f"    {'file:' + fileName!r},\n")
+        f.write("))\n")
+        f.write('process.load("DQMServices.Core.DQMStore_cfi")\n')
+        f.write('process.load("DQMServices.Components.EDMtoMEConverter_cfi")\n')
+        f.write(f'process.EDMtoMEConverter.runInputTag = cms.InputTag({metoedmProducer!r}, "MEtoEDMConverterRun")\n')
+        f.write(f'process.EDMtoMEConverter.lumiInputTag = cms.InputTag({metoedmProducer!r}, "MEtoEDMConverterLumi")\n')
+        # The harvesters only need the run histograms, the per-LS ones would
+        # make the file grow with the run
+        f.write("process.EDMtoMEConverter.convertOnEndLumi = False\n")
+        f.write("process.convert = cms.Path(process.EDMtoMEConverter)\n")
+        f.write(f'process.dqmOutput = cms.OutputModule("DQMRootOutputModule", fileName=cms.untracked.string({outputFileName!r}))\n')
+        f.write("process.output = cms.EndPath(process.dqmOutput)\n")
+
+
+def WriteHistogramSumConfig(configFile, inputFiles, outputFileName):
+    # Adds up the histograms of DQMIO files of the same run, with the DQMIO
+    # flavour of the Tier-0 merge
+    with open(configFile, "w") as f:
+        f.write("# Generated by the NGT calibration loop: sum of DQMIO histograms\n")
+        f.write("from Configuration.DataProcessing.Merge import mergeProcess\n\n")
+        f.write("process = mergeProcess(\n")
+        for fileName in inputFiles:
+            f.write(f"    {'file:' + str(fileName)!r},\n")
+        f.write(f"    output_file={outputFileName!r},\n")
+        f.write("    newDQMIO=True,\n")
+        f.write(")\n")
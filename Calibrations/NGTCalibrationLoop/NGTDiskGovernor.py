@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Disk-space governor of the NGT run directories.
+#
+# The run directories in /tmp/ngt fill up with the intermediate products of
+# the steps, and a full disk stalls every one of them. The governor deletes
+# each product once all its consumers are done with it, which it knows from
+# the job ledger that every step writes to:
+#   - a step 2 output, once the step 3 ALCA job that read it is done,
+#   - the script and configurations of a step 2 job, once the job is done,
+#   - the histograms-so-far file of a harvest, once a later harvest of the run is done,
+#   - every ROOT file left in the run directory (e.g. the step 3 outputs),
+#     once every step of every calibration has closed the run and none of
+#     its jobs is queued or running.
+# The logs, the traces, the witness files and the payloads stay.
+#
+# It also keeps an eye on the space the run directories take. A run over its
+# quota, all of them over the global quota, or too little free space on the
+# disk, and step 2 holds back its new jobs (back-pressure) until the cleanup
+# makes room: step 2 is where the big files come from, and the steps after
+# it are the ones that free them. Over the global quota, or short of free
+# space, the oldest runs that every step is done with are deleted altogether.
+
+import json
+import logging
+import os
+import re
+import shutil
+from pathlib import Path
+
+from NGTLedger import JobLedger
+from NGTLoopBase import NGT_BASE
+from NGTMetrics import METRICS
+from NGTUploader import UPLOAD_BASE
+
+GB = 1024**3
+
+# The defaults of the command line options of step 2 and of the engine.
+# A quota of 0 is no quota.
+runQuotaInGB = 100
+totalQuotaInGB = 500
+minFreeInGB = 20
+
+deletedBytes = METRICS.Counter("ngt_disk_deleted_bytes_total", "Bytes deleted from the run directories, per kind of product.")
+METRICS.Gauge("ngt_disk_run_bytes", "Bytes taken by the run directory, per run.")
+METRICS.Gauge("ngt_disk_free_bytes", "Free bytes on the filesystem of the run directories.")
+METRICS.Gauge("ngt_disk_backpressure", "1 while step 2 holds back the new jobs of the run for lack of disk space, per run.")
+
+
+def DirectoryBytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # Deleted in the meantime
+                continue
+    return total
+
+
+def HarvestNumber(jobName):
+    # e.g. harvestJob003_EcalPedestals -> 3
+    match = re.match(r"harvestJob(\d+)_", jobName)
+    return int(match.group(1)) if match else None
+
+
+class DiskGovernor(object):
+
+    def __init__(self, base=NGT_BASE, runQuotaInGB=runQuotaInGB, totalQuotaInGB=totalQuotaInGB, minFreeInGB=minFreeInGB, uploadBase=UPLOAD_BASE):
+        self.base = Path(base)
+        self.uploadBase = Path(uploadBase)
+        self.runQuotaInBytes = (runQuotaInGB or 0) * GB
+        self.totalQuotaInBytes = (totalQuotaInGB or 0) * GB
+        self.minFreeInBytes = (minFreeInGB or 0) * GB
+        # The ledger of the whole node: the jobs of every step and calibration
+        self.ledger = JobLedger()
+        # run -> bytes taken by its directory, as of the last poll
+        self.runBytes = {}
+        # The runs every step is done with, whose leftovers are gone
+        self.runsDone = set()
+        # run -> the paths we deleted already, not to look at them again
+        self.deleted = {}
+        METRICS.AddCollector(self.Metrics)
+
+    def RunDirectory(self, run):
+        return self.base / f"run{run}"
+
+    def Poll(self):
+        # Deletes what the consumers are done with, measures what is left and
+        # makes room if needed. Called by the scheduler, it never "progresses".
+        runs = sorted(
+            p.name[len("run"):] for p in self.base.glob("run*")
+            if p.name[len("run"):].isdigit() and p.is_dir()
+        )
+        for run in runs:
+            if run in self.runsDone:
+                continue
+            self.CleanRun(run)
+            self.runBytes[run] = DirectoryBytes(self.RunDirectory(run))
+        # The run directories deleted by hand (or by us) are gone for good
+        for run in set(self.runBytes) - set(runs):
+            del self.runBytes[run]
+            self.runsDone.discard(run)
+        self.MakeRoom()
+        return False
+
+    def CleanRun(self, run):
+        jobs = self.ledger.RunJobs(run)
+        runDir = self.RunDirectory(run)
+        freedBytes = 0
+        lastHarvests = {}
+        for step, calibration, name, status, info in jobs:
+            if status != "done":
+                continue
+            if step == "Step2":
+                freedBytes += self.DeleteJobScript(run, runDir / name)
+            elif step == "Step3":
+                # Nobody reads a step 2 output but the ALCA job of its calibration
+                for path in info.get("inputs", []):
+                    freedBytes += self.Delete(run, path, "step2Output")
+            elif step == "Step4" and HarvestNumber(name) is not None:
+                lastHarvests[calibration] = max(lastHarvests.get(calibration, -1), HarvestNumber(name))
+
+        # Each harvest starts from the histograms-so-far file of the one
+        # before, which holds the sum of all the earlier ones
+        for step, calibration, name, status, info in jobs:
+            number = HarvestNumber(name) if step == "Step4" else None
+            if number is not None and number < lastHarvests.get(calibration, -1) and "jobDir" in info:
+                freedBytes += self.Delete(run, Path(info["jobDir"]) / "histogramsSoFar.root", "histogramsSoFar")
+
+        runIsDone = self.RunIsDone(run, jobs)
+        if runIsDone:
+            # A harvest that fails merges all the step 3 outputs again, so they
+            # only go with the rest of the ROOT files, once the run is closed
+            for path in sorted(runDir.rglob("*.root")):
+                freedBytes += self.Delete(run, path, "runLeftovers")
+            self.runsDone.add(run)
+            self.deleted.pop(run, None)
+        if freedBytes:
+            logging.info(f"Freed {freedBytes / 2**20:.1f} MB in the directory of run {run}")
+        if runIsDone:
+            logging.info(f"Every step is done with run {run}, its intermediate products are deleted")
+
+    def RunIsDone(self, run, jobs):
+        # Every calibration of the step 2 passes of the run went through
+        # steps 3 and 4, and no job of the run is left
+        statuses = self.ledger.RunStatuses(run)
+        calibrations = {
+            calibration
+            for step, passName in statuses
+            if step == "Step2"
+            for calibration in passName.split("+")
+        }
+        if not calibrations or any(status != "done" for status in statuses.values()):
+            return False
+        if any((step, calibration) not in statuses for calibration in calibrations for step in ("Step3", "Step4")):
+            return False
+        return not any(status in ("queued", "running") for _, _, _, status, _ in jobs)
+
+    def DeleteJobScript(self, run, script):
+        # The step 2 job script and the configurations of its cmsRuns
+        if os.path.normpath(script) in self.deleted.get(run, ()):
+            return 0
+        try:
+            text = script.read_text()
+        except OSError:
+            text = ""
+        freedBytes = 0
+        for config in re.findall(r"^cmsRun (\S+\.py)", text, re.MULTILINE):
+            freedBytes += self.Delete(run, script.parent / config, "step2Job")
+        return freedBytes + self.Delete(run, script, "step2Job")
+
+    def Delete(self, run, path, product):
+        # Returns the number of bytes freed
+        path = os.path.normpath(path)
+        deleted = self.deleted.setdefault(run, set())
+        if path in deleted:
+            return 0
+        # Never anything outside of the run directory
+        runDir = os.path.normpath(self.RunDirectory(run))
+        if os.path.commonpath([path, runDir]) != runDir:
+            logging.warning(f"Not deleting {path}, it is not in {runDir}")
+            deleted.add(path)
+            return 0
+        try:
+            size = os.lstat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            size = 0
+        except OSError as e:
+            logging.warning(f"Could not delete {path}: {e}")
+            return 0
+        deleted.add(path)
+        if size:
+            logging.debug(f"Deleted {path} ({size} bytes)")
+            deletedBytes.Inc(size, product=product)
+        return size
+
+    def FreeBytes(self):
+        return shutil.disk_usage(self.base).free
+
+    def OverQuota(self):
+        # Why the run directories need room, or None
+        if self.minFreeInBytes:
+            free = self.FreeBytes()
+            if free < self.minFreeInBytes:
+                return f"only {free / GB:.1f} GB free, under the minimum of {self.minFreeInBytes / GB:.1f} GB"
+        total = sum(self.runBytes.values())
+        if self.totalQuotaInBytes and total > self.totalQuotaInBytes:
+            return f"the run directories take {total / GB:.1f} GB, over the quota of {self.totalQuotaInBytes / GB:.1f} GB"
+        return None
+
+    def BackPressure(self, run):
+        # Why step 2 should hold back the new jobs of the run, or None
+        reason = self.OverQuota()
+        if reason is None and self.runQuotaInBytes:
+            used = self.runBytes.get(str(run), 0)
+            if used > self.runQuotaInBytes:
+                reason = f"run {run} takes {used / GB:.1f} GB, over its quota of {self.runQuotaInBytes / GB:.1f} GB"
+        return reason
+
+    def MakeRoom(self):
+        # The runs every step is done with go, oldest first, with their logs
+        # and traces. Those with payloads still waiting for an upload stay.
+        reason = self.OverQuota()
+        if reason is None:
+            return
+        uploading = self.RunsWithPendingUploads()
+        for run in sorted(self.runsDone, key=int):
+            if run in uploading:
+                continue
+            logging.warning(f"Deleting the directory of run {run}: {reason}")
+            shutil.rmtree(self.RunDirectory(run), ignore_errors=True)
+            deletedBytes.Inc(self.runBytes.pop(run, 0), product="runDirectory")
+            self.runsDone.discard(run)
+            reason = self.OverQuota()
+            if reason is None:
+                return
+        logging.warning(f"No run directory left to delete, {reason}")
+
+    def RunsWithPendingUploads(self):
+        # The uploader copies the payloads from the harvest directories only
+        # when their upload starts
+        runs = set()
+        for stateFile in self.uploadBase.glob("*/uploads.json"):
+            try:
+                with open(stateFile, "r") as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not read upload state {stateFile}: {e}")
+                # We can't tell which runs are safe to delete
+                return set(self.runsDone)
+            for payload in list(state.get("pending", {}).values()) + list(state.get("inFlight", {}).values()):
+                runs.add(str(payload["run"]))
+        return runs
+
+    def Metrics(self):
+        samples = [("ngt_disk_free_bytes", {}, self.FreeBytes())]
+        for run, used in sorted(self.runBytes.items()):
+            samples.append(("ngt_disk_run_bytes", {"run": run}, used))
+            if run not in self.runsDone:
+                samples.append(("ngt_disk_backpressure", {"run": run}, int(self.BackPressure(run) is not None)))
+        return samples
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Prepared CMSSW environment for the jobs of the NGT calibration loop.
+#
+# Instead of every job doing "cmsrel" + "cmsenv", the release area is created
+# once per node, and the output of "scram runtime -sh" is cached in a small
+# shell script that the jobs simply source. Steps 2, 3 and 4 run under
+# different accounts: the cached environment is writable by all of them,
+# and only prepared again when the release area was set up since.
+
+import fcntl
+import logging
+import os
+import subprocess
+from pathlib import Path
+
+ENVIRONMENT_BASE = "/tmp/ngt/cmssw"
+
+
+def EnvironmentScriptPath(releaseArea):
+    # One cached environment per release area, e.g.
+    # /tmp/ngt/cmssw/CMSSW_15_0_16 -> /tmp/ngt/cmssw/env_tmp_ngt_cmssw_CMSSW_15_0_16.sh
+    name = str(releaseArea).strip("/").replace("/", "_")
+    return f"{ENVIRONMENT_BASE}/env_{name}.sh"
+
+
+def RunScram(args, cwd, scramArch):
+    env = dict(os.environ, SCRAM_ARCH=scramArch)
+    result = subprocess.run(
+        ["scram"] + args, cwd=cwd, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        logging.critical(f"scram {' '.join(args)} failed in {cwd}:\n{result.stderr}")
+        raise RuntimeError(f"scram {' '.join(args)} failed in {cwd}:\n{result.stderr}")
+    return result.stdout
+
+
+def ReleaseTime(releaseArea):
+    # When the release area was last set up (scram project, scram setup...)
+    times = [
+        os.stat(path).st_mtime
+        for path in (releaseArea, releaseArea / ".SCRAM", releaseArea / "config")
+        if path.exists()
+    ]
+    return max(times, default=0)
+
+
+def ShareWithOtherAccounts(path, mode):
+    # Step 2 (cmsusr) and steps 3/4 (sakura) share the cached environment.
+    # Only the owner can change the mode: for the others, it did it already.
+    try:
+        os.chmod(path, mode)
+    except PermissionError:
+        pass
+
+
+def ShareTree(top):
+    # The release area we create is writable by the other accounts too
+    for root, dirs, files in os.walk(top):
+        ShareWithOtherAccounts(root, 0o777)
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                ShareWithOtherAccounts(path, os.stat(path).st_mode | 0o666)
+
+
+def PrepareEnvironment(scramArch, cmsswVersion, releaseBase=ENVIRONMENT_BASE):
+    # Returns the path of a script that sets up the CMSSW runtime environment.
+    # The release area is only created if it does not exist yet, and the
+    # environment is only evaluated if it is not cached yet, or if the
+    # release area was set up again since.
+    releaseArea = Path(releaseBase) / cmsswVersion
+    envScript = EnvironmentScriptPath(releaseArea)
+    Path(ENVIRONMENT_BASE).mkdir(parents=True, exist_ok=True)
+    ShareWithOtherAccounts(ENVIRONMENT_BASE, 0o777)
+
+    def IsFresh():
+        return os.path.exists(envScript) and os.stat(envScript).st_mtime >= ReleaseTime(releaseArea)
+
+    # Whoever is already there just reads the cached script
+    if IsFresh():
+        return envScript
+
+    # Several loops may start at the same time on the node, only one
+    # of them gets to prepare the environment. flock works on a file
+    # opened read-only, e.g. a lock created by another account.
+    lockFile = envScript + ".lock"
+    lock = os.open(lockFile, os.O_RDONLY | os.O_CREAT, 0o666)
+    try:
+        ShareWithOtherAccounts(lockFile, 0o666)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if IsFresh():
+            return envScript
+
+        if not (releaseArea / "src").is_dir():
+            logging.info(f"Creating release area {releaseArea}...")
+            Path(releaseBase).mkdir(parents=True, exist_ok=True)
+            RunScram(["project", "-d", str(releaseBase), "CMSSW", cmsswVersion], releaseBase, scramArch)
+            if releaseBase == ENVIRONMENT_BASE:
+                ShareTree(releaseArea)
+
+        logging.info(f"Caching the runtime environment of {releaseArea}...")
+        runtime = RunScram(["runtime", "-sh"], str(releaseArea / "src"), scramArch)
+        tmpScript = f"{envScript}.{os.getpid()}.tmp"
+        with open(tmpScript, "w") as f:
+            f.write(f"# Cached 'scram runtime -sh' of {releaseArea}\n")
+            f.write(f"export SCRAM_ARCH={scramArch}\n")
+            f.write(runtime)
+        ShareWithOtherAccounts(tmpScript, 0o666)
+        # Jobs may be sourcing the old one right now, so we swap it atomically
+        os.replace(tmpScript, envScript)
+    finally:
+        os.close(lock)
+    return envScript
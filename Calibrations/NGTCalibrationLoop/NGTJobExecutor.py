@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Bounded job executor for the NGT calibration loop.
+#
+# Jobs are queued and only started while their threads fit in the slot budget
+# of the node (e.g. 8 slots for an 8-thread cmsRun). Finished children are
+# reaped with wait4, so that we record their exit code, wall time and max RSS
+# instead of forgetting about them.
+#
+# Each job may carry the deadline of its run (the end of the buffer window).
+# The executor learns from the finished jobs how long each kind of job of
+# each calibration takes, and from that the slack of every run: how long
+# before its deadline its queued jobs would be done. When the node is
+# saturated, the runs running out of slack go first, and the runs that are
+# projected to miss their deadline are reported as soon as we can tell.
+
+import heapq
+import json
+import logging
+import os
+import subprocess
+import time
+from collections import deque
+
+from NGTMetrics import METRICS
+
+jobWallSeconds = METRICS.Histogram("ngt_job_wall_seconds", "Wall time of the finished jobs, per kind of job.")
+jobQueueSeconds = METRICS.Histogram("ngt_job_queue_seconds", "Time the jobs waited for their slots, per kind of job.")
+jobsFinished = METRICS.Counter("ngt_jobs_finished_total", "Finished jobs, per kind of job and status (done or failed).")
+METRICS.Gauge("ngt_jobs_running", "Jobs running, per kind of job.")
+METRICS.Gauge("ngt_jobs_queued", "Jobs waiting for their slots, per kind of job.")
+METRICS.Gauge("ngt_slots_used", "Slots taken by the running jobs.")
+METRICS.Gauge("ngt_slots_total", "Slot budget of the job executor.")
+METRICS.Gauge("ngt_deadline_slack_seconds", "Projected time between the end of the jobs of a run and its deadline, per calibration and run.")
+
+# Under this much slack, the jobs of a run are urgent: when the node is
+# saturated, the urgent runs go first, the one with the least slack first
+urgentSlackInSeconds = 3600
+# What we expect a job to take, until we saw one of its kind finish
+defaultJobCostInSeconds = 600
+# How many of the last finished jobs of the report we learn the costs from
+costHistoryLength = 2000
+# A job waiting for more slots than are free lets the smaller jobs of the
+# other groups go ahead of it, but only for this long: then it keeps the
+# slots that free up until it fits
+backfillWindowInSeconds = 600
+
+
+def CostKey(group, kind):
+    # The jobs of a calibration (or pass) of the same kind cost about the
+    # same, whatever their run: the group is "<calibration>/<run>"
+    return (str(group).rsplit("/", 1)[0], kind)
+
+
+class Job(object):
+
+    def __init__(self, name, command, cwd, slots, stdout=None, stderr=None, onStart=None, onFinish=None, group=None, kind="job", deadline=None):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.slots = slots
+        # Paths for the job output, /dev/null if not given
+        self.stdout = stdout
+        self.stderr = stderr
+        self.onStart = onStart
+        self.onFinish = onFinish
+        # Jobs of the same group (e.g. the same run) share the node fairly
+        # with the other groups
+        self.group = group
+        # What the job does (e.g. step2, alca, harvest, upload), for the metrics
+        self.kind = kind
+        # When the run of the job must be done with (seconds since the epoch)
+        self.deadline = deadline
+        self.process = None
+        self.submitTime = time.time()
+        self.startTime = None
+        self.endTime = None
+        self.exitCode = None
+        self.maxRSSInKB = None
+
+    def WallTime(self):
+        if self.startTime is None:
+            return 0
+        return (self.endTime or time.time()) - self.startTime
+
+    def Summary(self):
+        return {
+            "name": self.name,
+            "cwd": self.cwd,
+            "slots": self.slots,
+            "group": self.group,
+            "kind": self.kind,
+            "deadline": self.deadline,
+            "submitTime": self.submitTime,
+            "startTime": self.startTime,
+            "endTime": self.endTime,
+            "queueTimeInSeconds": (self.startTime or time.time()) - self.submitTime,
+            "wallTimeInSeconds": self.WallTime(),
+            "exitCode": self.exitCode,
+            "maxRSSInKB": self.maxRSSInKB,
+        }
+
+
+class JobExecutor(object):
+
+    def __init__(self, totalSlots=None, reportFile=None):
+        self.totalSlots = totalSlots or os.cpu_count()
+        self.reportFile = reportFile
+        self.queuedJobs = deque()
+        self.runningJobs = []
+        # The jobs that could not even be started, reaped with the next poll
+        self.failedStarts = []
+        # When each group last got a job started, to take turns between groups
+        self.lastStartOfGroup = {}
+        # (calibration, kind) -> running average of the wall time of its jobs
+        self.jobCosts = {}
+        self.LoadCostHistory()
+        # The runs we reported as going to miss their deadline, and the
+        # projected slack of every run with a deadline
+        self.groupsAtRisk = set()
+        self.projectedSlack = {}
+        METRICS.AddCollector(self.Metrics)
+
+    def UsedSlots(self):
+        return sum(job.slots for job in self.runningJobs)
+
+    def FreeSlots(self):
+        return self.totalSlots - self.UsedSlots()
+
+    def HasJobs(self):
+        return bool(self.queuedJobs or self.runningJobs or self.failedStarts)
+
+    def GroupHasJobs(self, group, kind=None):
+        # Whether some jobs of the group (of that kind, if given) are still queued or running
+        return any(
+            job.group == group and kind in (None, job.kind)
+            for job in list(self.queuedJobs) + self.runningJobs + self.failedStarts
+        )
+
+    def Submit(self, name, command, cwd, slots=1, stdout=None, stderr=None, onStart=None, onFinish=None, group=None, kind="job", deadline=None):
+        job = Job(name, command, cwd, slots, stdout, stderr, onStart, onFinish, group, kind, deadline)
+        self.queuedJobs.append(job)
+        logging.info(
+            f"Queued job {name} ({slots} slots), {len(self.queuedJobs)} job(s) waiting"
+        )
+        self.StartQueuedJobs()
+        self.CheckDeadlines()
+        return job
+
+    def Poll(self):
+        # Reaps the finished jobs and starts the queued ones if they fit.
+        # Returns True if anything changed.
+        reaped = self.ReapJobs()
+        started = self.StartQueuedJobs()
+        if reaped or started:
+            self.CheckDeadlines()
+        # The jobs that failed to start are reaped right away
+        return bool(reaped or started or self.failedStarts)
+
+    # --- Job costs and deadlines ---
+
+    def LoadCostHistory(self):
+        # We start from what the jobs of the previous processes took
+        if not self.reportFile or not os.path.exists(self.reportFile):
+            return
+        with open(self.reportFile, "r") as f:
+            lines = deque(f, maxlen=costHistoryLength)
+        for line in lines:
+            try:
+                summary = json.loads(line)
+            except ValueError:
+                continue
+            if summary.get("exitCode") == 0 and "kind" in summary:
+                self.ObserveCost(CostKey(summary["group"], summary["kind"]), summary["wallTimeInSeconds"])
+
+    def ObserveCost(self, key, wallTimeInSeconds):
+        cost = self.jobCosts.get(key)
+        self.jobCosts[key] = wallTimeInSeconds if cost is None else 0.7 * cost + 0.3 * wallTimeInSeconds
+
+    def ExpectedCost(self, job):
+        return self.jobCosts.get(CostKey(job.group, job.kind), defaultJobCostInSeconds)
+
+    def GroupSlack(self, group, now):
+        # How long before its deadline the queued jobs of the group would be
+        # done, if they ran one after the other from now on. None without a deadline.
+        jobs = [job for job in self.queuedJobs if job.group == group]
+        deadlines = [job.deadline for job in jobs if job.deadline is not None]
+        if not deadlines:
+            return None
+        return min(deadlines) - now - sum(self.ExpectedCost(job) for job in jobs)
+
+    def Forecast(self, now=None):
+        # When the running and queued jobs of each group would be done, if
+        # the node ran the queue in order of slack from now on (each job
+        # takes the expected cost of its kind). Returns group -> time.
+        now = time.time() if now is None else now
+        releases = []
+        ends = {}
+        for job in self.runningJobs:
+            end = max(now, job.startTime + self.ExpectedCost(job))
+            heapq.heappush(releases, (end, job.slots))
+            ends[job.group] = max(ends.get(job.group, now), end)
+        freeSlots = self.FreeSlots()
+        slack = {}
+        for job in self.queuedJobs:
+            if job.group not in slack:
+                slack[job.group] = self.GroupSlack(job.group, now)
+        t = now
+        for job in sorted(
+            self.queuedJobs,
+            key=lambda j: (slack[j.group] is None, slack[j.group] or 0, j.submitTime),
+        ):
+            # A job bigger than the whole node runs alone
+            slots = min(job.slots, self.totalSlots)
+            while freeSlots < slots and releases:
+                release, releasedSlots = heapq.heappop(releases)
+                t = max(t, release)
+                freeSlots += releasedSlots
+            end = t + self.ExpectedCost(job)
+            freeSlots -= slots
+            heapq.heappush(releases, (end, slots))
+            ends[job.group] = max(ends.get(job.group, now), end)
+        return ends
+
+    def CheckDeadlines(self, now=None):
+        # Reports the runs that are projected to miss their deadline, once,
+        # and when they are back on track
+        now = time.time() if now is None else now
+        deadlines = {}
+        for job in list(self.queuedJobs) + self.runningJobs:
+            if job.deadline is not None:
+                deadlines[job.group] = min(job.deadline, deadlines.get(job.group, job.deadline))
+        ends = self.Forecast(now)
+        self.projectedSlack = {group: deadline - ends[group] for group, deadline in deadlines.items()}
+        for group, slack in self.projectedSlack.items():
+            if slack < 0 and group not in self.groupsAtRisk:
+                self.groupsAtRisk.add(group)
+                logging.warning(
+                    f"{group} will miss its deadline: its jobs are projected to end "
+                    f"{-slack / 60:.0f} min after it ({time.strftime('%H:%M:%S', time.localtime(deadlines[group]))})"
+                )
+            elif slack >= 0 and group in self.groupsAtRisk:
+                self.groupsAtRisk.discard(group)
+                logging.info(f"{group} is back on track, {slack / 60:.0f} min of slack")
+        # The runs that are done are not at risk any more
+        self.groupsAtRisk &= set(deadlines)
+
+    def NextJob(self, skippedGroups=()):
+        # Jobs are started in order within a group, but the group using the
+        # fewest slots goes first (or the one that waited longest, if even),
+        # so that a run with a long queue of jobs does not hold back the runs
+        # that started after it
+        slotsInUse = {}
+        for job in self.runningJobs:
+            slotsInUse[job.group] = slotsInUse.get(job.group, 0) + job.slots
+        firstOfGroup = {}
+        for job in self.queuedJobs:
+            if job.group not in skippedGroups:
+                firstOfGroup.setdefault(job.group, job)
+        if not firstOfGroup:
+            return None
+        # Unless the node is saturated and some runs are running out of time:
+        # then the run with the least slack goes first
+        if sum(job.slots for job in self.queuedJobs) > self.FreeSlots():
+            now = time.time()
+            slack = {group: self.GroupSlack(group, now) for group in firstOfGroup}
+            urgent = [
+                job for group, job in firstOfGroup.items()
+                if slack[group] is not None and slack[group] < urgentSlackInSeconds
+            ]
+            if urgent:
+                return min(urgent, key=lambda job: slack[job.group])
+        return min(
+            firstOfGroup.values(),
+            key=lambda job: (
+                slotsInUse.get(job.group, 0),
+                self.lastStartOfGroup.get(job.group, 0),
+                job.submitTime,
+            ),
+        )
+
+    def StartQueuedJobs(self):
+        started = []
+        skippedGroups = set()
+        while self.queuedJobs:
+            job = self.NextJob(skippedGroups)
+            if job is None:
+                break
+            # A job bigger than the whole node still runs, but alone
+            fits = job.slots <= self.FreeSlots() or not self.runningJobs
+            if not fits:
+                if time.time() - job.submitTime > backfillWindowInSeconds:
+                    break
+                # The rest of its group waits behind it, the other groups don't
+                skippedGroups.add(job.group)
+                continue
+            self.queuedJobs.remove(job)
+            if self.Start(job):
+                started.append(job)
+        return started
+
+    def Start(self, job):
+        # Returns False if the job could not be started (e.g. its directory
+        # is gone, or we are out of file descriptors): it then fails like a
+        # job that exits right away, so that the ledger and the FSMs hear of it
+        stdout = stderr = subprocess.DEVNULL
+        try:
+            if job.stdout:
+                stdout = open(job.stdout, "w")
+            if job.stderr:
+                stderr = open(job.stderr, "w")
+            job.process = subprocess.Popen(
+                job.command,
+                cwd=job.cwd,
+                stdout=stdout,
+                stderr=stderr,
+                start_new_session=True,  # same as setsid, but thread-safe
+                close_fds=True,
+            )
+        except OSError as e:
+            logging.error(f"Could not start job {job.name}: {e}")
+            job.startTime = job.endTime = time.time()
+            # Like a shell that could not run the command
+            job.exitCode = 127
+            self.failedStarts.append(job)
+            return False
+        finally:
+            for f in (stdout, stderr):
+                if f is not subprocess.DEVNULL:
+                    f.close()
+        job.startTime = time.time()
+        jobQueueSeconds.Observe(job.startTime - job.submitTime, kind=job.kind)
+        self.lastStartOfGroup[job.group] = job.startTime
+        self.runningJobs.append(job)
+        logging.info(
+            f"Started job {job.name} (pid {job.process.pid}), {self.UsedSlots()}/{self.totalSlots} slots in use"
+        )
+        if job.onStart is not None:
+            job.onStart(job)
+        return True
+
+    def ReapJobs(self):
+        reaped = []
+        while self.failedStarts:
+            job = self.failedStarts.pop(0)
+            self.Report(job)
+            reaped.append(job)
+            if job.onFinish is not None:
+                job.onFinish(job)
+        for job in list(self.runningJobs):
+            try:
+                pid, status, rusage = os.wait4(job.process.pid, os.WNOHANG)
+            except ChildProcessError:
+                # Somebody else reaped it, we don't know how it went
+                pid, status, rusage = job.process.pid, None, None
+            if pid == 0:
+                continue
+            job.endTime = time.time()
+            if status is not None:
+                job.exitCode = os.waitstatus_to_exitcode(status)
+                # ru_maxrss is in kB on Linux, and covers the children the job waited for
+                job.maxRSSInKB = rusage.ru_maxrss
+                job.process.returncode = job.exitCode
+            self.runningJobs.remove(job)
+            self.Report(job)
+            reaped.append(job)
+            if job.onFinish is not None:
+                job.onFinish(job)
+        return reaped
+
+    def Report(self, job):
+        summary = job.Summary()
+        if job.exitCode == 0:
+            self.ObserveCost(CostKey(job.group, job.kind), summary["wallTimeInSeconds"])
+        jobWallSeconds.Observe(summary["wallTimeInSeconds"], kind=job.kind)
+        jobsFinished.Inc(kind=job.kind, status="done" if job.exitCode == 0 else "failed")
+        if job.exitCode == 0:
+            logging.info(
+                f"Job {job.name} finished in {summary['wallTimeInSeconds']:.0f} s, max RSS {job.maxRSSInKB} kB"
+            )
+        else:
+            logging.warning(
+                f"Job {job.name} failed with exit code {job.exitCode} after {summary['wallTimeInSeconds']:.0f} s"
+            )
+        if self.reportFile:
+            with open(self.reportFile, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+
+    def Metrics(self):
+        running, queued = {}, {}
+        for job in list(self.runningJobs):
+            running[job.kind] = running.get(job.kind, 0) + 1
+        for job in list(self.queuedJobs):
+            queued[job.kind] = queued.get(job.kind, 0) + 1
+        samples = [("ngt_jobs_running", {"kind": k}, n) for k, n in running.items()]
+        samples += [("ngt_jobs_queued", {"kind": k}, n) for k, n in queued.items()]
+        samples.append(("ngt_slots_used", {}, self.UsedSlots()))
+        samples.append(("ngt_slots_total", {}, self.totalSlots))
+        for group, slack in list(self.projectedSlack.items()):
+            calibration, _, run = str(group).rpartition("/")
+            samples.append(("ngt_deadline_slack_seconds", {"calibration": calibration, "run": run}, slack))
+        return samples
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Lumisection inventory for the step 2 loop.
+#
+# Every file that appears on EOS is probed with "edmFileUtil --eventsInLumi"
+# exactly once. The probes run on a bounded thread pool, and the results
+# (run, LS, nEvents) are kept in a per-run JSON cache, keyed by the file path
+# and its size/mtime, so that a restarted loop does not open the files again.
+# The files that fail the probe are kept too, and only probed again once
+# their size/mtime changes.
+
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from NGTMetrics import METRICS
+
+XROOTD_PREFIX = "root://eoscms.cern.ch/"
+
+probeSeconds = METRICS.Histogram("ngt_edmfileutil_probe_seconds", "Latency of the edmFileUtil probes of the new files.")
+probeFailures = METRICS.Counter("ngt_edmfileutil_probe_failures_total", "edmFileUtil probes that failed.")
+
+# Example line of the edmFileUtil table: "        398348          187          2268"
+EVENTS_IN_LUMI_LINE = re.compile(r"^\s*(\d+)\s+(\d+)\s+(\d+)\s*$", re.MULTILINE)
+
+
+def edmFileUtilCommand(filename):
+    cmd = ["edmFileUtil", XROOTD_PREFIX + filename, "--eventsInLumi"]
+    output = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    return output
+
+
+def edmFileUtilLocalCommand(environmentScript):
+    # Probe for the files on the local disk (e.g. the step 2 outputs), run in
+    # the cached CMSSW environment of the jobs
+    def Probe(filename):
+        cmd = [
+            "bash", "-c",
+            f'source {environmentScript} && edmFileUtil "file:$0" --eventsInLumi',
+            filename,
+        ]
+        return subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+
+    return Probe
+
+
+def ParseEventsInLumi(stdout):
+    # Returns a list of (run, LS, nEvents) tuples
+    return [
+        (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        for m in EVENTS_IN_LUMI_LINE.finditer(stdout)
+    ]
+
+
+class LSInventory(object):
+
+    def __init__(self, cacheFile, maxWorkers=8, probe=edmFileUtilCommand):
+        self.cacheFile = cacheFile
+        self.maxWorkers = maxWorkers
+        self.probe = probe
+        self.lock = threading.Lock()
+        # path -> {"signature": [size, mtime], "good": bool, "lumis": [[run, LS, nEvents], ...]}
+        self.entries = {}
+        self.Load()
+
+    def Load(self):
+        if not self.cacheFile or not os.path.exists(self.cacheFile):
+            return
+        try:
+            with open(self.cacheFile, "r") as f:
+                self.entries = json.load(f)
+            logging.info(
+                f"Loaded {len(self.entries)} probed files from {self.cacheFile}"
+            )
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read inventory cache {self.cacheFile}: {e}")
+            self.entries = {}
+
+    def Save(self):
+        if not self.cacheFile:
+            return
+        # Write-then-rename, so that a crash never leaves a truncated cache behind
+        tmpFile = self.cacheFile + ".tmp"
+        with self.lock:
+            with open(tmpFile, "w") as f:
+                json.dump(self.entries, f)
+        os.replace(tmpFile, self.cacheFile)
+
+    def IsKnown(self, path, signature=None):
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        # If we don't know the size/mtime of the file, the path is enough
+        return signature is None or tuple(entry["signature"] or ()) == tuple(signature)
+
+    def ProbeOne(self, path, signature):
+        with probeSeconds.Time():
+            result = self.probe(path)
+        good = result.returncode == 0 and "ERR" not in result.stdout
+        if not good:
+            probeFailures.Inc()
+            logging.warning(f"\n Following file won't be processed(skipping): {path}")
+            # The failure is cached with the size/mtime of the file, so that
+            # it is only probed again once it changes. Without them, we can't
+            # tell, and we try again next time.
+            if signature is None:
+                return
+        lumis = ParseEventsInLumi(result.stdout) if good else []
+        with self.lock:
+            self.entries[path] = {
+                "signature": list(signature) if signature is not None else None,
+                "good": good,
+                "lumis": [list(lumi) for lumi in lumis],
+            }
+
+    def Update(self, files):
+        # files is either a list of paths, or a dict of path -> (size, mtime).
+        # Only the files we have never seen (or that changed) get probed.
+        if not isinstance(files, dict):
+            files = {path: None for path in files}
+        toProbe = {
+            path: signature
+            for path, signature in files.items()
+            if not self.IsKnown(path, signature)
+        }
+        if not toProbe:
+            return 0
+        logging.info(f"Probing {len(toProbe)} new files with edmFileUtil...")
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            futures = [
+                pool.submit(self.ProbeOne, path, signature)
+                for path, signature in toProbe.items()
+            ]
+            for future in futures:
+                future.result()
+        self.Save()
+        return len(toProbe)
+
+    def GoodFiles(self, files=None):
+        # The files we have probed successfully (restricted to "files", if given)
+        candidates = self.entries.keys() if files is None else files
+        return [p for p in candidates if p in self.entries and self.entries[p]["good"]]
+
+    def LumisForFiles(self, files):
+        # Returns the (run, LS, nEvents) table for a set of files
+        table = []
+        for path in files:
+            entry = self.entries.get(path)
+            if entry is not None:
+                table.extend(tuple(lumi) for lumi in entry["lumis"])
+        return table
+
+    def LSForFiles(self, files):
+        return {ls for _, ls, _ in self.LumisForFiles(files)}
+
+    def EventsForFiles(self, files):
+        return sum(nEvents for _, _, nEvents in self.LumisForFiles(files))
+
+    def MaxLS(self):
+        return max(self.LSForFiles(self.entries.keys()), default=0)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Persistent job ledger for the NGT calibration loop.
+#
+# The bookkeeping of every step (runs latched, files or LS processed, job
+# numbers, jobs queued or running) is written transactionally to a SQLite
+# database in WAL mode, shared by all the steps and calibrations running on
+# the node. A restarted loop reloads it and resumes where it stopped, instead
+# of reprocessing everything or latching onto old run directories.
+
+import json
+import os
+import sqlite3
+import time
+
+LEDGER_PATH = "/tmp/ngt/ngtLedger.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    step TEXT, calibration TEXT, run TEXT,
+    status TEXT, info TEXT, updated REAL,
+    PRIMARY KEY (step, calibration, run)
+);
+CREATE TABLE IF NOT EXISTS items (
+    step TEXT, calibration TEXT, run TEXT, kind TEXT, item TEXT,
+    PRIMARY KEY (step, calibration, run, kind, item)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    step TEXT, calibration TEXT, run TEXT, name TEXT, value INTEGER,
+    PRIMARY KEY (step, calibration, run, name)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    step TEXT, calibration TEXT, run TEXT, name TEXT,
+    status TEXT, info TEXT, updated REAL,
+    PRIMARY KEY (step, calibration, run, name)
+);
+"""
+
+
+def ShareFile(path, create=False):
+    # Makes the file writable by every account of the node (creating it
+    # first if asked to). Only its owner can: for the other accounts, the
+    # owner did it already.
+    if create:
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o666))
+    try:
+        os.chmod(path, 0o666)
+    except (FileNotFoundError, PermissionError):
+        pass
+
+
+class JobLedger(object):
+
+    # Without a step and a calibration, only the queries over the whole node
+    # (at the end) make sense, e.g. for the disk governor
+    def __init__(self, step=None, calibration=None, path=LEDGER_PATH):
+        self.step = step
+        self.calibration = calibration
+        self.path = path
+        # Step 2 (cmsusr) and steps 3/4 (sakura) share the ledger: like the
+        # run directories, it must be writable by every account. SQLite gives
+        # its -wal and -shm files the permissions of the database.
+        ShareFile(path, create=True)
+        # Several loops write to the same file, so we wait for each other
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        for suffix in ("-wal", "-shm"):
+            ShareFile(path + suffix)
+
+    def Key(self, run):
+        return (self.step, self.calibration, str(run))
+
+    # --- Runs ---
+
+    def OpenRun(self, run, info=None):
+        # Opening a run twice (e.g. when resuming it) keeps its first info
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO runs VALUES (?, ?, ?, 'active', ?, ?)",
+                (*self.Key(run), json.dumps(info or {}), time.time()),
+            )
+
+    def CloseRun(self, run):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE runs SET status='done', updated=? WHERE step=? AND calibration=? AND run=?",
+                (time.time(), *self.Key(run)),
+            )
+
+    def ActiveRun(self):
+        # Returns (run, info) of the run we were busy with, or None
+        row = self.conn.execute(
+            "SELECT run, info FROM runs WHERE step=? AND calibration=? AND status='active' "
+            "ORDER BY updated LIMIT 1",
+            (self.step, self.calibration),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def ActiveRuns(self):
+        rows = self.conn.execute(
+            "SELECT run, info FROM runs WHERE step=? AND calibration=? AND status='active' "
+            "ORDER BY updated",
+            (self.step, self.calibration),
+        ).fetchall()
+        return [(run, json.loads(info)) for run, info in rows]
+
+    def RunsDone(self):
+        rows = self.conn.execute(
+            "SELECT run FROM runs WHERE step=? AND calibration=? AND status='done'",
+            (self.step, self.calibration),
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def KnownRuns(self):
+        # The runs we ever latched, whether we are done with them or not
+        rows = self.conn.execute(
+            "SELECT run FROM runs WHERE step=? AND calibration=?",
+            (self.step, self.calibration),
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    # --- Processed items and counters ---
+
+    def Record(self, run, items=None, counters=None, jobs=None):
+        # items is a dict of kind -> iterable of items, counters a dict of
+        # name -> value and jobs a dict of name -> (status, info).
+        # Everything goes in one transaction.
+        key = self.Key(run)
+        with self.conn:
+            for name, (status, info) in (jobs or {}).items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (*key, name, status, json.dumps(info), time.time()),
+                )
+            for kind, values in (items or {}).items():
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO items VALUES (?, ?, ?, ?, ?)",
+                    [(*key, kind, str(value)) for value in values],
+                )
+            for name, value in (counters or {}).items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO counters VALUES (?, ?, ?, ?, ?)",
+                    (*key, name, int(value)),
+                )
+
+    def Items(self, run, kind):
+        rows = self.conn.execute(
+            "SELECT item FROM items WHERE step=? AND calibration=? AND run=? AND kind=?",
+            (*self.Key(run), kind),
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def Counter(self, run, name, default=0):
+        row = self.conn.execute(
+            "SELECT value FROM counters WHERE step=? AND calibration=? AND run=? AND name=?",
+            (*self.Key(run), name),
+        ).fetchone()
+        return default if row is None else row[0]
+
+    # --- Jobs ---
+
+    def RecordJob(self, run, name, status, info=None):
+        key = self.Key(run)
+        with self.conn:
+            if info is None:
+                self.conn.execute(
+                    "UPDATE jobs SET status=?, updated=? WHERE step=? AND calibration=? AND run=? AND name=?",
+                    (status, time.time(), *key, name),
+                )
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (*key, name, status, json.dumps(info), time.time()),
+                )
+
+    def Jobs(self, run, status):
+        rows = self.conn.execute(
+            "SELECT name, info FROM jobs WHERE step=? AND calibration=? AND run=? AND status=? "
+            "ORDER BY updated",
+            (*self.Key(run), status),
+        ).fetchall()
+        return [(name, json.loads(info)) for name, info in rows]
+
+    # --- The whole node ---
+
+    def RunStatuses(self, run):
+        # (step, calibration) -> status, of every loop that latched the run
+        rows = self.conn.execute(
+            "SELECT step, calibration, status FROM runs WHERE run=?", (str(run),)
+        ).fetchall()
+        return {(step, calibration): status for step, calibration, status in rows}
+
+    def RunJobs(self, run):
+        # (step, calibration, name, status, info) of every job of the run
+        rows = self.conn.execute(
+            "SELECT step, calibration, name, status, info FROM jobs WHERE run=? ORDER BY updated",
+            (str(run),),
+        ).fetchall()
+        return [(step, calibration, name, status, json.loads(info)) for step, calibration, name, status, info in rows]
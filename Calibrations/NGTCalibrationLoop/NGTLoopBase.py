@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# What the step 3 and step 4 loops of the NGT calibration loop have in common.
+#
+# Both follow the run directories that step 2 creates in /tmp/ngt: they pick
+# up the next run, are told about the witness files of the step before them
+# as they appear, and close the run once the step before them has written the
+# runEnd file of their calibration (or the time ran out). Only the jobs they prepare, and
+# the files they wait for, differ.
+
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+import yaml
+
+from NGTLedger import JobLedger
+from NGTMetrics import METRICS
+from NGTTrace import RunTracer, StateTracer
+from NGTWatchers import RunDirectoryLister
+
+NGT_BASE = "/tmp/ngt"
+# Step 3 writes the number of events of its inputs next to the outputs of
+# each ALCA job, for the statistics gate of step 4
+INPUT_EVENTS_FILE_NAME = "inputEvents.json"
+
+METRICS.Gauge("ngt_files_waiting", "Files of the step before waiting for a job, per step, calibration and run.")
+
+
+def RunEndFileName(calibration, step=2):
+    # Step 2 signals the end of a run separately for each calibration, and
+    # step 3 signals it to step 4 once its own last jobs are done
+    if step == 2:
+        return f"runEnd_{calibration}.log"
+    return f"runEnd_{calibration}_step{step}.log"
+
+
+def ReadCalibrationConfig(calibration):
+    with open(f"{NGT_BASE}/calibrationYAML/{calibration}.yaml", "r") as f:
+        return yaml.safe_load(f)
+
+
+def ReadNGTParameters():
+    with open(f"{NGT_BASE}/ngtParameters.jsn", "r") as f:
+        return json.load(f)
+
+
+class NGTLoopBase(object):
+
+    # The back and forth of the polling loop, that we don't trace
+    idleTransitions = ()
+    # The step whose end of the run we wait for
+    runEndStep = 2
+
+    def __init__(self, name, calibrationName, runLister=None):
+        # No anonymous FSMs in my watch!
+        self.name = name
+        self.calibration_name = calibrationName
+        print(f"We are processing {self.calibration_name}.")
+        # Our bookkeeping survives restarts in the job ledger
+        self.ledger = JobLedger(self.name, self.calibration_name)
+        self.setOfRunsProcessed = {"run" + run for run in self.ledger.RunsDone()}
+        # When we run next to other loops, the run directories are listed once for all
+        self.runLister = runLister if runLister is not None else RunDirectoryLister(NGT_BASE)
+        self.witnessWatcher = None
+        self.fileEventCallback = None
+        # The timing events of each run go to its trace
+        self.tracer = RunTracer(self.name, self.calibration_name)
+        self.stateTracer = StateTracer(self.tracer, self.idleTransitions)
+        METRICS.AddCollector(self.Metrics)
+
+    # We check if a new run appeared, e.g. /tmp/ngt/run386925
+    def NewRunAppeared(self):
+        print("Checking if a new run appeared")
+        newRuns = self.runLister.RunDirectories() - self.setOfRunsProcessed
+        # Thiago: rig to run on 398600
+        # newRuns = {p for p in newRuns if p.startswith("run398600")}
+
+        foundNewRuns = not (not newRuns)  # Is this pythonic?
+        if foundNewRuns:
+            print("New runs found!")
+            # What happens if we found more than one run?
+            # We figure that out later...
+            # Slice off the "run" substring at the beginning
+            self.runNumber = (self.GetNextRun(newRuns))[3:]
+            print(f"Run {self.runNumber} is available")
+        else:
+            print("No new runs...")
+
+        return foundNewRuns
+
+    # For now, we just take the earliest of the new runs,
+    # unless we were restarted in the middle of one
+    def GetNextRun(self, newRuns):
+        activeRun = self.ledger.ActiveRun()
+        if activeRun is not None and "run" + activeRun[0] in newRuns:
+            print(f"Resuming run {activeRun[0]} from the job ledger")
+            return "run" + activeRun[0]
+        return sorted(newRuns)[0]
+
+    def StartRun(self):
+        # Prepare the new run
+        self.workingDir = self.pathWhereFilesAppear + "/run" + self.runNumber
+        startTimeFilePath = Path(self.workingDir + "/runStart.log")
+        if startTimeFilePath.exists():
+            with open(startTimeFilePath, "r") as f:
+                runStartLine = f.readline()
+                self.startTime = datetime.fromisoformat(runStartLine)
+        else:
+            # Weird, how come we don't have a runStart.log?
+            # Fine, we set the start time to now
+            print("We didn't find a runStart.log file... setting run start to NOW")
+            self.startTime = datetime.now(timezone.utc)
+
+        print(f"Run {self.runNumber} detected, started at {self.startTime.isoformat()}")
+
+        # If we are resuming this run, we get back what we already did
+        self.ledger.OpenRun(self.runNumber)
+        self.setOfFilesProcessed = {
+            Path(p) for p in self.ledger.Items(self.runNumber, "file")
+        }
+        self.alcaJobNumber = self.ledger.Counter(self.runNumber, "alcaJobNumber")
+        if self.setOfFilesProcessed:
+            print(f"Resumed run {self.runNumber}: {len(self.setOfFilesProcessed)} files already processed")
+
+    def JobDirectory(self, kind, number):
+        # e.g. apJob003_EcalPedestals: all the calibrations share the run directory
+        return Path(f"{self.workingDir}/{kind}{number:03}_{self.calibration_name}")
+
+    def AnnounceNewFiles(self):
+        # Called from the watcher thread, so we only pass the news on
+        if self.fileEventCallback is not None:
+            self.fileEventCallback()
+
+    def RunIsNotComplete(self):
+        print("Is the run complete?")
+        runEndedFile = Path(self.workingDir) / RunEndFileName(self.calibration_name, self.runEndStep)
+        if runEndedFile.exists():
+            print("The run is complete!")
+        else:
+            print("Not yet...")
+        return not runEndedFile.exists()
+
+    def StillHaveTime(self):
+        now_utc = datetime.now(timezone.utc)
+        diff = now_utc - self.startTime
+        if diff.total_seconds() > self.timeoutInSeconds:
+            print("Time ran out!")
+            return False
+        else:
+            return True
+
+    def Deadline(self):
+        # When we must be done with the run, for the job executor
+        return self.startTime.timestamp() + self.timeoutInSeconds
+
+    def ExecutePrepareFiles(self):
+        print("I am PreparingFiles")
+        self.PrepareFilesForProcessing()
+
+    def ExecutePrepareFinalFiles(self):
+        print("I am PreparingFinalFiles")
+        self.PrepareFilesForProcessing()
+        # Since this is final files, they have to be enough!
+        self.preparedFinalFiles = True
+
+    def ThereAreFilesWaiting(self):
+        if self.waitingFiles:
+            print("++ There are Files waiting!")
+        else:
+            print("++ No Files waiting...")
+        return self.waitingFiles
+
+    def WePreparedFinalFiles(self):
+        return self.preparedFinalFiles
+
+    def ReadConfiguration(self):
+        # The YAML of our calibration and the release/GT of the node,
+        # read again every time we reset the machine
+        self.calib_config = ReadCalibrationConfig(self.calibration_name)
+        config = ReadNGTParameters()
+        self.scramArch = config["SCRAM_ARCH"]
+        self.cmsswVersion = config["CMSSW_VERSION"]
+        self.globalTag = config["GLOBAL_TAG"]
+
+    def TraceStateChange(self):
+        self.stateTracer.Changed(self.runNumber, self.state)
+
+    def Metrics(self):
+        if self.state == "NotRunning":
+            return []
+        labels = {"step": self.name, "calibration": self.calibration_name, "run": str(self.runNumber)}
+        return [("ngt_files_waiting", labels, len(self.setOfAvailableFiles - self.setOfFilesProcessed))]
+
+    def StopWatchingFiles(self):
+        if self.witnessWatcher is not None:
+            self.witnessWatcher.Stop()
+            self.witnessWatcher = None
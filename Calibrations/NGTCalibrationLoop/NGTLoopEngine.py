@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# The whole NGT calibration loop in a single process.
+#
+# Instead of one process per step and per calibration, the engine runs steps
+# 2, 3 and 4 of every calibration declared in calibrationYAML/*.yaml in the
+# same event-driven scheduler. They all share one OMS client, one job executor
+# (so that the slot budget of the node covers every cmsRun we start) and one
+# lister of the run directories. The loops are the ones of NGTLoopStep2/3/4.py,
+# which can still be run on their own.
+
+import argparse
+import logging
+from pathlib import Path
+
+import NGTLoopStep2
+import NGTLoopStep3
+import NGTLoopStep4
+from NGTDiskGovernor import DiskGovernor, minFreeInGB, runQuotaInGB, totalQuotaInGB
+from NGTJobExecutor import JobExecutor
+from NGTLoopBase import NGT_BASE
+from NGTMetrics import StartMetricsServer
+from NGTOMSClient import OMSClient
+from NGTScheduler import EventScheduler
+from NGTWatchers import RunDirectoryLister
+
+# How often we look after the jobs of all the loops
+jobPollIntervalInSeconds = 5
+# How often the disk governor cleans up and measures the run directories
+diskPollIntervalInSeconds = 30
+
+
+def DeclaredCalibrations(directory=f"{NGT_BASE}/calibrationYAML"):
+    # Every YAML file in the directory is a calibration to run
+    return sorted(p.stem for p in Path(directory).glob("*.yaml"))
+
+
+class NGTLoopEngine(object):
+
+    def __init__(self, calibrations, steps=(2, 3, 4), omsUrl=None, slots=None, maxRuns=3, runQuotaInGB=runQuotaInGB, totalQuotaInGB=totalQuotaInGB, minFreeInGB=minFreeInGB):
+        self.scheduler = EventScheduler()
+        self.omsClient = OMSClient(url=omsUrl) if omsUrl else OMSClient()
+        self.jobExecutor = JobExecutor(
+            totalSlots=slots, reportFile=f"{NGT_BASE}/NGTLoopEngine_jobs.jsonl"
+        )
+        self.runLister = RunDirectoryLister(NGT_BASE)
+        # One disk governor cleans up after all the loops, and holds back step 2
+        self.diskGovernor = DiskGovernor(
+            runQuotaInGB=runQuotaInGB, totalQuotaInGB=totalQuotaInGB, minFreeInGB=minFreeInGB
+        )
+        # (calibration, step) -> the loop(s) of that step
+        self.loops = {}
+
+        # The calibrations that read the same files share their step 2 pass
+        if 2 in steps:
+            for calibrationNames in NGTLoopStep2.GroupCalibrations(calibrations):
+                logging.info(f"One step 2 pass for {', '.join(calibrationNames)}")
+                runs = NGTLoopStep2.NGTLoopStep2Runs(
+                    "Step2", calibrationNames, maxRuns, self.omsClient, self.jobExecutor, self.diskGovernor
+                )
+                groupName = runs.idleLoop.calibration_name
+                NGTLoopStep2.AddSources(
+                    self.scheduler, runs, prefix=f"{groupName}/Step2/", pollJobs=False
+                )
+                self.loops[(groupName, 2)] = runs
+
+        for calibration in calibrations:
+            logging.info(f"Setting up steps {[s for s in steps if s != 2]} of {calibration}")
+            # The source names get the calibration and the step, since the
+            # file watchers wake up their loop by name
+            if 3 in steps:
+                loop = NGTLoopStep3.NGTLoopStep3(
+                    "Step3", calibration, jobExecutor=self.jobExecutor, runLister=self.runLister
+                )
+                NGTLoopStep3.AddSources(
+                    self.scheduler, loop, prefix=f"{calibration}/Step3/", pollJobs=False
+                )
+                self.loops[(calibration, 3)] = loop
+            if 4 in steps:
+                loop = NGTLoopStep4.NGTLoopStep4(
+                    "Step4", calibration, jobExecutor=self.jobExecutor, runLister=self.runLister
+                )
+                NGTLoopStep4.AddSources(
+                    self.scheduler, loop, prefix=f"{calibration}/Step4/", pollJobs=False
+                )
+                self.loops[(calibration, 4)] = loop
+
+        # One poll for all the jobs, whichever loop started them
+        self.scheduler.AddSource(
+            "PollJobs",
+            self.jobExecutor.Poll,
+            jobPollIntervalInSeconds,
+            when=self.jobExecutor.HasJobs,
+        )
+        self.scheduler.AddSource("DiskGovernor", self.diskGovernor.Poll, diskPollIntervalInSeconds)
+
+    def Run(self):
+        logging.info(
+            f"Running {len(self.loops)} loop(s) with {self.jobExecutor.totalSlots} slots"
+        )
+        self.scheduler.Run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs steps 2, 3 and 4 of all our calibration workflows in a single process.')
+    parser.add_argument('-c', '--calibrations', type=str, nargs='+', help='Calibration workflows to process (default: all those in /tmp/ngt/calibrationYAML).', default=None)
+    parser.add_argument('--steps', type=int, nargs='+', help='Steps to run (default: 2 3 4).', default=[2, 3, 4], choices=[2, 3, 4])
+    parser.add_argument('--slots', type=int, help='Number of threads our jobs may use at once on this node (default: all cores).', default=None)
+    parser.add_argument('--maxRuns', type=int, help='Number of runs step 2 processes at the same time, per pass over the RAW (default: 3).', default=3)
+    parser.add_argument('--omsUrl', type=str, help='OMS aggregation API to query (e.g. a local stub server for testing).', default='https://cmsoms.cms/agg/api')
+    parser.add_argument('--metricsPort', type=int, help='Serve the metrics of all the loops on http://localhost:<port>/metrics (default: 9400, 0 for no endpoint).', default=9400)
+    NGTLoopStep2.AddDiskArguments(parser)
+    args = parser.parse_args()
+
+    NGTLoopStep2.SetupLogging("NGTLoopEngine")
+    calibrations = args.calibrations or DeclaredCalibrations()
+    if not calibrations:
+        parser.error(f"No calibration declared in {NGT_BASE}/calibrationYAML")
+    engine = NGTLoopEngine(
+        calibrations,
+        steps=args.steps,
+        omsUrl=args.omsUrl,
+        slots=args.slots,
+        maxRuns=args.maxRuns,
+        runQuotaInGB=args.runQuotaGB,
+        totalQuotaInGB=args.totalQuotaGB,
+        minFreeInGB=args.minFreeGB,
+    )
+    StartMetricsServer(args.metricsPort)
+    engine.Run()
+
+
+if __name__ == "__main__":
+    main()
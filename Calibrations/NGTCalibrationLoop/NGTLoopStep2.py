@@ -1,29 +1,96 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
+import copy
 import json
 import logging
 import os
 import random
 import re
 import string
-import subprocess
 import sys
 import time
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-import yaml
 
 from transitions import Machine, State
-from omsapi import OMSAPI
+
+from NGTBatching import BatchPolicy, StreamingPolicy
+from NGTCompleteness import CompletenessTracker, Tier0LatencyHistory
+from NGTConfigTemplates import TemplateFileName, WriteOverrideConfig, WriteTemplateGeneration
+from NGTDiskGovernor import DiskGovernor, minFreeInGB, runQuotaInGB, totalQuotaInGB
+from NGTEnvironment import PrepareEnvironment
+from NGTJobExecutor import JobExecutor
+from NGTLSInventory import LSInventory, edmFileUtilCommand
+from NGTLedger import JobLedger
+from NGTLoopBase import NGT_BASE, ReadCalibrationConfig, RunEndFileName
+from NGTMetrics import METRICS, StartMetricsServer
+from NGTOMSClient import OMSClient, OMSError
+from NGTScheduler import EventScheduler
+from NGTTrace import RunTracer, StateTracer
+from NGTWatchers import XRootDDirectoryWatcher
 
 CURRENT_RUN = ""
 LAST_LS = None
 
-import argparse
-parser = argparse.ArgumentParser(description='Runs step2 of our calibration loop of a given calibration workflow.')
-parser.add_argument('-c', '--calibration', type=str, help='Calibration workflow to process: e.g. SiStripBad or EcalPedestals.', required=True, choices=['SiStripBad', 'EcalPedestals'])
-args = parser.parse_args()
+# Calibrations can share a step 2 pass if they read the same files and agree
+# on these, besides the non-ALCAPRODUCER part of their step
+SHARED_PASS_SETTINGS = ("scenario", "datatier", "eventcontent", "process", "era", "python_config_mods")
+
+METRICS.Gauge("ngt_step2_runs_active", "Runs step 2 is processing, per pass.")
+METRICS.Gauge("ngt_step2_files_waiting", "Files on EOS waiting for a step 2 job, per pass and run.")
+METRICS.Gauge("ngt_step2_ls_waiting", "LS in the files waiting for a step 2 job, per pass and run.")
+METRICS.Gauge("ngt_step2_ls_coverage", "Fraction of the LS of the run (according to OMS) found on EOS, per pass and run.")
+METRICS.Gauge("ngt_step2_ls_missing", "LS of the run (according to OMS) not found on EOS yet, per pass and run.")
+
+
+def SplitStep(step):
+    # "RAW2DIGI,RECO,ALCAPRODUCER:A+B" -> ("RAW2DIGI,RECO", ["A", "B"])
+    reco, producers = [], []
+    for part in step.split(","):
+        if part.startswith("ALCAPRODUCER:"):
+            producers += part[len("ALCAPRODUCER:"):].split("+")
+        else:
+            reco.append(part)
+    return ",".join(reco), producers
+
+
+def PassKey(config):
+    conf = config["step_2_config"]
+    settings = tuple(repr(conf.get(key)) for key in SHARED_PASS_SETTINGS)
+    return (config.get("file_in_path"), SplitStep(conf["step"])[0]) + settings
+
+
+def GroupCalibrations(calibrationNames):
+    # The calibrations that can share one pass over the RAW go together,
+    # in the order they were given
+    groups = {}
+    for name in calibrationNames:
+        groups.setdefault(PassKey(ReadCalibrationConfig(name)), []).append(name)
+    return list(groups.values())
+
+
+def CombinedConfig(configs):
+    # The configuration of a pass shared by several calibrations: the first
+    # one gives the reconstruction, the file path and the batching, and the
+    # pass runs the union of the ALCAPRODUCER sequences of all of them
+    combined = copy.deepcopy(configs[0])
+    if len(configs) == 1:
+        return combined
+    conf = combined["step_2_config"]
+    producers = []
+    for config in configs:
+        for producer in SplitStep(config["step_2_config"]["step"])[1]:
+            if producer not in producers:
+                producers.append(producer)
+    conf["step"] = f"{SplitStep(conf['step'])[0]},ALCAPRODUCER:{'+'.join(producers)}"
+    conf["nThreads"] = max(c["step_2_config"].get("nThreads", 8) for c in configs)
+    conf["nStreams"] = max(c["step_2_config"].get("nStreams", 8) for c in configs)
+    conf["output_filename_affix"] = "".join(
+        c["step_2_config"]["output_filename_affix"] for c in configs
+    )
+    return combined
 
 class NGTLoopStep2(object):
 
@@ -47,9 +114,49 @@ class NGTLoopStep2(object):
         p.mkdir(parents=True, exist_ok=True)
         os.chmod(p, 0o777)
         self.workingDir = str(p)
+        # The other FSMs must not latch onto our run
+        self.runsInProgress.add(str(runNumber))
         # We take the real run start time to write it in the runStart.log
         with open(self.workingDir + "/runStart.log", "w") as f:
             f.write(self.runStartTime.isoformat())
+        # Every file of this run is probed with edmFileUtil only once,
+        # the results are cached next to the run products
+        self.lsInventory = LSInventory(
+            f"{self.workingDir}/lsInventory_{self.calibration_name}.json",
+            maxWorkers=self.maxProbeWorkers,
+        )
+        # Which LS of the run are on EOS, to know when the run is complete
+        self.completeness = CompletenessTracker.FromConfig(
+            self.calib_config["step_2_config"].get("completeness"),
+            self.runStartTime.timestamp(),
+            history=self.tier0Latency,
+        )
+        # We only relist the EOS directory when it is due, and only
+        # the files that newly appeared are handed to the inventory
+        self.directoryWatcher = XRootDDirectoryWatcher(
+            self.pathWhereFilesAppear, maxInterval=self.maxListingIntervalInSeconds
+        )
+        # The ledger remembers the run, so that a restarted loop can resume it.
+        # If we are resuming, we get back what we already did.
+        self.ledger.OpenRun(
+            runNumber,
+            {
+                "runStartTime": self.runStartTime.isoformat(),
+                "pathWhereFilesAppear": self.pathWhereFilesAppear,
+            },
+        )
+        self.setOfLSProcessed = self.ledger.Items(runNumber, "file")
+        self.setOfExpectedOutputs = self.ledger.Items(runNumber, "output")
+        # Jobs that were still waiting for a slot when we stopped never ran
+        for jobName, jobInfo in self.ledger.Jobs(runNumber, "queued"):
+            logging.info(f"Resubmitting job {jobName} from the job ledger")
+            self.SubmitJob(
+                jobName, jobInfo["command"], jobInfo["slots"], jobInfo.get("events", 0), jobInfo.get("trace")
+            )
+        if self.setOfLSProcessed:
+            logging.info(
+                f"Resumed run {runNumber}: {len(self.setOfLSProcessed)} files already processed"
+            )
 
     def AnnounceWaitingForLS(self):
         logging.info("I am WaitingForLS...")
@@ -58,31 +165,18 @@ class NGTLoopStep2(object):
     #    logging.info("The run stopped...")
 
     def LastLSRunNumber(self, runnum):
-        omsapi = OMSAPI("https://cmsoms.cms/agg/api", "v1", cert_verify=False)
-        q = omsapi.query("runs")
-        q.filter("run_number", runnum)
+        # Usually served from the record DAQIsRunning has just fetched.
+        # None when OMS can't tell us: we don't know how long the run is
         try:
-            response = q.data().json()
-        except Exception as e:
-            logging.warning(f"OMS query for run {runnum} failed. Returning LS 0.")
-            return 0
-        run_info = response["data"][0]["attributes"]
+            run_info = self.omsClient.GetRun(runnum)
+        except OMSError as e:
+            logging.warning(f"OMS query for run {runnum} failed: {e}")
+            return None
+        if run_info is None:
+            logging.warning(f"OMS does not know run {runnum}")
+            return None
         last_ls = run_info.get("last_lumisection_number")
-        return int(last_ls)
-
-    def LSavailable(self):
-        availableFiles = self.GetListOfAvailableFiles()
-        ls_numbers = set()
-        for file_path in availableFiles:
-            result = self.edmFileUtilCommand(file_path)
-            for match in re.finditer(
-                r"^\s*\d+\s+(\d+)\s+", result.stdout, re.MULTILINE
-            ):
-                ls_numbers.add(int(match.group(1)))
-        max_ls = max(
-            ls_numbers, default=0
-        )  # default to 0 bc if there are none it will crash this function
-        return max_ls
+        return int(last_ls) if last_ls is not None else None
 
     def WeStillHaveTime(self):
         now_utc = datetime.now(timezone.utc)
@@ -96,6 +190,11 @@ class NGTLoopStep2(object):
             logging.info("Time is up!")
         return delta.total_seconds() < (self.maxLatchTimeInHours * 60 * 60)
 
+    def Deadline(self):
+        # The RAW of the run stays in the buffer for maxLatchTimeInHours:
+        # the job executor gives priority to the runs running out of time
+        return self.runStartTime.timestamp() + self.maxLatchTimeInHours * 60 * 60
+
     def CalFuProcessed(self, run_number):
 
         # this whole omsapi block does not need to be repeated so often lol
@@ -113,10 +212,22 @@ class NGTLoopStep2(object):
                 f"We will spend {self.maxLatchTimeInHours-hours_elapsed:.1f} more hours in this run before proceeding to the next one."
             )
 
-        ### Thiago: what does this do?
+        # The tracker already knows the LS of every file we listed in
+        # CheckLSForProcessing, nothing gets listed or probed again here
         LastLS_OMS = self.LastLSRunNumber(run_number)
-        LastLS_available = self.LSavailable()
-        return abs(int(LastLS_OMS) - int(LastLS_available)) <= int(LastLS_OMS * 0.04)
+        if LastLS_OMS is None:
+            # An OMS outage must not end the run early, the latch time still applies
+            logging.info(f"The last LS of run {run_number} is unknown, waiting for OMS")
+            return False
+        complete = self.completeness.IsComplete(int(LastLS_OMS))
+        if complete:
+            self.tracer.Emit(
+                run_number, "runComplete",
+                lastLS=int(LastLS_OMS),
+                coverage=self.completeness.Coverage(),
+                missing=self.completeness.MissingLS(),
+            )
+        return complete
 
     def RunHasEndedAndFilesAreReady(self):
         if self.DAQIsRunning():
@@ -140,7 +251,6 @@ class NGTLoopStep2(object):
     def DAQIsRunning(self):
         global CURRENT_RUN, LAST_LS
         logging.info("Checking our run status via OMS...")
-        omsapi = OMSAPI("https://cmsoms.cms/agg/api", "v1", cert_verify=False)
 
         # ---
         # --- STATE 2: LATCHED. Check status of *our* run.
@@ -153,24 +263,23 @@ class NGTLoopStep2(object):
 
         # Query specifically for our run
         try:  # due to oms specific error recently
-            q_our_run = omsapi.query("runs")
-            q_our_run.filter("run_number", self.runNumber)
-            response_our_run = q_our_run.data().json()
-        except Exception as e:
+            our_run_info = self.omsClient.GetRun(self.runNumber)
+        except OMSError as e:
             logging.error(f"Error querying OMS API: {e}")
             return False
 
-        if "data" not in response_our_run or not response_our_run["data"]:
+        if our_run_info is None:
             logging.warning(
                 f"Could not find info for *our* run {self.runNumber}. Assuming it ended."
             )
             return False  # Treat our run as finished
 
-        our_run_info = response_our_run["data"][0]["attributes"]
-
         # Update the global LAST_LS to our run's last LS
         LAST_LS = our_run_info.get("last_lumisection_number")
         is_running = our_run_info.get("end_time") is None
+        # How far behind EOS is, for the metrics
+        if self.completeness is not None and LAST_LS is not None:
+            self.completeness.SetLastLS(int(LAST_LS))
 
         logging.info(
             f"Our run {self.runNumber}: Last LS is {LAST_LS}. Running: {is_running}"
@@ -188,27 +297,39 @@ class NGTLoopStep2(object):
         # ---
         # --- STATE 1: NOT LATCHED. Find the LATEST PROTONS run.
         # ---
-        logging.info("Currently NotRunning. Looking for the most recent PROTONS run...")
-        omsapi = OMSAPI("https://cmsoms.cms/agg/api", "v1", cert_verify=False)
-        q = omsapi.query("runs")
+        # If we were restarted in the middle of a run, we resume it first
+        # (unless another FSM has resumed it already)
+        for run_number, info in self.ledger.ActiveRuns():
+            if run_number in self.runsInProgress:
+                continue
+            logging.info(f"Resuming run {run_number} from the job ledger")
+            self.runNumber = int(run_number)
+            self.runStartTime = datetime.fromisoformat(info["runStartTime"])
+            self.pathWhereFilesAppear = info["pathWhereFilesAppear"]
+            return True
 
-        # --- THIS IS THE NEW, MORE ROBUST FILTER ---
-        q.filter("fill_type_runtime", "PROTONS")
-        q.filter("l1_hlt_mode", "collisions2025")
-        # --- END NEW FILTER ---
+        logging.info("Currently NotRunning. Looking for the most recent PROTONS run...")
 
         # Sort by run number and get the top 50
-        q.sort("run_number", asc=False).paginate(page=1, per_page=50)
-        response = q.data().json()
+        try:
+            candidateRuns = self.omsClient.GetRuns(
+                # --- THIS IS THE NEW, MORE ROBUST FILTER ---
+                {"fill_type_runtime": "PROTONS", "l1_hlt_mode": "collisions2025"},
+                perPage=50,
+            )
+        except OMSError as e:
+            logging.error(f"Error querying OMS API: {e}")
+            return False
 
-        if "data" not in response or not response["data"]:
+        if not candidateRuns:
             logging.info("No PROTONS *collisions* runs found in OMS. Waiting.")
             return False  # Stay in NotRunning
 
         # We loop over the runs, starting from the EARLIEST!
         now_utc = datetime.now(timezone.utc)
+        knownRuns = self.ledger.KnownRuns()
         newRunAvailable = False
-        for candidateRun in reversed(response["data"]):
+        for candidateRun in reversed(candidateRuns):
             run_info = candidateRun["attributes"]
             run_number = run_info.get("run_number")
             run_type = run_info.get("l1_hlt_mode")
@@ -221,7 +342,12 @@ class NGTLoopStep2(object):
             isRecentRun = int(delta.total_seconds()) < int(
                 self.maxLatchTimeInHours * 60 * 60
             )
-            runDirMissing = not (Path(f"/tmp/ngt/run{run_number}").exists())
+            # The run directory is shared by all the calibrations, so it is
+            # the ledger that tells whether we had this run already
+            runDirMissing = str(run_number) not in knownRuns
+            # Runs that another FSM is processing are not for us either
+            if str(run_number) in self.runsInProgress:
+                continue
             # We want a run that
             # 1. (is not running AND is long enough AND has started less than 8 hours ago)
             # OR (2. is still running AND has started less than 8 hours ago)
@@ -297,12 +423,7 @@ class NGTLoopStep2(object):
         return True
 
     def edmFileUtilCommand(self, filename):
-        # for now it only works with one file, rewrite to also give out for several files..!
-        cmd = ["edmFileUtil", "root://eoscms.cern.ch/" + filename, "--eventsInLumi"]
-        output = subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        )
-        return output
+        return edmFileUtilCommand(filename)
 
     def GetRunNumber(self):
         availableFiles = self.GetListOfAvailableFiles()
@@ -339,10 +460,61 @@ class NGTLoopStep2(object):
         self.waitingLS = len(self.setOfLSToProcess) > 0
         logging.info("New LSs to process:")
         logging.info(self.setOfLSToProcess)
-        if len(self.setOfLSToProcess) >= self.minimumLS:
-            self.enoughLS = True
-        else:
-            self.enoughLS = False
+        # We remember when we first saw each file, for the latency deadline
+        # and for the trace of the run
+        now = time.time()
+        readyFiles = self.directoryWatcher.ReadyFiles()
+        for path in self.setOfLSToProcess:
+            if path in self.fileFirstSeen:
+                continue
+            self.fileFirstSeen[path] = now
+            signature = readyFiles.get(path)
+            self.tracer.Emit(
+                self.runNumber, "fileSeen",
+                file=str(path),
+                ls=sorted(self.lsInventory.LSForFiles([path])),
+                events=self.lsInventory.EventsForFiles([path]),
+                mtime=signature[1] if signature else None,
+            )
+        # The completeness tracker only looks at the files it has not seen yet
+        self.completeness.Add(
+            listOfLSFilesAvailable,
+            self.lsInventory,
+            lambda path: readyFiles[path][1] if readyFiles.get(path) else self.fileFirstSeen.get(path),
+            now=now,
+        )
+        # We have enough LS when the batching policy can form at least one job
+        self.batchesToProcess = self.FormJobs(now=now)
+        self.enoughLS = len(self.batchesToProcess) > 0
+
+    def FormJobs(self, final=False, now=None):
+        # Each job is a list of blocks, each block a list of files that gets
+        # its own output (and witness file). Without the streaming mode, a
+        # job is a single block: the batch formed by the batching policy.
+        if self.streamingPolicy is not None:
+            pendingFiles = [
+                (path, self.lsInventory.LSForFiles([path]), firstSeen)
+                for path, _, firstSeen in self.PendingFiles()
+            ]
+            return self.streamingPolicy.FormJobs(
+                pendingFiles, self.completeness.presentLS, final=final, now=now
+            )
+        return [[batch] for batch in self.batchPolicy.FormBatches(self.PendingFiles(), final=final, now=now)]
+
+    def PendingFiles(self):
+        # The files waiting for a job, in LS order, with their number of
+        # events (from the inventory) and the time we first saw them
+        def FirstLS(path):
+            return min(self.lsInventory.LSForFiles([path]), default=0)
+
+        return [
+            (
+                path,
+                self.lsInventory.EventsForFiles([path]),
+                self.fileFirstSeen.get(path, time.time()),
+            )
+            for path in sorted(self.setOfLSToProcess, key=lambda p: (FirstLS(p), str(p)))
+        ]
 
     # This function only looks at a given path and lists all available
     # files of the form "run*_ls*.root". Could be made smarter if needed
@@ -353,24 +525,22 @@ class NGTLoopStep2(object):
             logging.critical("pathWhereFilesAppear is not set. Cannot list files.")
             return []
 
-        cmd = f"xrdfs {prefix} ls {self.pathWhereFilesAppear}"
         ## Thiago: rig to get only one file
         # if(self.rigMe == True):
         # cmd = "xrdfs root://eoscms.cern.ch/ ls /eos/cms/tier0/store/data/Run2025G/TestEnablesEcalHcal/RAW/Express-v1/000/398/600/00000/e03573bc-978e-4655-909a-15e45ab59a98.root"
-        all_files = (
-            subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            .stdout.strip()
-            .splitlines()
-        )
-        final_list = []
-        for file in all_files:
-            output = self.edmFileUtilCommand(file)
-            if "ERR" in output.stdout:
-                logging.warning(
-                    f"\n Following file won't be processed(skipping): {file}"
-                )
-            else:
-                final_list.append(file)
+        # The watcher relists the directory only when it is due (it backs off
+        # while nothing changes), and keeps the files it has already seen
+        if self.directoryWatcher.path != self.pathWhereFilesAppear:
+            self.directoryWatcher = XRootDDirectoryWatcher(
+                self.pathWhereFilesAppear, prefix=prefix,
+                maxInterval=self.maxListingIntervalInSeconds,
+            )
+        self.directoryWatcher.Poll()
+        all_files = self.directoryWatcher.ReadyFiles()
+        # The inventory probes the new files in parallel, and skips the
+        # ones it has already seen. Unreadable files are not returned.
+        self.lsInventory.Update(all_files)
+        final_list = self.lsInventory.GoodFiles(all_files)
         return final_list
 
     def ExecutePrepareLS(self):
@@ -379,153 +549,243 @@ class NGTLoopStep2(object):
 
     def ExecutePrepareFinalLS(self):
         logging.info("I am PreparingFinalLS")
-        self.PrepareLSForProcessing()
+        self.PrepareLSForProcessing(final=True)
         self.preparedFinalLS = True
 
-    def PrepareLSForProcessing(self):
+    def PrepareLSForProcessing(self, final=False):
         logging.info("I am in PrepareLSForProcessing...")
+        # This is the last go at this run: whatever is pending gets a job,
+        # however small the batch is
+        if final:
+            self.batchesToProcess = self.FormJobs(final=True)
         logging.info("Will use the following LS:")
-        logging.info(self.setOfLSToProcess)
+        for blocks in self.batchesToProcess:
+            logging.info(blocks)
 
     def PrepareExpressJobs(self):
         logging.info("I am in PrepareExpressjobs...")
-        # We may arrive here without a self.setOfLSToProcess if
-        # the run started and ended without producing LS.
-        # In that case, nothing to do - just copy it to setOfExpressLS
-        if not self.setOfLSToProcess:
-            self.setOfExpressLS = self.setOfLSToProcess
-            return
-
-        # Thiago: new logic to avoid gigantic cmsRun jobs
-        # if(len(self.setOfLSToProcess) > self.maximumFilesPerJob):
-        #   as_a_list = sorted(self.setOfLSToProcess)
-        #   topTargets = as_a_list[0:self.maximumFilesPerJob]
-        #   self.setOfExpressLS = set(topTargets)
-        # else:
-        #   self.setOfExpressLS = self.setOfLSToProcess
-
-        self.setOfExpressLS = self.setOfLSToProcess
-        # Extract all LS numbers (as integers)
-        str_paths = {"root://eoscms.cern.ch/" + str(p) for p in self.setOfExpressLS}
-
-        ls_numbers = set()  # use a set to avoid duplicates
-
-        for file_path in str_paths:
-            logging.info(file_path)
-            cmd = ["edmFileUtil", f"{file_path}", "--eventsInLumi"]
-
-            result = subprocess.run(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            )
+        # We may arrive here without batches if the run started and ended
+        # without producing LS. In that case, nothing to do.
+        # Each batch formed by the batching policy (or each group of blocks,
+        # in the streaming mode) becomes one job.
+        self.preparedJobs = []
+        self.setOfExpressLS = set()
+        for blocks in self.batchesToProcess:
+            self.preparedJobs.append(self.PrepareExpressJob(blocks))
+            for block in blocks:
+                self.setOfExpressLS.update(block)
+        self.batchesToProcess = []
+        self.setOfLSToProcess = set()
 
-            if result.returncode != 0:
-                logging.warning(f"edmFileUtil failed for {file_path}:\n{result.stderr}")
-                continue
+    def PrepareExpressJob(self, blocks):
+        # blocks is a list of lists of files: each block gets its own cmsRun,
+        # output and witness file, one after the other, so that step 3 can
+        # pick up the first blocks while the job goes on with the next ones
+        step_args = self.calib_config["step_2_config"]
+        output_affix = step_args["output_filename_affix"]
 
-            # Find lumisection numbers -- second column in output table
-            # Example line: "        398348          187          2268"
-            for match in re.finditer(
-                r"^\s*\d+\s+(\d+)\s+", result.stdout, re.MULTILINE
-            ):
-                ls_numbers.add(int(match.group(1)))
+        tempAffix = "".join(random.choices(string.ascii_letters + string.digits, k=10))
+        tempScriptName = "cmsDriver_" + tempAffix + ".sh"
+        # The cmsDriver configuration only depends on the calibration, the run,
+        # the release and the GT: it is generated once and reused by every job
+        templateFileName = TemplateFileName(
+            self.runNumber, output_affix, self.cmsswVersion, self.globalTag
+        )
+        files = [path for block in blocks for path in block]
+        expectedOutputs = []
 
-        # Convert to sorted list if you want
-        ls_numbers = sorted(ls_numbers)
+        # Here we should have some logic that prepares the Express jobs
+        # Probably should have a call to cmsDriver
+        # There are better ways to do this, but right now I just do it with a file
+        with open(self.workingDir + "/" + tempScriptName, "w") as f:
+            # The release area and its environment are prepared once per node,
+            # so we just source the cached environment
+            f.write("#!/bin/bash -ex\n\n")
+            f.write(f"source {self.environmentScript}\n\n")
+            # Now we do the cmsDriver.py proper, if nobody did it yet
+            str_paths = {"root://eoscms.cern.ch/" + str(p) for p in files}
+            cmsDriverCommand = (
+                f"cmsDriver.py expressStep2 --conditions {self.globalTag} "
+                + f" -s {step_args['step']} "
+                + f"--datatier {step_args['datatier']} --eventcontent {step_args['eventcontent']} --data --process {step_args['process']} "
+                + f"--scenario {step_args['scenario']} --era {step_args['era']} "
+                + f"--nThreads {step_args.get('nThreads', 8)} --nStreams {step_args.get('nStreams', 8)} -n -1 "
+                # the input and output are overridden by each job anyway
+                + f"--filein {','.join(sorted(str_paths))} "
+                + f"--fileout file:output_{tempAffix}{self.passOutputs[0][0]}.root --no_exec"
+            )
+            WriteTemplateGeneration(f, templateFileName, cmsDriverCommand)
+            for block in blocks:
+                expectedOutputs += self.WriteBlock(f, block, tempScriptName, tempAffix, templateFileName)
+
+        logging.info(f"Prepared file {tempScriptName}")
+        return {
+            "script": tempScriptName,
+            "files": files,
+            "events": self.lsInventory.EventsForFiles(files),
+            "outputs": expectedOutputs,
+        }
+
+    def WriteBlock(self, f, files, jobName, tempAffix, templateFileName):
+        # Writes the lines of the job script that process one block of files,
+        # and returns its expected outputs.
+        # Extract all LS numbers (as integers). These files were already
+        # probed when they were listed, so we just ask the inventory.
+        ls_numbers = sorted(self.lsInventory.LSForFiles(files))
 
         logging.info(f"Found {len(ls_numbers)} unique lumisections:")
         logging.info(ls_numbers)
 
-        # ls_numbers = [int(re.search(r"ls(\d{4})", path).group(1)) for path in str_paths]
-
         # Compute min and max, then format back
-        min_ls = min(ls_numbers, default=None)
-        max_ls = max(ls_numbers, default=None)
+        min_ls = min(ls_numbers, default=0)
+        max_ls = max(ls_numbers, default=0)
         step_args = self.calib_config["step_2_config"]
         output_affix = step_args["output_filename_affix"]
 
-        tempAffix = "".join(random.choices(string.ascii_letters + string.digits, k=10))
-        self.tempScriptName = "cmsDriver_" + tempAffix + ".sh"
         affix = f"LS{min_ls:04d}To{max_ls:04d}"
+        # Several files may hold the same LS, so two jobs can cover the same range
+        baseAffix, n = affix, 1
+        while f"{self.workingDir}/run{self.runNumber}_{affix}{self.passOutputs[0][0]}.root" in self.setOfExpectedOutputs:
+            affix = f"{baseAffix}_{n}"
+            n += 1
         logFileName = f"run{self.runNumber}_{affix}_step2.log"
-        tempOutputFileName = "output_" + tempAffix + ".root"
-        outputFileName = f"run{self.runNumber}_{affix}{output_affix}.root"
+        # One output (and witness file) per calibration of the pass:
+        # (temporary name, final name, witness file, ALCAPRODUCER paths)
+        outputs = [
+            (
+                f"output_{tempAffix}{calibrationAffix}.root",
+                f"run{self.runNumber}_{affix}{calibrationAffix}.root",
+                f"run{self.runNumber}_{affix}{calibrationAffix}_job.txt",
+                paths,
+            )
+            for calibrationAffix, paths in self.passOutputs
+        ]
         python_filename = f"run{self.runNumber}_{affix}{output_affix}.py"
 
-        # Here we should have some logic that prepares the Express jobs
-        # Probably should have a call to cmsDriver
-        # There are better ways to do this, but right now I just do it with a file
-        with open(self.workingDir + "/" + self.tempScriptName, "w") as f:
-            # Do we actually need to set the environment like this every time?
-            f.write("#!/bin/bash -ex\n\n")
-            f.write(f"export $SCRAM_ARCH={self.scramArch}\n")
-            f.write(f"cmsrel {self.cmsswVersion}\n")
-            f.write(f"cd {self.cmsswVersion}/src\n")
-            f.write("cmsenv\n")
-            f.write("cd -\n\n")
-            # Now we do the cmsDriver.py proper
-            f.write(f"cmsDriver.py expressStep2 --conditions {self.globalTag} ")
-            f.write(
-            f" -s {step_args['step']} "
-            + f"--datatier {step_args['datatier']} --eventcontent {step_args['eventcontent']} --data --process {step_args['process']} "
-            + f"--scenario {step_args['scenario']} --era {step_args['era']} "
-            + "--nThreads 8 --nStreams 8 -n -1 "
+        # some massaging to go from PosixPath to string
+        str_paths = {"root://eoscms.cern.ch/" + str(p) for p in files}
+        # Each job only overrides the input files and the output file name(s)
+        if len(outputs) == 1:
+            WriteOverrideConfig(
+                self.workingDir + "/" + python_filename,
+                self.workingDir + "/" + templateFileName,
+                str_paths,
+                f"file:{outputs[0][0]}",
             )
-
-            # and we pass the list of LS to process (self.setOfLSToProcess)
-            f.write("--filein ")
-            # some massaging to go from PosixPath to string
-            str_paths = {"root://eoscms.cern.ch/" + str(p) for p in self.setOfExpressLS}
-            f.write(",".join(str_paths))
-            f.write(f" --fileout file:{tempOutputFileName} --no_exec ")
-            f.write(
-                    f"--python_filename {python_filename}\n\n"
-            ) 
-            f.write(
-                f"cmsRun {python_filename} > {logFileName} 2>&1\n"
+        else:
+            WriteOverrideConfig(
+                self.workingDir + "/" + python_filename,
+                self.workingDir + "/" + templateFileName,
+                str_paths,
+                splitOutputs=[(f"file:{temp}", paths) for temp, _, _, paths in outputs],
             )
+
+        f.write(
+            f"cmsRun {python_filename} > {logFileName} 2>&1\n"
+        )
+        for tempOutputFileName, outputFileName, witness_file, _ in outputs:
             # we now move the file to its final location
             f.write(f"mv {tempOutputFileName} {outputFileName}\n")
             # touch the witness file
-            witness_file = f"run{self.runNumber}_{affix}{output_affix}_job.txt"
             f.write(f"touch {witness_file} \n")
-            # should delete the script for good measure (FIXME: implement later)
-
-        logging.info(f"Prepared file {self.tempScriptName}")
-        self.setOfExpectedOutputs.add(self.workingDir + "/" + outputFileName)
-        self.setOfLSToProcess = set()
+        expectedOutputs = [self.workingDir + "/" + output[1] for output in outputs]
+        self.setOfExpectedOutputs.update(expectedOutputs)
+        # The trace of the run tells when each block was done, not only the whole job
+        if self.streamingPolicy is not None:
+            f.write(
+                self.tracer.ShellEmit(
+                    self.runNumber, "blockDone", job=jobName, ls=ls_numbers, outputs=expectedOutputs
+                )
+            )
+        f.write("\n")
+        return expectedOutputs
 
     def LaunchExpressJobs(self):
         logging.info("I am in LaunchExpressJobs...")
 
         # Here we should launch the Express jobs
-        # We use subprocess.Popen, since we don't want to hang waiting for this
-        # to finish running. Some other loop will look at their output
+        # We hand them to the job executor, which starts them as soon as their
+        # threads fit on the node, and keeps track of how they went.
         # Notice: we only ACTUALLY launch the jobs if we are still treating this run!
-        # If we find the magic file runEnd.log, we just do nothing!
+        # If we find the magic file runEnd_<calibration>.log, we just do nothing!
         # We have to check this here because we don't want to continuously go through
         # launching jobs if we are forced to go through the PreparingFinalLS path
-        end_log_path = Path(self.workingDir) / "runEnd.log"
+        end_log_path = Path(self.workingDir) / RunEndFileName(self.calibrationNames[0])
 
         # We also don't want to launch anything if there is nothing to launch
-        if (not end_log_path.exists()) and self.setOfExpressLS:
-            logging.info(f"Launching file {self.tempScriptName}")
-            subprocess.Popen(
-                ["bash", self.tempScriptName],
-                cwd=self.workingDir,
-                preexec_fn=os.setsid,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                close_fds=True,
-            )
-            logging.info("Launched jobs with:")
-            logging.info(self.setOfExpressLS)
+        jobs = {}
+        if not end_log_path.exists():
+            for preparedJob in self.preparedJobs:
+                logging.info(f"Launching file {preparedJob['script']}")
+                jobInfo = {
+                    "command": ["bash", preparedJob["script"]],
+                    "slots": self.calib_config["step_2_config"].get("nThreads", 8),
+                    "events": preparedJob["events"],
+                    # What the trace of the run says about the job
+                    "trace": {
+                        "inputs": sorted(str(f) for f in preparedJob["files"]),
+                        "ls": sorted(self.lsInventory.LSForFiles(preparedJob["files"])),
+                        "outputs": preparedJob["outputs"],
+                    },
+                }
+                jobs[preparedJob["script"]] = ("queued", jobInfo)
 
         # Now we have to move the LSs to self.setOfLSProcessed
         # and clear self.setOfLSToProcess
-        # In any case we remove them from the list
+        # In any case we remove them from the list.
+        # The ledger gets the files and the job in one go, so that after a
+        # restart we neither lose nor redo them.
+        self.ledger.Record(
+            self.runNumber,
+            items={
+                "file": self.setOfExpressLS,
+                "output": [o for job in self.preparedJobs for o in job["outputs"]] if jobs else [],
+            },
+            jobs=jobs,
+        )
+        for jobName, (_, jobInfo) in jobs.items():
+            self.SubmitJob(jobName, jobInfo["command"], jobInfo["slots"], jobInfo["events"], jobInfo["trace"])
+        if jobs:
+            logging.info(f"Launched {len(jobs)} job(s) with:")
+            logging.info(self.setOfExpressLS)
+        self.preparedJobs = []
         self.setOfLSProcessed = self.setOfLSProcessed.union(self.setOfExpressLS)
         self.setOfLSToProcess = set()
 
+    def SubmitJob(self, jobName, command, slots, events=0, trace=None):
+        # The ledger and the trace of the run follow the job through the
+        # executor, and the batching policy learns from it how fast our
+        # jobs process events
+        runNumber = self.runNumber
+        group = f"{self.calibration_name}/{runNumber}"
+
+        def OnFinish(job):
+            self.ledger.RecordJob(runNumber, jobName, "done" if job.exitCode == 0 else "failed")
+            if job.exitCode == 0:
+                self.batchPolicy.ObserveJob(events, job.WallTime())
+            # The end of the run waits for its last job
+            if str(runNumber) in self.pendingRunEnds and not self.jobExecutor.GroupHasJobs(group, "step2"):
+                self.SignalRunEnd(runNumber, self.pendingRunEnds.pop(str(runNumber)))
+
+        onStart, onFinish = self.tracer.JobCallbacks(
+            runNumber, jobName,
+            onStart=lambda job: self.ledger.RecordJob(runNumber, jobName, "running"),
+            onFinish=OnFinish,
+            events=events,
+            **(trace or {}),
+        )
+        self.jobExecutor.Submit(
+            f"{self.calibration_name}/run{runNumber}/{jobName}",
+            command,
+            cwd=self.workingDir,
+            slots=slots,
+            onStart=onStart,
+            onFinish=onFinish,
+            group=group,
+            kind="step2",
+            deadline=self.Deadline(),
+        )
+
     def ThereAreLSWaiting(self):
         if self.waitingLS:
             logging.info("++ There are LS waiting!")
@@ -543,6 +803,27 @@ class NGTLoopStep2(object):
     def WePreparedFinalLS(self):
         return self.preparedFinalLS
 
+    def ThereIsDiskSpace(self):
+        # Back-pressure: while the disk governor says there is no room, our
+        # files wait on EOS, until steps 3 and 4 are done with the outputs
+        # already there and the governor deleted them
+        if self.diskGovernor is None or not self.setOfLSToProcess:
+            return True
+        reason = self.diskGovernor.BackPressure(self.runNumber)
+        if reason is None:
+            if self.heldBack:
+                logging.warning(f"There is disk space again, run {self.runNumber} goes on")
+                self.heldBack = False
+            return True
+        if not self.heldBack:
+            logging.warning(f"Holding back the jobs of run {self.runNumber}: {reason}")
+            self.heldBack = True
+        logging.info(f"++ No disk space for new jobs: {reason}")
+        return False
+
+    def TraceStateChange(self):
+        self.stateTracer.Changed(self.runNumber, self.state)
+
     def ExecuteCleanup(self):
         logging.info("I am in ExecuteCleanup")
         self.rigMe = False
@@ -550,12 +831,15 @@ class NGTLoopStep2(object):
             logging.info("We prepared Final LS, will reset the machine...")
             # We actually have to reset the machine only when we go to NotRunning!
 
-            # Announce that the run ended and setup the witness file
-            logging.info(
-                f"Processing of run {self.runNumber} has ended. Creating empty runEnd.log..."
-            )
-            end_log_path = Path(self.workingDir) / "runEnd.log"
-            end_log_path.touch()
+            # Steps 3 and 4 close the run as soon as we announce its end, so
+            # we only do it once the outputs of our last jobs are there
+            if self.jobExecutor.GroupHasJobs(f"{self.calibration_name}/{self.runNumber}", "step2"):
+                logging.info(
+                    f"Processing of run {self.runNumber} has ended, waiting for its last jobs to announce it"
+                )
+                self.pendingRunEnds[str(self.runNumber)] = self.workingDir
+            else:
+                self.SignalRunEnd(self.runNumber, self.workingDir)
             # Make a log of everything that we did
             with open(self.workingDir + "/allLSProcessed.log", "w") as f:
                 for LS in sorted(self.setOfLSProcessed):
@@ -564,25 +848,67 @@ class NGTLoopStep2(object):
                 for output in self.setOfExpectedOutputs:
                     f.write("file:" + output + "\n")
 
+    def SignalRunEnd(self, runNumber, workingDir):
+        # Announce that the run ended and setup the witness file
+        # Every calibration of the pass gets its own
+        for calibrationName in self.calibrationNames:
+            end_log_path = Path(workingDir) / RunEndFileName(calibrationName)
+            logging.info(
+                f"Processing of run {runNumber} has ended. Creating empty {end_log_path.name}..."
+            )
+            end_log_path.touch()
+        self.ledger.CloseRun(runNumber)
+        self.runsInProgress.discard(str(runNumber))
+
     def ResetTheMachine(self):
         logging.info("Machine reset!")
+        # We are done with our run, if we had one (but it stays ours until
+        # its last jobs are done)
+        runNumber = str(getattr(self, "runNumber", 0))
+        if runNumber not in self.pendingRunEnds:
+            self.runsInProgress.discard(runNumber)
         self.runNumber = 0
         self.rigMe = False
-        self.tempScriptName = ""
         self.startTime = 0
-        self.minimumLS = 1  # these variable names are a bit misleading as they are not minimumLS but minimum files availabe (same for the other ones ok)
         self.minLSToProcess = (
             50  # to avoid the continued processing of runs that do not have enough data
         )
-        self.maximumFilesPerJob = 5
         self.maxLatchTimeInHours = 8  # due to 8 hours of buffering
+        self.maxProbeWorkers = 8  # concurrent edmFileUtil probes
+        self.lsInventory = None
+        self.completeness = None
+        self.maxListingIntervalInSeconds = 30  # slowest xrdfs relisting when idle
+        self.directoryWatcher = None
         self.runStartTime = None
         self.waitingLS = False
         self.enoughLS = False
-        calibration_config_path = f"/tmp/ngt/calibrationYAML/{self.calibration_name}.yaml"
-        with open(calibration_config_path, "r") as f:
-            self.calib_config = yaml.safe_load(f)
+        self.heldBack = False
+        # With several calibrations in the pass, calib_config is their combination
+        calib_configs = [ReadCalibrationConfig(name) for name in self.calibrationNames]
+        self.calib_config = CombinedConfig(calib_configs)
+        # What each calibration gets out of the pass: its output affix, and
+        # the paths of its ALCAPRODUCER sequences
+        self.passOutputs = [
+            (
+                config["step_2_config"]["output_filename_affix"],
+                ["pathALCARECO" + p for p in SplitStep(config["step_2_config"]["step"])[1]],
+            )
+            for config in calib_configs
+        ]
         self.file_in_path = self.calib_config.get("file_in_path")
+        # How the files are grouped into jobs. The YAML is read again for each
+        # run, but we keep what we learnt about the speed of our jobs.
+        batchPolicy = BatchPolicy.FromConfig(self.calib_config["step_2_config"].get("batching"))
+        if getattr(self, "batchPolicy", None) is not None:
+            batchPolicy.eventsPerSecond = self.batchPolicy.eventsPerSecond
+        self.batchPolicy = batchPolicy
+        # In the streaming mode, the files are grouped into blocks of LS instead
+        self.streamingPolicy = StreamingPolicy.FromConfig(
+            self.calib_config["step_2_config"].get("streaming"), batchPolicy.maxLatencyInSeconds
+        )
+        self.fileFirstSeen = {}
+        self.batchesToProcess = []
+        self.preparedJobs = []
         self.pathWhereFilesAppear = self.file_in_path + CURRENT_RUN + "/00000"
         logging.info(f"self.pathWhereFilesAppear {self.pathWhereFilesAppear}")
         self.workingDir = "/dev/null"
@@ -600,17 +926,65 @@ class NGTLoopStep2(object):
         self.setOfLSProcessed = set()
         self.setOfExpectedOutputs = set()
 
-    def __init__(self, name):
+    def __init__(self, name, calibrationNames, omsClient=None, jobExecutor=None, shared=None, diskGovernor=None):
 
         # No anonymous FSMs in my watch!
         self.name = name
-        self.calibration_name = args.calibration
+        # The calibrations sharing this pass over the RAW (see GroupCalibrations).
+        # The bookkeeping goes under their combined name.
+        self.calibrationNames = list(calibrationNames)
+        self.calibration_name = "+".join(self.calibrationNames)
         print(f"We are processing {self.calibration_name}.")
-        self.ResetTheMachine()
+        # When we process several runs at once, there is one FSM per run,
+        # and all of them share what is below with the first one
+        if shared is not None:
+            self.omsClient = shared.omsClient
+            self.ledger = shared.ledger
+            self.jobExecutor = shared.jobExecutor
+            self.runsInProgress = shared.runsInProgress
+            self.pendingRunEnds = shared.pendingRunEnds
+            self.tracer = shared.tracer
+            self.tier0Latency = shared.tier0Latency
+            self.diskGovernor = shared.diskGovernor
+            self.ResetTheMachine()
+            self.environmentScript = shared.environmentScript
+        else:
+            # A single OMS client for the whole lifetime of the loop
+            self.omsClient = omsClient
+            # Our bookkeeping survives restarts in the job ledger
+            self.ledger = JobLedger(self.name, self.calibration_name)
+            # Same for the executor: jobs outlive the run they belong to
+            self.jobExecutor = jobExecutor
+            # The runs latched by any of the FSMs
+            self.runsInProgress = set()
+            # The runs whose end we announce once their last jobs are done
+            self.pendingRunEnds = {}
+            # The timing events of each run go to its trace
+            self.tracer = RunTracer(self.name, self.calibration_name)
+            # How long the files of the pass take to reach EOS, over the runs
+            self.tier0Latency = Tier0LatencyHistory(
+                f"{NGT_BASE}/tier0Latency_{self.calibration_name}.json"
+            )
+            # Holds back our jobs when the disk fills up, if we have one
+            self.diskGovernor = diskGovernor
+            self.ResetTheMachine()
+            # The CMSSW environment of our jobs, prepared once for the whole node.
+            # ResetTheMachine has read the release and SCRAM_ARCH for us.
+            self.environmentScript = PrepareEnvironment(self.scramArch, self.cmsswVersion)
+
+        # Every FSM records its own state changes, but not its idle polling
+        self.stateTracer = StateTracer(
+            self.tracer,
+            idleTransitions=[("WaitingForLS", "CheckingLSForProcess"), ("CheckingLSForProcess", "WaitingForLS")],
+        )
 
         # Initialize the state machine
         self.machine = Machine(
-            model=self, states=NGTLoopStep2.states, queued=True, initial="NotRunning"
+            model=self,
+            states=NGTLoopStep2.states,
+            queued=True,
+            initial="NotRunning",
+            after_state_change="TraceStateChange",
         )
 
         # Add some transitions. We could also define these using a static list of
@@ -655,6 +1029,7 @@ class NGTLoopStep2(object):
         # Go immediately to PreparingFinalLS to signal to Step3 that we are ready.
         # Notice: we will probably keep running over that run, and that is inneficient.
         # But we do the optimisation later.
+        # The last jobs go whatever the disk space: the RAW is about to leave the buffer.
         self.machine.add_transition(
             trigger="ContinueAfterCheckLS",
             source="CheckingLSForProcess",
@@ -664,11 +1039,12 @@ class NGTLoopStep2(object):
 
         # If we arrived here, we still have time... let's work leisurely.
         # If we have enough LS, process them immediately, we go to PreparingLS
+        # (unless the disk is full: then the files wait on EOS)
         self.machine.add_transition(
             trigger="ContinueAfterCheckLS",
             source="CheckingLSForProcess",
             dest="PreparingLS",
-            conditions=["ThereAreLSWaiting", "ThereAreEnoughLS"],
+            conditions=["ThereAreLSWaiting", "ThereAreEnoughLS", "ThereIsDiskSpace"],
         )
 
         # If the run is over and we have the files to be processed,
@@ -677,7 +1053,7 @@ class NGTLoopStep2(object):
             trigger="ContinueAfterCheckLS",
             source="CheckingLSForProcess",
             dest="PreparingFinalLS",
-            conditions=["RunHasEndedAndFilesAreReady"],
+            conditions=["RunHasEndedAndFilesAreReady", "ThereIsDiskSpace"],
         )
 
         # If we don't have enough LS, but we are still running,
@@ -735,87 +1111,238 @@ class NGTLoopStep2(object):
         )
 
 
-# --- NEW LOGGING SETUP ---
-# Create /tmp/ngt if it doesn't exist, so we can write the log file
-Path("/tmp/ngt").mkdir(parents=True, exist_ok=True)
-
-# Get the main logger
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)  # Capture everything at logger level
-
-# Create formatter
-formatter = logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-# 1. ALL MESSAGES - Complete history
-all_handler = logging.FileHandler("/tmp/ngt/NGTLoopStep2_ALL.log")
-all_handler.setLevel(logging.DEBUG)
-all_handler.setFormatter(formatter)
-logger.addHandler(all_handler)
-
-# 2. INFO ONLY
-info_handler = logging.FileHandler("/tmp/ngt/NGTLoopStep2_INFO.log")
-info_handler.setLevel(logging.INFO)
-info_handler.addFilter(lambda record: record.levelno == logging.INFO)  # ONLY info
-info_handler.setFormatter(formatter)
-logger.addHandler(info_handler)
-
-# 3. WARNING ONLY
-warning_handler = logging.FileHandler("/tmp/ngt/NGTLoopStep2_WARNING.log")
-warning_handler.setLevel(logging.WARNING)
-warning_handler.addFilter(
-    lambda record: record.levelno == logging.WARNING
-)  # ONLY warnings
-warning_handler.setFormatter(formatter)
-logger.addHandler(warning_handler)
-
-# 4. ERROR ONLY
-error_handler = logging.FileHandler("/tmp/ngt/NGTLoopStep2_ERROR.log")
-error_handler.setLevel(logging.ERROR)
-error_handler.addFilter(lambda record: record.levelno == logging.ERROR)  # ONLY errors
-error_handler.setFormatter(formatter)
-logger.addHandler(error_handler)
-
-# 5. CRITICAL ONLY
-critical_handler = logging.FileHandler("/tmp/ngt/NGTLoopStep2_CRITICAL.log")
-critical_handler.setLevel(logging.CRITICAL)
-critical_handler.addFilter(
-    lambda record: record.levelno == logging.CRITICAL
-)  # ONLY critical
-critical_handler.setFormatter(formatter)
-logger.addHandler(critical_handler)
-
-# 6. Screen output (stderr) - warnings and above
-stream_handler = logging.StreamHandler(sys.stderr)
-stream_handler.setLevel(logging.WARNING)
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
-
-# Optional: Add a simple startup message to verify logging is working
-logging.info("Logging initialized - writing to split log files")
-logging.warning("Warning-level logging active")
-# --- END OF ENHANCED LOGGING SETUP ---
-
-loop = NGTLoopStep2("Step2")
-# loop.rigMe = True
-loop.state
-
-while True:
-    while loop.state == "NotRunning":
-        time.sleep(1)
-        loop.TryStartRun()
-
-    while loop.state == "WaitingForLS":
-        loop.TryProcessLS()
-        time.sleep(1)
-        loop.ContinueAfterCheckLS()
-        time.sleep(1)
-        loop.TryPrepareExpressJobs()
-        time.sleep(1)
-        loop.TryLaunchExpressJobs()
-        time.sleep(1)
-        loop.ContinueToCleanup()
-        time.sleep(1)
-        loop.ContinueAfterCleanup()
-        time.sleep(1)
+class NGTLoopStep2Runs(object):
+    # Step 2 follows several runs at the same time, so that short runs do not
+    # wait behind a long one. Each run gets its own FSM (with its own LS
+    # inventory, directory watcher and batching state), and there is always
+    # one more FSM in NotRunning, looking for the next run to latch.
+    # The job executor is shared, and shares the slots fairly between runs.
+
+    def __init__(self, name, calibrationNames, maxActiveRuns, omsClient, jobExecutor, diskGovernor=None):
+        self.name = name
+        self.calibrationNames = calibrationNames
+        self.maxActiveRuns = maxActiveRuns
+        self.idleLoop = NGTLoopStep2(name, calibrationNames, omsClient, jobExecutor, diskGovernor=diskGovernor)
+        self.jobExecutor = self.idleLoop.jobExecutor
+        self.activeLoops = []
+        METRICS.AddCollector(self.Metrics)
+
+    def LookForRun(self):
+        # We latch as many runs as we can take
+        latched = False
+        while len(self.activeLoops) < self.maxActiveRuns:
+            self.idleLoop.TryStartRun()
+            if self.idleLoop.state == "NotRunning":
+                break
+            logging.info(
+                f"Run {self.idleLoop.runNumber} latched, {len(self.activeLoops) + 1} run(s) in progress"
+            )
+            self.activeLoops.append(self.idleLoop)
+            self.idleLoop = NGTLoopStep2(self.name, self.calibrationNames, shared=self.idleLoop)
+            latched = True
+        return latched
+
+    def CanTakeRun(self):
+        return len(self.activeLoops) < self.maxActiveRuns
+
+    def LoopsWaitingForLS(self):
+        return [loop for loop in self.activeLoops if loop.state == "WaitingForLS"]
+
+    def SecondsUntilDue(self):
+        # The LS check of each run is paced by its own EOS directory watcher
+        return min(
+            (loop.directoryWatcher.SecondsUntilDue() for loop in self.LoopsWaitingForLS()),
+            default=omsPollIntervalInSeconds,
+        )
+
+    def Metrics(self):
+        passName = self.idleLoop.calibration_name
+        samples = [("ngt_step2_runs_active", {"pass": passName}, len(self.activeLoops))]
+        for loop in list(self.activeLoops):
+            if loop.lsInventory is None or loop.completeness is None:
+                continue
+            labels = {"pass": passName, "run": str(loop.runNumber)}
+            pendingFiles = list(loop.setOfLSToProcess)
+            samples += [
+                ("ngt_step2_files_waiting", labels, len(pendingFiles)),
+                ("ngt_step2_ls_waiting", labels, len(loop.lsInventory.LSForFiles(pendingFiles))),
+            ]
+            if loop.completeness.lastLS > 0:
+                samples += [
+                    ("ngt_step2_ls_coverage", labels, loop.completeness.Coverage()),
+                    ("ngt_step2_ls_missing", labels, loop.completeness.lastLS - loop.completeness.coveredLS),
+                ]
+        return samples
+
+    def ProcessLS(self):
+        progressed = False
+        for loop in self.LoopsWaitingForLS():
+            if loop.directoryWatcher.IsDue():
+                progressed = ProcessLS(loop) or progressed
+        # The runs that are over give their place to new ones
+        self.activeLoops = [loop for loop in self.activeLoops if loop.state != "NotRunning"]
+        return progressed
+
+
+def SetupLogging(logPrefix="NGTLoopStep2"):
+    # --- NEW LOGGING SETUP ---
+    # Create /tmp/ngt if it doesn't exist, so we can write the log file
+    Path("/tmp/ngt").mkdir(parents=True, exist_ok=True)
+
+    # Get the main logger
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)  # Capture everything at logger level
+
+    # Create formatter
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    # 1. ALL MESSAGES - Complete history
+    all_handler = logging.FileHandler(f"/tmp/ngt/{logPrefix}_ALL.log")
+    all_handler.setLevel(logging.DEBUG)
+    all_handler.setFormatter(formatter)
+    logger.addHandler(all_handler)
+
+    # 2. INFO ONLY
+    info_handler = logging.FileHandler(f"/tmp/ngt/{logPrefix}_INFO.log")
+    info_handler.setLevel(logging.INFO)
+    info_handler.addFilter(lambda record: record.levelno == logging.INFO)  # ONLY info
+    info_handler.setFormatter(formatter)
+    logger.addHandler(info_handler)
+
+    # 3. WARNING ONLY
+    warning_handler = logging.FileHandler(f"/tmp/ngt/{logPrefix}_WARNING.log")
+    warning_handler.setLevel(logging.WARNING)
+    warning_handler.addFilter(
+        lambda record: record.levelno == logging.WARNING
+    )  # ONLY warnings
+    warning_handler.setFormatter(formatter)
+    logger.addHandler(warning_handler)
+
+    # 4. ERROR ONLY
+    error_handler = logging.FileHandler(f"/tmp/ngt/{logPrefix}_ERROR.log")
+    error_handler.setLevel(logging.ERROR)
+    error_handler.addFilter(lambda record: record.levelno == logging.ERROR)  # ONLY errors
+    error_handler.setFormatter(formatter)
+    logger.addHandler(error_handler)
+
+    # 5. CRITICAL ONLY
+    critical_handler = logging.FileHandler(f"/tmp/ngt/{logPrefix}_CRITICAL.log")
+    critical_handler.setLevel(logging.CRITICAL)
+    critical_handler.addFilter(
+        lambda record: record.levelno == logging.CRITICAL
+    )  # ONLY critical
+    critical_handler.setFormatter(formatter)
+    logger.addHandler(critical_handler)
+
+    # 6. Screen output (stderr) - warnings and above
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setLevel(logging.WARNING)
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    # Optional: Add a simple startup message to verify logging is working
+    logging.info("Logging initialized - writing to split log files")
+    logging.warning("Warning-level logging active")
+    # --- END OF ENHANCED LOGGING SETUP ---
+
+
+# How often we ask OMS for a new run while we can take one
+omsPollIntervalInSeconds = 10
+# How often we look after our running cmsRun jobs
+jobPollIntervalInSeconds = 5
+# How often the disk governor cleans up and measures the run directories
+diskPollIntervalInSeconds = 30
+
+
+def ProcessLS(loop):
+    # The whole trigger chain runs back to back: the intermediate
+    # states are transient, there is nothing to wait for in between
+    numberOfLSProcessed = len(loop.setOfLSProcessed)
+    loop.TryProcessLS()
+    loop.ContinueAfterCheckLS()
+    loop.TryPrepareExpressJobs()
+    loop.TryLaunchExpressJobs()
+    loop.ContinueToCleanup()
+    loop.ContinueAfterCleanup()
+    # We made progress if we launched a job or if the run is over
+    return (
+        loop.state != "WaitingForLS"
+        or len(loop.setOfLSProcessed) > numberOfLSProcessed
+    )
+
+
+def AddSources(scheduler, runs, prefix="", pollJobs=True):
+    # The scheduler sources of the step 2 loops of one calibration. When
+    # several calibrations share the scheduler, the prefix keeps their names
+    # apart, and pollJobs=False leaves the polling of a shared job executor
+    # to whoever owns it.
+    # If we latched a run, we go look for its LS right away
+    scheduler.AddSource(
+        prefix + "LookForRun",
+        runs.LookForRun,
+        omsPollIntervalInSeconds,
+        when=runs.CanTakeRun,
+    )
+    # The LS check is paced by the EOS directory watchers, which back off
+    # by themselves when nothing new appears
+    scheduler.AddSource(
+        prefix + "ProcessLS",
+        runs.ProcessLS,
+        runs.SecondsUntilDue,
+        when=lambda: len(runs.LoopsWaitingForLS()) > 0,
+    )
+    # The executor reaps finished jobs and starts queued ones
+    if pollJobs:
+        scheduler.AddSource(
+            prefix + "PollJobs",
+            runs.jobExecutor.Poll,
+            jobPollIntervalInSeconds,
+            when=runs.jobExecutor.HasJobs,
+        )
+
+
+def AddDiskArguments(parser):
+    # The quotas of the disk governor, for step 2 and for the engine
+    parser.add_argument('--runQuotaGB', type=float, help=f'Disk space a run directory may take before step 2 holds back its new jobs (default: {runQuotaInGB}, 0 for no quota).', default=runQuotaInGB)
+    parser.add_argument('--totalQuotaGB', type=float, help=f'Disk space all the run directories may take before step 2 holds back its new jobs (default: {totalQuotaInGB}, 0 for no quota).', default=totalQuotaInGB)
+    parser.add_argument('--minFreeGB', type=float, help=f'Free disk space under which step 2 holds back its new jobs (default: {minFreeInGB}, 0 for no minimum).', default=minFreeInGB)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs step2 of our calibration loop of a given calibration workflow.')
+    parser.add_argument('-c', '--calibration', type=str, nargs='+', help='Calibration workflow(s) to process: e.g. SiStripBad or EcalPedestals. Those reading the same files share their passes over them.', required=True, choices=['SiStripBad', 'EcalPedestals'])
+    parser.add_argument('--slots', type=int, help='Number of threads our cmsRun jobs may use at once on this node (default: all cores).', default=None)
+    parser.add_argument('--maxRuns', type=int, help='Number of runs we process at the same time (default: 3).', default=3)
+    parser.add_argument('--omsUrl', type=str, help='OMS aggregation API to query (e.g. a local stub server for testing).', default='https://cmsoms.cms/agg/api')
+    parser.add_argument('--metricsPort', type=int, help='Serve the metrics of the loop on http://localhost:<port>/metrics (default: no endpoint).', default=None)
+    AddDiskArguments(parser)
+    args = parser.parse_args()
+
+    SetupLogging()
+    omsClient = OMSClient(url=args.omsUrl)
+    jobExecutor = JobExecutor(totalSlots=args.slots, reportFile="/tmp/ngt/NGTLoopStep2_jobs.jsonl")
+    # The disk governor cleans up after all the steps of the node
+    diskGovernor = DiskGovernor(
+        runQuotaInGB=args.runQuotaGB, totalQuotaInGB=args.totalQuotaGB, minFreeInGB=args.minFreeGB
+    )
+    scheduler = EventScheduler()
+    # One set of FSMs per pass over the RAW
+    for calibrationNames in GroupCalibrations(args.calibration):
+        logging.info(f"One step 2 pass for {', '.join(calibrationNames)}")
+        runs = NGTLoopStep2Runs("Step2", calibrationNames, args.maxRuns, omsClient, jobExecutor, diskGovernor)
+        AddSources(scheduler, runs, prefix=f"{runs.idleLoop.calibration_name}/", pollJobs=False)
+    scheduler.AddSource(
+        "PollJobs",
+        jobExecutor.Poll,
+        jobPollIntervalInSeconds,
+        when=jobExecutor.HasJobs,
+    )
+    scheduler.AddSource("DiskGovernor", diskGovernor.Poll, diskPollIntervalInSeconds)
+    StartMetricsServer(args.metricsPort)
+    scheduler.Run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,24 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
 import json
 import os
-import re
-import subprocess
-import time
-from datetime import datetime, timezone
 from pathlib import Path
-import yaml
 from transitions import Machine, State
 
-import argparse
-parser = argparse.ArgumentParser(description='Runs step3 of our calibration loop of a given calibration workflow.')
-parser.add_argument('-c', '--calibration', type=str, help='Calibration workflow to process: e.g. SiStripBad or EcalPedestals.', required=True, choices=['SiStripBad', 'EcalPedestals'])
-args = parser.parse_args()
+from NGTBatching import FANOUT_DEFAULTS, SplitByEvents, StatisticsGate
+from NGTConfigTemplates import WriteOverrideConfig, WriteShardsAndMerge
+from NGTEnvironment import PrepareEnvironment
+from NGTJobExecutor import JobExecutor
+from NGTLSInventory import LSInventory, edmFileUtilLocalCommand
+from NGTLoopBase import INPUT_EVENTS_FILE_NAME, NGTLoopBase, RunEndFileName
+from NGTMetrics import StartMetricsServer
+from NGTScheduler import EventScheduler
+from NGTWatchers import WitnessWatcher
+
 
-class NGTLoopStep3(object):
+class NGTLoopStep3(NGTLoopBase):
 
     # Define some states.
     states = [
@@ -30,71 +32,37 @@ class NGTLoopStep3(object):
         State(name="CleanupState", on_enter="ExecuteCleanup"),
     ]
 
-    # We check if a new run appeared, e.g. /tmp/ngt/run386925
-    def NewRunAppeared(self):
-        print("Checking if a new run appeared")
-        path = Path(self.pathWhereFilesAppear)
-        currentDirs = {p.name for p in path.iterdir() if p.is_dir()}
-        newDirs = currentDirs - self.setOfRunsProcessed
-        
-        newRuns = {p for p in newDirs if p.startswith("run")}
-        # Thiago: rig to run on 398600
-        # newRuns = {p for p in newDirs if p.startswith("run398600")}
-        
-        foundNewRuns = not (not newRuns)  # Is this pythonic?
-        if foundNewRuns:
-            print("New runs found!")
-            # What happens if we found more than one run?
-            # We figure that out later...
-            # Slice off the "run" substring at the beginning
-            self.runNumber = (self.GetNextRun(newRuns))[3:]
-            print(f"Run {self.runNumber} is available")
-        else:
-            print("No new runs...")
-
-        return foundNewRuns
-
-    # For now, we just take the earliest of the new runs
-    def GetNextRun(self, newRuns):
-        return sorted(newRuns)[0]
+    idleTransitions = (
+        ("WaitingForStep2Files", "CheckingFilesForProcess"),
+        ("CheckingFilesForProcess", "WaitingForStep2Files"),
+    )
 
     def SetupNewRun(self):
-        # Prepare the new run
-        self.workingDir = self.pathWhereFilesAppear + "/run" + self.runNumber
-        startTimeFilePath = Path(self.workingDir + "/runStart.log")
-        if startTimeFilePath.exists():
-            with open(startTimeFilePath, "r") as f:
-                runStartLine = f.readline()
-                self.startTime = datetime.fromisoformat(runStartLine)
-        else:
-            # Weird, how come we don't have a runStart.log?
-            # Fine, we set the start time to now
-            print("We didn't find a runStart.log file... setting run start to NOW")
-            self.startTime = datetime.now(timezone.utc)
+        self.StartRun()
+        # The ALCA jobs that were still waiting for a slot when we stopped never ran
+        for jobName, jobInfo in self.ledger.Jobs(self.runNumber, "queued"):
+            print(f"Resubmitting job {jobName} from the job ledger")
+            self.SubmitALCAJob(
+                self.runNumber, jobInfo["jobDir"], jobInfo["slots"], jobInfo.get("inputs", [])
+            )
+        # The number of events of each step 2 output, to size the ALCA jobs
+        self.step2Inventory = LSInventory(
+            f"{self.workingDir}/step2Inventory_{self.calibration_name}.json",
+            probe=edmFileUtilLocalCommand(self.environmentScript),
+        )
 
-        print(f"Run {self.runNumber} detected, started at {self.startTime.isoformat()}")
+        # From now on, the step 2 witness files are reported to us as they appear
+        suffixControlFiles = self.calib_config["step_3_config"]["step_2_witness_suffix"]
+        self.witnessWatcher = WitnessWatcher(
+            self.workingDir,
+            lambda name: name.startswith("run") and name.endswith(suffixControlFiles),
+            callback=self.AnnounceNewFiles,
+        )
+        self.witnessWatcher.Start()
 
     def AnnounceWaitingForStep2Files(self):
         print("I am WaitingForStep2Files...")
 
-    def RunIsNotComplete(self):
-        print("Is the run complete?")
-        runEndedFile = Path(self.workingDir + "/runEnd.log")
-        if runEndedFile.exists():
-            print("The run is complete!")
-        else:
-            print("Not yet...")
-        return not runEndedFile.exists()
-
-    def StillHaveTime(self):
-        now_utc = datetime.now(timezone.utc)
-        diff = now_utc - self.startTime
-        if diff.total_seconds() > self.timeoutInSeconds:
-            print("Time ran out!")
-            return False
-        else:
-            return True
-
     def CheckFilesForProcessing(self):
         print("I am in CheckFilesForProcessing...")
         # Do something to check if there are Files to process
@@ -109,46 +77,25 @@ class NGTLoopStep3(object):
         else:
             self.enoughFiles = False
 
-    # This function only looks at a given path and lists
-    # all available files of the form "run*_step2.root".
+    # This function keeps the set of all available files of the form
+    # "run*_step2.root".
     # Notice, however, that "available" here means
     # "the ROOT files are closed and ready to be used"!
-    # So, we list files of the form
+    # So, we look for files of the form
     # "run*_*ecalPedsStep2_job.txt". If we find those,
     # we lop off that suffix and substitute it for "step2.root"
+    # The witness watcher only hands us the control files that appeared
+    # since the last call, so we never rescan the run directory.
     def GetSetOfAvailableFiles(self):
-        # For this version, self.pathWhereFilesAppear is the same as
-        # self.workingDir
         conf = self.calib_config["step_3_config"]
         suffixControlFiles = conf["step_2_witness_suffix"]
         rootFileSuffix = conf["step_2_root_suffix"]
 
-        targetPath = self.workingDir
-        # We control the naming of these files, we know they're called like this
-        setOfControlFiles = set(
-            list(Path(targetPath).glob(f"run*{suffixControlFiles}"))
-        )
-        as_strings = {str(p) for p in setOfControlFiles}
-        changed = {
-            (
-                s[: -len(suffixControlFiles)] + rootFileSuffix
-                if s.endswith(suffixControlFiles)
-                else s
+        for s in self.witnessWatcher.NewFiles():
+            self.setOfAvailableFiles.add(
+                Path(s[: -len(suffixControlFiles)] + rootFileSuffix)
             )
-            for s in as_strings
-        }
-        setOfAvailableFiles = {Path(s) for s in changed}
-        return setOfAvailableFiles
-
-    def ExecutePrepareFiles(self):
-        print("I am PreparingFiles")
-        self.PrepareFilesForProcessing()
-
-    def ExecutePrepareFinalFiles(self):
-        print("I am PreparingFinalFiles")
-        self.PrepareFilesForProcessing()
-        # Since this is final files, they have to be enough!
-        self.preparedFinalFiles = True
+        return set(self.setOfAvailableFiles)
 
     def PrepareFilesForProcessing(self):
         print("I am in PrepareFilesForProcessing...")
@@ -180,7 +127,7 @@ class NGTLoopStep3(object):
         # There are better ways to do this, but right now I just do it with a file
 
         # First make a particular subdir for us to run in
-        alcaJobDir = Path(self.workingDir + "/apJob" + f"{self.alcaJobNumber:03}")
+        alcaJobDir = self.JobDirectory("apJob", self.alcaJobNumber)
         alcaJobDir.mkdir(parents=True, exist_ok=True)
         os.chmod(alcaJobDir, 0o777)
         # Save it so that we can use it later
@@ -195,18 +142,16 @@ class NGTLoopStep3(object):
         # Write the job file
         with alcaJobFile.open("w") as f:
             f.write("#!/bin/bash -ex\n\n")
-            # First we go to the workingDir to setup CMSSW
-            f.write(f"export $SCRAM_ARCH={self.scramArch}\n")
-            f.write(f"cd {self.workingDir}/{self.cmsswVersion}/src\n")
-            f.write("cmsenv\n")
-            f.write("cd -\n\n")
+            # The CMSSW environment is prepared once per node, we just source it
+            f.write(f"source {self.environmentScript}\n\n")
             # Now we do the cmsDriver.py proper
             f.write(f"cmsDriver.py expressStep3 --conditions {self.globalTag} ")
             f.write(
                 f" -s {conf['step']} "
                 + "--datatier ALCARECO --eventcontent ALCARECO "
                 + "--triggerResultsProcess RERECO "
-                + "--nThreads 8 --nStreams 8 -n -1 "
+                + f"--nThreads {self.ThreadsPerJob()} "
+                + f"--nStreams {self.calib_config['step_3_config'].get('nStreams', 8)} -n -1 "
             )
             # and we pass the list of files to process (self.setOfFilesToProcess)
             f.write("--filein ")
@@ -226,7 +171,26 @@ class NGTLoopStep3(object):
                 f.write("@EOF\n\n")
 
             # 1. Run Step 3. If it fails, 'bash -e' stops the script here.
-            f.write(f"cmsRun {python_filename}\n\n")
+            # With several shards, each one runs the same configuration over
+            # its own files in parallel, and the PromptCalibProd outputs are
+            # merged in the job directory, where step 4 expects them.
+            shards = self.ShardExpressFiles()
+            # Every shard runs its own cmsRun with nThreads threads
+            self.jobSlots = self.ThreadsPerJob() * len(shards)
+            shardDirs = []
+            if len(shards) == 1:
+                f.write(f"cmsRun {python_filename}\n\n")
+            else:
+                for i, shard in enumerate(shards):
+                    shardDir = alcaJobDir / f"shard{i:02}"
+                    shardDir.mkdir(exist_ok=True)
+                    WriteOverrideConfig(
+                        str(shardDir / "ALCAOUTPUT_shard.py"),
+                        str(alcaJobDir / python_filename),
+                        {"file:" + str(p) for p in shard},
+                    )
+                    shardDirs.append(shardDir.name)
+                WriteShardsAndMerge(f, shardDirs, "ALCAOUTPUT_shard.py", "PromptCalibProd*.root")
 
             # 2. <<< THIS IS THE NEW LINE >>>
             #    This line is only reached if cmsRun succeeds.
@@ -234,27 +198,71 @@ class NGTLoopStep3(object):
 
             # 3. Write the witness file(s) for good measure
             f.write(f"touch {conf['step_3_witness_suffix']}\n")
-            # And remove the big file, we don't need it!
-            #f.write(conf['cleanup_command'])
+            # And remove the big file, we don't need it! With several shards,
+            # each of them has its own.
+            cleanupCommand = (conf.get("cleanup_command") or "").strip()
+            if cleanupCommand:
+                for shardDir in shardDirs or ["."]:
+                    f.write(f"(cd {shardDir} && {cleanupCommand})\n")
+
+        # Step 4 only harvests once the run has enough statistics: it needs
+        # the number of events that went into our outputs
+        if StatisticsGate.FromConfig(self.calib_config["step_4_config"].get("statistics_gate")):
+            files = sorted(self.setOfExpressFiles)
+            events = self.step2Inventory.EventsForFiles([str(p) for p in files]) if self.CountEvents(files) else None
+            with open(alcaJobDir / INPUT_EVENTS_FILE_NAME, "w") as f:
+                json.dump({"events": events}, f)
+
+    def ShardExpressFiles(self):
+        # Splits the step 2 files of this pass into parallel ALCA jobs
+        # with about the same number of events each
+        fanOut = dict(FANOUT_DEFAULTS, **(self.calib_config["step_3_config"].get("fan_out") or {}))
+        files = sorted(self.setOfExpressFiles)
+        # The shards run at the same time, in a single job of the executor:
+        # they can't take more than the whole node
+        maxJobs = min(fanOut["max_jobs"], self.jobExecutor.totalSlots // self.ThreadsPerJob())
+        if maxJobs <= 1 or len(files) <= 1:
+            return [files]
+
+        if self.CountEvents(files):
+            weights = [(p, self.step2Inventory.EventsForFiles([str(p)])) for p in files]
+            totalEvents = sum(nEvents for _, nEvents in weights)
+            # No point in splitting a handful of events
+            nShards = min(
+                maxJobs, len(files), max(1, totalEvents // fanOut["min_events_per_job"])
+            )
+        else:
+            # We can't count the events of every file, their size will do
+            print("Could not count the events of all step 2 files, sharding by file size")
+            weights = [(p, p.stat().st_size) for p in files]
+            nShards = min(maxJobs, len(files))
+
+        shards = SplitByEvents(weights, nShards)
+        print(f"Splitting {len(files)} files into {len(shards)} ALCA job(s)")
+        return shards
+
+    def ThreadsPerJob(self):
+        # Threads of each cmsRun of the ALCA jobs (and of each of their shards)
+        return self.calib_config["step_3_config"].get("nThreads", 8)
+
+    def CountEvents(self, files):
+        # The step 2 outputs are probed once each, and the result is cached.
+        # Returns False if the events of some of them could not be counted.
+        self.step2Inventory.Update(
+            {str(p): (p.stat().st_size, int(p.stat().st_mtime)) for p in files}
+        )
+        return len(self.step2Inventory.GoodFiles([str(p) for p in files])) == len(files)
 
     def LaunchExpressJobs(self):
         print("I am in LaunchExpressJobs...")
 
         # Here we should launch the Express jobs
-        # We use subprocess.Popen, since we don't want to hang waiting for this
-        # to finish running. Some other loop will look at their output
+        # The job executor runs them without us hanging, as soon as their
+        # threads fit on the node. Some other loop will look at their output
         if self.jobDir != "/dev/null" and len(self.setOfExpressFiles) != 0:
-            with open(self.jobDir + "/stdout.log", "w") as out, open(
-                self.jobDir + "/stderr.log", "w"
-            ) as err:
-                subprocess.Popen(
-                    ["bash", "ALCAOUTPUT.sh"],
-                    cwd=self.jobDir,
-                    stdout=out,
-                    stderr=err,
-                    preexec_fn=os.setsid,  # Unix-only; detaches session
-                    close_fds=True,
-                )
+            self.SubmitALCAJob(
+                self.runNumber, self.jobDir, self.jobSlots, sorted(str(p) for p in self.setOfExpressFiles)
+            )
         else:
             print("WARNING: not launching Express jobs!")
             print(f"DEBUG: {self.jobDir} and {len(self.setOfExpressFiles)}")
@@ -265,18 +273,51 @@ class NGTLoopStep3(object):
         # and setOfExpressFiles
         print("Launched jobs with:")
         print(self.setOfExpressFiles)
+        self.ledger.Record(
+            self.runNumber,
+            items={"file": self.setOfFilesToProcess},
+            counters={"alcaJobNumber": self.alcaJobNumber},
+        )
         self.setOfFilesProcessed = self.setOfFilesProcessed.union(
             self.setOfFilesToProcess
         )
         self.setOfFilesToProcess = set()
         self.setOfExpressFiles = set()
 
-    def ThereAreFilesWaiting(self):
-        if self.waitingFiles:
-            print("++ There are Files waiting!")
-        else:
-            print("++ No Files waiting...")
-        return self.waitingFiles
+    def SubmitALCAJob(self, runNumber, jobDir, slots, inputs):
+        jobName = Path(jobDir).name
+        group = f"{self.calibration_name}/{runNumber}"
+
+        def OnFinish(job):
+            self.ledger.RecordJob(runNumber, jobName, "done" if job.exitCode == 0 else "failed")
+            # The end of the run waits for its last job
+            if runNumber in self.pendingRunEnds and not self.jobExecutor.GroupHasJobs(group, "alca"):
+                self.SignalRunEnd(runNumber, self.pendingRunEnds.pop(runNumber))
+
+        # The trace follows the step 2 files into the output that step 4 harvests
+        onStart, onFinish = self.tracer.JobCallbacks(
+            runNumber, jobName,
+            onStart=lambda job: self.ledger.RecordJob(runNumber, jobName, "running"),
+            onFinish=OnFinish,
+            inputs=inputs,
+            outputs=[str(Path(jobDir) / self.calib_config["step_4_config"]["step_3_root_filename"])],
+        )
+        self.jobExecutor.Submit(
+            f"run{runNumber}/{jobName}",
+            ["bash", "ALCAOUTPUT.sh"],
+            cwd=jobDir,
+            slots=slots,
+            stdout=jobDir + "/stdout.log",
+            stderr=jobDir + "/stderr.log",
+            onStart=onStart,
+            onFinish=onFinish,
+            group=group,
+            kind="alca",
+            deadline=self.Deadline(),
+        )
+        self.ledger.RecordJob(
+            runNumber, jobName, "queued", {"jobDir": jobDir, "slots": slots, "inputs": inputs}
+        )
 
     def ThereAreEnoughFiles(self):
         if self.enoughFiles:
@@ -285,9 +326,6 @@ class NGTLoopStep3(object):
             print("++ Not enough step2 files...")
         return self.enoughFiles
 
-    def WePreparedFinalFiles(self):
-        return self.preparedFinalFiles
-
     def ExecuteCleanup(self):
         print("I am in ExecuteCleanup")
         if self.preparedFinalFiles:
@@ -298,13 +336,27 @@ class NGTLoopStep3(object):
             with open(self.workingDir + "/allStep2FilesProcessed.log", "w") as f:
                 for Files in sorted(self.setOfFilesProcessed):
                     f.write(str(Files) + "\n")
+            # Step 4 closes the run as soon as we announce its end, so we
+            # only do it once the outputs of our last jobs are there
+            if self.jobExecutor.GroupHasJobs(f"{self.calibration_name}/{self.runNumber}", "alca"):
+                print(f"Waiting for the last ALCA jobs of run {self.runNumber} to announce its end")
+                self.pendingRunEnds[self.runNumber] = self.workingDir
+            else:
+                self.SignalRunEnd(self.runNumber, self.workingDir)
             # Add the run we have just seen to our memory
             # If is easier to just add the "run" prefix here
             self.setOfRunsProcessed.add("run" + self.runNumber)
             print(self.setOfRunsProcessed)
 
+    def SignalRunEnd(self, runNumber, workingDir):
+        end_log_path = Path(workingDir) / RunEndFileName(self.calibration_name, 3)
+        print(f"Step 3 of run {runNumber} has ended. Creating empty {end_log_path.name}...")
+        end_log_path.touch()
+        self.ledger.CloseRun(runNumber)
+
     def ResetTheMachine(self):
         print("Machine reset!")
+        self.StopWatchingFiles()
         self.runNumber = 0
         self.startTime = 0
         self.timeoutInSeconds = 9 * 60 * 60  # 8 hours
@@ -316,38 +368,40 @@ class NGTLoopStep3(object):
         self.pathWhereFilesAppear = "/tmp/ngt/"
         self.workingDir = "/dev/null"
         self.jobDir = "/dev/null"
+        self.jobSlots = 8
         self.alcaJobNumber = 0
         self.preparedFinalFiles = False
-
-        calibration_config_path = f"/tmp/ngt/calibrationYAML/{self.calibration_name}.yaml"
-        with open(calibration_config_path, "r") as f:
-            self.calib_config = yaml.safe_load(f)
-
         # Read some configurations
-        with open(f"{self.pathWhereFilesAppear}/ngtParameters.jsn", "r") as f:
-            config = json.load(f)
-        self.scramArch = config["SCRAM_ARCH"]
-        self.cmsswVersion = config["CMSSW_VERSION"]
-        self.globalTag = config["GLOBAL_TAG"]
+        self.ReadConfiguration()
 
+        self.setOfAvailableFiles = set()
         self.setOfFilesObserved = set()
         self.setOfFilesToProcess = set()
         self.setOfExpressFiles = set()
         self.setOfFilesProcessed = set()
         self.setOfExpectedOutputs = set()
 
-    def __init__(self, name):
+    def __init__(self, name, calibrationName, jobExecutor=None, runLister=None):
 
-        # No anonymous FSMs in my watch!
-        self.name = name
-        self.calibration_name = args.calibration
-        print(f"We are processing {self.calibration_name}.")
-        self.setOfRunsProcessed = set()
+        super().__init__(name, calibrationName, runLister)
+        # The ALCA jobs run through the job executor, which may be shared
+        # with the other steps and calibrations of the process
+        if jobExecutor is None:
+            jobExecutor = JobExecutor(reportFile="/tmp/ngt/NGTLoopStep3_jobs.jsonl")
+        self.jobExecutor = jobExecutor
+        # The runs whose end we announce once their last ALCA jobs are done
+        self.pendingRunEnds = {}
         self.ResetTheMachine()
+        # The same release area as the step 2 jobs
+        self.environmentScript = PrepareEnvironment(self.scramArch, self.cmsswVersion)
 
         # Initialize the state machine
         self.machine = Machine(
-            model=self, states=NGTLoopStep3.states, queued=True, initial="NotRunning"
+            model=self,
+            states=NGTLoopStep3.states,
+            queued=True,
+            initial="NotRunning",
+            after_state_change="TraceStateChange",
         )
 
         # Add some transitions. We could also define these using a static list of
@@ -464,29 +518,78 @@ class NGTLoopStep3(object):
         )
 
 
-loop = NGTLoopStep3("Step3")
-
-loop.state
-
-sleepTime = 60
-
-while True:
-    while loop.state == "NotRunning":
-        time.sleep(
-            sleepTime
-        )  # Should be close to 60 for deployment, close to 1 for testing
-        loop.TryLookForRun()
-
-    while loop.state == "WaitingForStep2Files":
-        loop.TryProcessFiles()
-        time.sleep(sleepTime)
-        loop.ContinueAfterCheckFiles()
-        time.sleep(sleepTime)
-        loop.TryPrepareALCAPROMPTJobs()
-        time.sleep(sleepTime)
-        loop.TryLaunchALCAPROMPTJobs()
-        time.sleep(sleepTime)
-        loop.ContinueToCleanup()
-        time.sleep(1)
-        loop.ContinueAfterCleanup()
-        time.sleep(1)
+
+# How often we look for new runs and for new files.
+# The local directory scans are cheap, so we can afford to be quick here.
+runPollIntervalInSeconds = 10
+# New files are announced by the witness-file watcher, this is only a safety net
+filePollIntervalInSeconds = 60
+# How often we look after the running ALCA jobs
+jobPollIntervalInSeconds = 5
+
+
+def LookForRun(loop):
+    loop.TryLookForRun()
+    # If we found a run, go look for its files right away
+    return loop.state != "NotRunning"
+
+
+def ProcessFiles(loop):
+    # The whole trigger chain runs back to back: the intermediate
+    # states are transient, there is nothing to wait for in between
+    numberOfFilesProcessed = len(loop.setOfFilesProcessed)
+    loop.TryProcessFiles()
+    loop.ContinueAfterCheckFiles()
+    loop.TryPrepareALCAPROMPTJobs()
+    loop.TryLaunchALCAPROMPTJobs()
+    loop.ContinueToCleanup()
+    loop.ContinueAfterCleanup()
+    # We made progress if we launched a job or if the run is over
+    return (
+        loop.state != "WaitingForStep2Files"
+        or len(loop.setOfFilesProcessed) > numberOfFilesProcessed
+    )
+
+
+def AddSources(scheduler, loop, prefix="", pollJobs=True):
+    # The scheduler sources of one step 3 loop. When several loops share the
+    # scheduler, the prefix keeps their names apart, since the file watcher
+    # wakes up its loop by name. pollJobs=False leaves the polling of a
+    # shared job executor to whoever owns it.
+    scheduler.AddSource(
+        prefix + "LookForRun",
+        lambda: LookForRun(loop),
+        runPollIntervalInSeconds,
+        when=lambda: loop.state == "NotRunning",
+    )
+    scheduler.AddSource(
+        prefix + "ProcessFiles",
+        lambda: ProcessFiles(loop),
+        filePollIntervalInSeconds,
+        when=lambda: loop.state == "WaitingForStep2Files",
+    )
+    loop.fileEventCallback = lambda: scheduler.Notify(prefix + "ProcessFiles")
+    if pollJobs:
+        scheduler.AddSource(
+            prefix + "PollJobs",
+            loop.jobExecutor.Poll,
+            jobPollIntervalInSeconds,
+            when=loop.jobExecutor.HasJobs,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs step3 of our calibration loop of a given calibration workflow.')
+    parser.add_argument('-c', '--calibration', type=str, help='Calibration workflow to process: e.g. SiStripBad or EcalPedestals.', required=True, choices=['SiStripBad', 'EcalPedestals'])
+    parser.add_argument('--metricsPort', type=int, help='Serve the metrics of the loop on http://localhost:<port>/metrics (default: no endpoint).', default=None)
+    args = parser.parse_args()
+
+    loop = NGTLoopStep3("Step3", args.calibration)
+    StartMetricsServer(args.metricsPort)
+    scheduler = EventScheduler()
+    AddSources(scheduler, loop)
+    scheduler.Run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,35 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
 import json
 import os
-import re
-import subprocess
 import time
-from datetime import datetime, timezone
-import yaml
 from pathlib import Path
 
 from transitions import Machine, State
 
+from NGTBatching import StatisticsGate
+from NGTConfigTemplates import WriteHistogramConversionConfig, WriteHistogramSumConfig
+from NGTEnvironment import PrepareEnvironment
+from NGTJobExecutor import JobExecutor
+from NGTLoopBase import INPUT_EVENTS_FILE_NAME, NGTLoopBase
+from NGTMetrics import METRICS, StartMetricsServer
+from NGTScheduler import EventScheduler
+from NGTUploader import PayloadUploader
+from NGTWatchers import WitnessWatcher
+
 os.environ["COND_AUTH_PATH"] = os.path.expanduser("/nfshome0/sakura")
 print("COND_AUTH_PATH set to:", os.environ["COND_AUTH_PATH"])
 
-import argparse
-parser = argparse.ArgumentParser(description='Runs step4 of our calibration loop of a given calibration workflow.')
-parser.add_argument('-c', '--calibration', type=str, help='Calibration workflow to process: e.g. SiStripBad or EcalPedestals.', required=True, choices=['SiStripBad', 'EcalPedestals'])
-args = parser.parse_args()
+METRICS.Gauge("ngt_seconds_since_last_upload", "Seconds since the last successful upload, per calibration.")
+METRICS.Gauge("ngt_uploads_pending", "Payloads waiting for the next upload session, per calibration.")
+METRICS.Gauge("ngt_uploads_in_flight", "Payloads of the upload session running now, per calibration.")
+METRICS.Gauge("ngt_harvest_events", "Events in the step 3 outputs of the run, per calibration and run.")
+METRICS.Gauge("ngt_harvest_next_events", "Events the run needs for its next harvest, per calibration and run.")
+
 
-class NGTLoopStep4(object):
+class NGTLoopStep4(NGTLoopBase):
 
     # Define some states.
     states = [
@@ -34,69 +43,41 @@ class NGTLoopStep4(object):
         State(name="CleanupState", on_enter="ExecuteCleanup"),
     ]
 
-    # We check if a new run appeared, e.g. /tmp/ngt/run386925
-    def NewRunAppeared(self):
-        print("Checking if a new run appeared")
-        path = Path(self.pathWhereFilesAppear)
-        currentDirs = {p.name for p in path.iterdir() if p.is_dir()}
-        newDirs = currentDirs - self.setOfRunsProcessed
-        newRuns = {p for p in newDirs if p.startswith("run")}
-        # Thiago: rig to run on 398600
-        # newRuns = {p for p in newDirs if p.startswith("run398600")}
-        foundNewRuns = not (not newRuns)  # Is this pythonic?
-        if foundNewRuns:
-            print("New runs found!")
-            # What happens if we found more than one run?
-            # We figure that out later...
-            # Slice off the "run" substring at the beginning
-            self.runNumber = (self.GetNextRun(newRuns))[3:]
-            print(f"Run {self.runNumber} is available")
-        else:
-            print("No new runs...")
-
-        return foundNewRuns
-
-    # For now, we just take the earliest of the new runs
-    def GetNextRun(self, newRuns):
-        return sorted(newRuns)[0]
+    idleTransitions = (
+        ("WaitingForFiles", "CheckingFilesForProcess"),
+        ("CheckingFilesForProcess", "WaitingForFiles"),
+    )
+    # We harvest the outputs of step 3, which may still be running when step 2 is done
+    runEndStep = 3
 
     def SetupNewRun(self):
-        # Prepare the new run
-        self.workingDir = self.pathWhereFilesAppear + "/run" + self.runNumber
-        startTimeFilePath = Path(self.workingDir + "/runStart.log")
-        if startTimeFilePath.exists():
-            with open(startTimeFilePath, "r") as f:
-                runStartLine = f.readline()
-                self.startTime = datetime.fromisoformat(runStartLine)
-        else:
-            # Weird, how come we don't have a runStart.log?
-            # Fine, we set the start time to now
-            print("We didn't find a runStart.log file... setting run start to NOW")
-            self.startTime = datetime.now(timezone.utc)
+        self.StartRun()
+        self.lastUploadTime = self.ledger.Counter(self.runNumber, "lastUploadTime")
+        self.setOfFilesMerged = {
+            Path(p) for p in self.ledger.Items(self.runNumber, "merged")
+        }
+        # Whether the payload of the last harvest never made it
+        failedJobs = {name for name, _ in self.ledger.Jobs(self.runNumber, "failed")}
+        self.lastHarvestFailed = (
+            self.alcaJobNumber > 0
+            and self.JobDirectory("harvestJob", self.alcaJobNumber - 1).name in failedJobs
+        )
 
-        print(f"Run {self.runNumber} detected, started at {self.startTime.isoformat()}")
+        # From now on, the step 3 witness files are reported to us as they
+        # appear in our apJobNNN directories
+        controlName = self.calib_config["step_4_config"]["step_3_witness_suffix"]
+        jobDirSuffix = "_" + self.calibration_name
+        self.witnessWatcher = WitnessWatcher(
+            self.workingDir,
+            lambda name: name == controlName,
+            subdirMatcher=lambda name: name.startswith("apJob") and name.endswith(jobDirSuffix),
+            callback=self.AnnounceNewFiles,
+        )
+        self.witnessWatcher.Start()
 
     def AnnounceWaitingForFiles(self):
         print("I am WaitingForFiles...")
 
-    def RunIsNotComplete(self):
-        print("Is the run complete?")
-        runEndedFile = Path(self.workingDir + "/runEnd.log")
-        if runEndedFile.exists():
-            print("The run is complete!")
-        else:
-            print("Not yet...")
-        return not runEndedFile.exists()
-
-    def StillHaveTime(self):
-        now_utc = datetime.now(timezone.utc)
-        diff = now_utc - self.startTime
-        if diff.total_seconds() > self.timeoutInSeconds:
-            print("Time ran out!")
-            return False
-        else:
-            return True
-
     def CheckFilesForProcessing(self):
         print("I am in CheckFilesForProcessing...")
         # Do something to check if there are Files to process
@@ -115,40 +96,44 @@ class NGTLoopStep4(object):
         else:
             self.enoughFiles = False
 
-    # This function only looks at a given path and lists
-    # all available files of the form "PromptCalibProdEcalPedestals.root".
+    # This function keeps the set of all available files of the form
+    # "PromptCalibProdEcalPedestals.root".
     # Notice, however, that "available" here means
     # "the ROOT files are closed and ready to be used"!
     # So, we list files of the form
     # "ecalPedsStep3_job.txt". If we find those,
     # we lop off that suffix and substitute it for "PromptCalibProdEcalPedestals.root"
+    # The witness watcher only hands us the control files that appeared
+    # since the last call, so we never walk the apJob directories again.
     def GetSetOfAvailableFiles(self):
-        # For this version, self.pathWhereFilesAppear is the same as
-        # self.workingDir
-        targetPath = Path(self.workingDir)
         conf = self.calib_config["step_4_config"]
         controlName = conf["step_3_witness_suffix"]
         targetName = conf["step_3_root_filename"]
-        setOfControlFiles = {p for p in targetPath.rglob(controlName)}
-        setOfAvailableFiles = set()
-        as_strings = {str(p) for p in setOfControlFiles}
-        changed = {
-            s[: -len(controlName)] + targetName if s.endswith(controlName) else s
-            for s in as_strings
-        }
-        setOfAvailableFiles = {Path(s) for s in changed}
-
-        return setOfAvailableFiles
-
-    def ExecutePrepareFiles(self):
-        print("I am PreparingFiles")
-        self.PrepareFilesForProcessing()
-
-    def ExecutePrepareFinalFiles(self):
-        print("I am PreparingFinalFiles")
-        self.PrepareFilesForProcessing()
-        # Since this is final files, they have to be enough!
-        self.preparedFinalFiles = True
+        for s in self.witnessWatcher.NewFiles():
+            path = Path(s[: -len(controlName)] + targetName)
+            self.setOfAvailableFiles.add(path)
+            if self.statisticsGate is not None:
+                self.eventsOfFiles[path] = self.ReadInputEvents(path.parent)
+
+        return set(self.setOfAvailableFiles)
+
+    def ReadInputEvents(self, jobDir):
+        # The number of events step 3 counted in the inputs of the job,
+        # None if it could not
+        try:
+            with open(jobDir / INPUT_EVENTS_FILE_NAME, "r") as f:
+                return json.load(f).get("events")
+        except (OSError, ValueError) as e:
+            print(f"Could not read the number of events of {jobDir}: {e}")
+            return None
+
+    def RunEvents(self):
+        # The events of all the step 3 outputs of the run so far, which every
+        # harvest processes. None if we don't know them all.
+        events = [self.eventsOfFiles.get(path) for path in self.setOfAvailableFiles]
+        if None in events:
+            return None
+        return sum(events)
 
     def PrepareFilesForProcessing(self):
         print("I am in PrepareFilesForProcessing...")
@@ -178,19 +163,56 @@ class NGTLoopStep4(object):
         # There are better ways to do this, but right now I just do it with a file
 
         # First make a particular subdir for us to run in
-        alcaJobDir = Path(self.workingDir + "/harvestJob" + f"{self.alcaJobNumber:03}")
+        alcaJobDir = self.JobDirectory("harvestJob", self.alcaJobNumber)
         alcaJobDir.mkdir(parents=True, exist_ok=True)
         os.chmod(alcaJobDir, 0o777)
         # Save it so that we can use it later
         self.jobDir = str(alcaJobDir)
         alcaJobFile = alcaJobDir / Path("HARVESTING.sh")
 
+        # The histograms-so-far file of the previous harvesting job, if any
+        previousHistograms = None
+        if self.alcaJobNumber > 0:
+            previousHistograms = str(self.JobDirectory("harvestJob", self.alcaJobNumber - 1) / "histogramsSoFar.root")
+
         # At this point, we already increase the self.alcaJobNumber
         self.alcaJobNumber += 1
 
         conf_step4 = self.calib_config["step_4_config"]
         conf_driver = conf_step4["cms_driver"]
         conf_upload = conf_step4["upload_metadata"]
+        # In incremental mode we don't harvest all the files of the run every
+        # time: each job turns its new files into histograms, adds them to the
+        # histograms-so-far of the previous job, and only harvests that sum,
+        # whose size does not grow with the run
+        incremental = conf_step4.get("incremental_harvesting") or None
+        if incremental is True:
+            incremental = {}
+        # The step 3 outputs the previous job did not fold in yet. None may be
+        # left, e.g. for the final harvest after a harvest that failed once
+        # its histograms were summed: we harvest those histograms again.
+        newFiles = self.setOfExpressFiles - self.setOfFilesMerged
+        if incremental is not None:
+            metoedmProducer = incremental.get("metoedm_producer", "MEtoEDMConverter")
+            if previousHistograms is not None and newFiles:
+                WriteHistogramConversionConfig(
+                    str(alcaJobDir / "TODQM.py"),
+                    newFiles,
+                    metoedmProducer,
+                    "newHistograms.root",
+                )
+                WriteHistogramSumConfig(
+                    str(alcaJobDir / "SUM.py"),
+                    [previousHistograms, "newHistograms.root"],
+                    "histogramsSoFar.tmp.root",
+                )
+            # From scratch, for the first job or if the previous one failed
+            WriteHistogramConversionConfig(
+                str(alcaJobDir / "TODQM_ALL.py"),
+                self.setOfExpressFiles,
+                metoedmProducer,
+                "histogramsSoFar.tmp.root",
+            )
 
         
         # Write the metadata for the upload
@@ -208,20 +230,37 @@ class NGTLoopStep4(object):
         # Write the job file
         with alcaJobFile.open("w") as f:
             f.write("#!/bin/bash -ex\n\n")
-            # First we go to the CMSSWPath to setup CMSSW
-            f.write(f"export $SCRAM_ARCH={self.scramArch}\n")
-            f.write(f"cd {self.CMSSWPath}/{self.cmsswVersion}/src\n")
-            f.write("cmsenv\n")
-            f.write("cd -\n\n")
+            # The environment of the release in CMSSWPath is cached, we just source it
+            f.write(f"source {self.environmentScript}\n\n")
+            if incremental is not None:
+                if previousHistograms is not None:
+                    f.write(f"if [ -f {previousHistograms} ]; then\n")
+                    if newFiles:
+                        f.write("  cmsRun TODQM.py > todqm.log 2>&1 || exit 1\n")
+                        f.write("  cmsRun SUM.py > sum.log 2>&1 || exit 1\n")
+                    else:
+                        # Nothing to add: an empty PoolSource would fail
+                        f.write(f"  cp {previousHistograms} histogramsSoFar.tmp.root\n")
+                    f.write("else\n")
+                    f.write("  cmsRun TODQM_ALL.py > todqm.log 2>&1 || exit 1\n")
+                    f.write("fi\n")
+                else:
+                    f.write("cmsRun TODQM_ALL.py > todqm.log 2>&1 || exit 1\n")
+                # The next job only starts from our histograms once they are complete
+                f.write("mv histogramsSoFar.tmp.root histogramsSoFar.root\n\n")
+                str_paths = {"file:histogramsSoFar.root"}
+            else:
+                # some massaging to go from PosixPath to string
+                str_paths = {"file:" + str(p) for p in self.setOfExpressFiles}
             # Now we do the cmsDriver.py proper
             python_filename = f"run{self.runNumber}{conf_driver['python_filename_affix']}.py"
             f.write(f"cmsDriver.py expressStep4 --conditions {self.globalTag} ")
             f.write(f" -s {conf_driver['step']} --scenario {conf_driver['scenario']} --data ")
             # and we pass the list of files to process (self.setOfFilesToProcess)
             f.write(" --filein ")
-            # some massaging to go from PosixPath to string
-            str_paths = {"file:" + str(p) for p in self.setOfExpressFiles}
             f.write(",".join(str_paths))
+            if incremental is not None:
+                f.write(" --filetype DQM")
             # set a known python_filename
             f.write(" -n -1 --no_exec ")
             f.write(f"--python_filename {python_filename}\n\n")
@@ -241,27 +280,19 @@ class NGTLoopStep4(object):
             f.write(f"mv promptCalibConditions.db {final_db_name}\n")
             metadata_file = conf_step4["metadata_filename"]
             f.write(f'if [ -f "{metadata_file}" ]; then echo "Metadata file exists!"; else echo "Metadata file missing"; fi\n')
-            # We should upload...
-            f.write(f"uploadConditions.py {final_db_name}")
+            # The upload stage takes it from here, once the job is done
+            f.write(f'if [ ! -f "{final_db_name}" ]; then exit 1; fi\n')
 
     def LaunchExpressJobs(self):
         print("I am in LaunchExpressJobs...")
 
         # Here we should launch the Express jobs
-        # We use subprocess.Popen, since we don't want to hang waiting for this
-        # to finish running. Some other loop will look at their output
+        # The job executor runs them without us hanging, and tells us when
+        # they are done, so that we never have two harvests of a run at once
         if self.jobDir != "/dev/null" and len(self.setOfExpressFiles) != 0:
-            with open(self.jobDir + "/stdout.log", "w") as out, open(
-                self.jobDir + "/stderr.log", "w"
-            ) as err:
-                subprocess.Popen(
-                    ["bash", "HARVESTING.sh"],
-                    cwd=self.jobDir,
-                    stdout=out,
-                    stderr=err,
-                    preexec_fn=os.setsid,  # Unix-only; detaches session
-                    close_fds=True,
-                )
+            self.SubmitHarvest(
+                self.runNumber, self.jobDir, sorted(str(p) for p in self.setOfExpressFiles)
+            )
         else:
             print("WARNING: not launching Express jobs!")
 
@@ -271,18 +302,134 @@ class NGTLoopStep4(object):
         # and setOfExpressFiles
         print("Launched jobs with:")
         print(self.setOfExpressFiles)
+        self.ledger.Record(
+            self.runNumber,
+            items={"file": self.setOfFilesToProcess, "merged": self.setOfExpressFiles},
+            counters={"alcaJobNumber": self.alcaJobNumber},
+        )
+        # What the job we just launched folds into its histograms-so-far file
+        self.setOfFilesMerged = set(self.setOfExpressFiles)
         self.setOfFilesProcessed = self.setOfFilesProcessed.union(
             self.setOfFilesToProcess
         )
         self.setOfFilesToProcess = set()
         self.setOfExpressFiles = set()
 
-    def ThereAreFilesWaiting(self):
-        if self.waitingFiles:
-            print("++ There are Files waiting!")
+    def SubmitHarvest(self, runNumber, jobDir, inputs):
+        jobName = Path(jobDir).name
+        conf_step4 = self.calib_config["step_4_config"]
+        dbFile = Path(jobDir) / conf_step4["final_db_name"]
+        metadataFile = Path(jobDir) / conf_step4["metadata_filename"]
+        inputTag = conf_step4["upload_metadata"]["inputTag"]
+
+        def OnFinish(job):
+            del self.harvestsInFlight[runNumber]
+            status = "done" if job.exitCode == 0 else "failed"
+            self.ledger.RecordJob(runNumber, jobName, status)
+            if runNumber == self.runNumber:
+                self.lastHarvestFailed = job.exitCode != 0
+            if job.exitCode == 0 and dbFile.exists():
+                # The payload joins the upload queue
+                self.uploader.Add(runNumber, dbFile, metadataFile, inputTag)
+            # The files that arrived in the meantime can go now
+            if self.fileEventCallback is not None:
+                self.fileEventCallback()
+
+        # The trace follows the step 3 outputs into the payload we upload
+        onStart, onFinish = self.tracer.JobCallbacks(
+            runNumber, jobName, onFinish=OnFinish, inputs=inputs, outputs=[str(dbFile)],
+            events=self.RunEvents(),
+        )
+        self.harvestsInFlight[runNumber] = self.jobExecutor.Submit(
+            f"run{runNumber}/{jobName}",
+            ["bash", "HARVESTING.sh"],
+            cwd=jobDir,
+            slots=1,
+            stdout=jobDir + "/stdout.log",
+            stderr=jobDir + "/stderr.log",
+            onStart=onStart,
+            onFinish=onFinish,
+            group=f"{self.calibration_name}/{runNumber}",
+            kind="harvest",
+            deadline=self.Deadline(),
+        )
+        self.ledger.RecordJob(runNumber, jobName, "running", {"jobDir": jobDir})
+
+    def RecordUpload(self, runs, uploadTime):
+        # Called by the uploader once the payloads of these runs are in
+        for runNumber in runs:
+            self.ledger.Record(runNumber, counters={"lastUploadTime": uploadTime})
+        if self.runNumber in runs:
+            self.lastUploadTime = uploadTime
+        if self.fileEventCallback is not None:
+            self.fileEventCallback()
+
+    def Metrics(self):
+        labels = {"calibration": self.calibration_name}
+        samples = super().Metrics() + [
+            ("ngt_uploads_pending", labels, len(self.uploader.state["pending"])),
+            ("ngt_uploads_in_flight", labels, len(self.uploader.state["inFlight"])),
+        ]
+        lastUploadTime = self.uploader.state.get("lastUploadTime")
+        if lastUploadTime:
+            samples.append(("ngt_seconds_since_last_upload", labels, time.time() - lastUploadTime))
+        if self.statisticsGate is not None and self.state != "NotRunning":
+            runLabels = dict(labels, run=str(self.runNumber))
+            events = self.RunEvents()
+            if events is not None:
+                samples.append(("ngt_harvest_events", runLabels, events))
+            samples.append(("ngt_harvest_next_events", runLabels, self.statisticsGate.Threshold(self.alcaJobNumber)))
+        return samples
+
+    def AHarvestIsInFlight(self):
+        # At most one harvest per run at a time: the files that arrive
+        # while it runs are all collapsed into the next one
+        inFlight = self.runNumber in self.harvestsInFlight
+        if inFlight:
+            print(f"++ The harvest of run {self.runNumber} is still running, new files wait for the next one")
+        return inFlight
+
+    def SecondsUntilUploadAllowed(self):
+        return max(0, self.lastUploadTime + self.minimumUploadIntervalInSeconds - time.time())
+
+    def HarvestCanStart(self):
+        if self.AHarvestIsInFlight():
+            return False
+        wait = self.SecondsUntilUploadAllowed()
+        if wait > 0:
+            print(f"++ Last upload was too recent, next harvest in {wait:.0f} s")
+        return wait == 0
+
+    def StatisticsAreEnough(self):
+        # The first harvest of the run waits for enough events, and every
+        # next one for backoff_factor times more. The end of the run does not
+        # wait: it always gets its final harvest.
+        if self.statisticsGate is None:
+            return True
+        events = self.RunEvents()
+        threshold = self.statisticsGate.Threshold(self.alcaJobNumber)
+        if self.statisticsGate.IsOpen(events, self.alcaJobNumber):
+            print(f"++ Enough statistics for harvest {self.alcaJobNumber}: {events} events (threshold {threshold})")
+            return True
+        print(f"++ Not enough statistics for harvest {self.alcaJobNumber}: {events}/{threshold} events")
+        return False
+
+    def SomethingIsLeftToHarvest(self):
+        # The end of the run only gets its final harvest if some step 3
+        # outputs are not in a harvest yet, or if the last one failed:
+        # otherwise its payload would be the one we already uploaded
+        unmerged = self.setOfFilesToProcess - self.setOfFilesMerged
+        if unmerged:
+            print(f"++ {len(unmerged)} file(s) left for the final harvest")
+        elif self.lastHarvestFailed:
+            print("++ The last harvest failed, the final harvest does it again")
         else:
-            print("++ No Files waiting...")
-        return self.waitingFiles
+            print("++ Every file is in the last harvest, no final harvest needed")
+        return bool(unmerged) or self.lastHarvestFailed
+
+    def SkipFinalHarvest(self):
+        # The run is over all the same
+        self.preparedFinalFiles = True
 
     def ThereAreEnoughFiles(self):
         if self.enoughFiles:
@@ -291,9 +438,6 @@ class NGTLoopStep4(object):
             print("++ Not enough input files...")
         return self.enoughFiles
 
-    def WePreparedFinalFiles(self):
-        return self.preparedFinalFiles
-
     def ExecuteCleanup(self):
         print("I am in ExecuteCleanup")
         if self.preparedFinalFiles:
@@ -304,6 +448,7 @@ class NGTLoopStep4(object):
             with open(self.workingDir + "/allStep3FilesProcessed.log", "w") as f:
                 for Files in sorted(self.setOfFilesProcessed):
                     f.write(str(Files) + "\n")
+            self.ledger.CloseRun(self.runNumber)
             # Add the run we have just seen to our memory
             # If is easier to just add the "run" prefix here
             self.setOfRunsProcessed.add("run" + self.runNumber)
@@ -311,6 +456,7 @@ class NGTLoopStep4(object):
 
     def ResetTheMachine(self):
         print("Machine reset!")
+        self.StopWatchingFiles()
         self.runNumber = 0
         self.startTime = 0
         self.timeoutInSeconds = 8 * 60 * 60  # 8 hours
@@ -321,37 +467,60 @@ class NGTLoopStep4(object):
         self.workingDir = "/dev/null"
         self.jobDir = "/dev/null"
         self.alcaJobNumber = 0
+        self.lastUploadTime = 0
+        self.lastHarvestFailed = False
         self.preparedFinalFiles = False
-        calibration_config_path = f"/tmp/ngt/calibrationYAML/{self.calibration_name}.yaml"
-        with open(calibration_config_path, "r") as f:
-            self.calib_config = yaml.safe_load(f)
-        self.CMSSWPath = self.calib_config["step_4_config"]["cmssw_base_path"]
-
         # Read some configurations
-        with open(f"{self.pathWhereFilesAppear}/ngtParameters.jsn", "r") as f:
-            config = json.load(f)
-        self.scramArch = config["SCRAM_ARCH"]
-        self.cmsswVersion = config["CMSSW_VERSION"]
-        self.globalTag = config["GLOBAL_TAG"]
+        self.ReadConfiguration()
+        self.minimumUploadIntervalInSeconds = self.calib_config["step_4_config"].get(
+            "min_upload_interval_seconds", 0
+        )
+        self.CMSSWPath = self.calib_config["step_4_config"]["cmssw_base_path"]
+        # The harvests wait for enough statistics, if the calibration says so
+        self.statisticsGate = StatisticsGate.FromConfig(
+            self.calib_config["step_4_config"].get("statistics_gate")
+        )
+        # Number of events of each step 3 output, for the statistics gate
+        self.eventsOfFiles = {}
 
+        self.setOfAvailableFiles = set()
         self.setOfFilesObserved = set()
         self.setOfFilesToProcess = set()
         self.setOfExpressFiles = set()
         self.setOfFilesProcessed = set()
+        self.setOfFilesMerged = set()
         self.setOfExpectedOutputs = set()
 
-    def __init__(self, name):
+    def __init__(self, name, calibrationName, jobExecutor=None, runLister=None):
 
-        # No anonymous FSMs in my watch!
-        self.name = name
-        self.calibration_name = args.calibration
-        print(f"We are processing {self.calibration_name}.")
-        self.setOfRunsProcessed = set()
+        super().__init__(name, calibrationName, runLister)
+        # The harvests run through the job executor, at most one per run.
+        # It may be shared with the other steps and calibrations of the process.
+        if jobExecutor is None:
+            jobExecutor = JobExecutor(reportFile="/tmp/ngt/NGTLoopStep4_jobs.jsonl")
+        self.jobExecutor = jobExecutor
+        self.harvestsInFlight = {}
         self.ResetTheMachine()
+        # Harvesting runs in the release of CMSSWPath, whose environment we cache
+        self.environmentScript = PrepareEnvironment(
+            self.scramArch, self.cmsswVersion, releaseBase=self.CMSSWPath
+        )
+        # The payloads are uploaded asynchronously, batched and deduplicated
+        self.uploader = PayloadUploader(
+            self.calibration_name,
+            self.jobExecutor,
+            self.environmentScript,
+            onUploaded=self.RecordUpload,
+            tracer=self.tracer,
+        )
 
         # Initialize the state machine
         self.machine = Machine(
-            model=self, states=NGTLoopStep4.states, queued=True, initial="NotRunning"
+            model=self,
+            states=NGTLoopStep4.states,
+            queued=True,
+            initial="NotRunning",
+            after_state_change="TraceStateChange",
         )
 
         # Add some transitions. We could also define these using a static list of
@@ -400,7 +569,7 @@ class NGTLoopStep4(object):
             trigger="ContinueAfterCheckFiles",
             source="CheckingFilesForProcess",
             dest="PreparingFiles",
-            conditions=["ThereAreFilesWaiting", "ThereAreEnoughFiles"],
+            conditions=["ThereAreFilesWaiting", "ThereAreEnoughFiles", "StatisticsAreEnough", "HarvestCanStart"],
         )
 
         # If we don't have enough Files, but we are still running,
@@ -413,8 +582,26 @@ class NGTLoopStep4(object):
             conditions=["RunIsNotComplete", "StillHaveTime"],
         )
 
+        # Even at the end of the run, the last harvest waits for the one
+        # in flight, so that the payloads are uploaded in order
+        self.machine.add_transition(
+            trigger="ContinueAfterCheckFiles",
+            source="CheckingFilesForProcess",
+            dest="WaitingForFiles",
+            conditions=["AHarvestIsInFlight"],
+        )
+
         # If we don't have enough Files, and we are not still running,
-        # no more Files will come. We go to PreparingFinalFiles
+        # no more Files will come. If the last harvest already had all of
+        # them, we are done: straight to the cleanup
+        self.machine.add_transition(
+            trigger="ContinueAfterCheckFiles",
+            source="CheckingFilesForProcess",
+            dest="CleanupState",
+            unless=["SomethingIsLeftToHarvest"],
+            before="SkipFinalHarvest",
+        )
+        # Otherwise we go to PreparingFinalFiles
         self.machine.add_transition(
             trigger="ContinueAfterCheckFiles",
             source="CheckingFilesForProcess",
@@ -445,6 +632,10 @@ class NGTLoopStep4(object):
             dest="CleanupState",
         )
 
+        # Without a final harvest, there are no jobs to prepare or launch
+        for trigger in ("TryPrepareHarvestingJobs", "TryLaunchHarvestingJobs", "ContinueToCleanup"):
+            self.machine.add_transition(trigger=trigger, source="CleanupState", dest=None)
+
         # All other triggers take you from WaitingForFiles to WaitingForFiles if need be
         self.machine.add_transition(
             trigger="TryPrepareHarvestingJobs",
@@ -468,29 +659,90 @@ class NGTLoopStep4(object):
         )
 
 
-loop = NGTLoopStep4("Step4")
-
-loop.state
-
-sleepTime = 60
-
-while True:
-    while loop.state == "NotRunning":
-        time.sleep(
-            sleepTime
-        )  # Should be close to 60 for deployment, close to 1 for testing
-        loop.TryLookForRun()
-
-    while loop.state == "WaitingForFiles":
-        loop.TryProcessFiles()
-        time.sleep(sleepTime)
-        loop.ContinueAfterCheckFiles()
-        time.sleep(sleepTime)
-        loop.TryPrepareHarvestingJobs()
-        time.sleep(sleepTime)
-        loop.TryLaunchHarvestingJobs()
-        time.sleep(sleepTime)
-        loop.ContinueToCleanup()
-        time.sleep(sleepTime)
-        loop.ContinueAfterCleanup()
-        time.sleep(sleepTime)
+
+# How often we look for new runs and for new files.
+# The local directory scans are cheap, so we can afford to be quick here.
+runPollIntervalInSeconds = 10
+# New files are announced by the witness-file watcher, this is only a safety net
+filePollIntervalInSeconds = 60
+# How often we look after the running harvests and uploads
+jobPollIntervalInSeconds = 5
+# How often we retry failed uploads
+uploadRetryIntervalInSeconds = 60
+
+
+def FilePollInterval(loop):
+    # If we hold a harvest back because of the upload interval, we come
+    # back exactly when it is allowed
+    wait = loop.SecondsUntilUploadAllowed()
+    return min(wait, filePollIntervalInSeconds) if wait > 0 else filePollIntervalInSeconds
+
+
+def LookForRun(loop):
+    loop.TryLookForRun()
+    # If we found a run, go look for its files right away
+    return loop.state != "NotRunning"
+
+
+def ProcessFiles(loop):
+    # The whole trigger chain runs back to back: the intermediate
+    # states are transient, there is nothing to wait for in between
+    numberOfFilesProcessed = len(loop.setOfFilesProcessed)
+    loop.TryProcessFiles()
+    loop.ContinueAfterCheckFiles()
+    loop.TryPrepareHarvestingJobs()
+    loop.TryLaunchHarvestingJobs()
+    loop.ContinueToCleanup()
+    loop.ContinueAfterCleanup()
+    # We made progress if we launched a job or if the run is over
+    return (
+        loop.state != "WaitingForFiles"
+        or len(loop.setOfFilesProcessed) > numberOfFilesProcessed
+    )
+
+
+def AddSources(scheduler, loop, prefix="", pollJobs=True):
+    # The scheduler sources of one step 4 loop, see NGTLoopStep3.AddSources
+    scheduler.AddSource(
+        prefix + "LookForRun",
+        lambda: LookForRun(loop),
+        runPollIntervalInSeconds,
+        when=lambda: loop.state == "NotRunning",
+    )
+    scheduler.AddSource(
+        prefix + "ProcessFiles",
+        lambda: ProcessFiles(loop),
+        lambda: FilePollInterval(loop),
+        when=lambda: loop.state == "WaitingForFiles",
+    )
+    loop.fileEventCallback = lambda: scheduler.Notify(prefix + "ProcessFiles")
+    if pollJobs:
+        scheduler.AddSource(
+            prefix + "PollJobs",
+            loop.jobExecutor.Poll,
+            jobPollIntervalInSeconds,
+            when=loop.jobExecutor.HasJobs,
+        )
+    scheduler.AddSource(
+        prefix + "Upload",
+        loop.uploader.Flush,
+        uploadRetryIntervalInSeconds,
+        when=loop.uploader.HasPending,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs step4 of our calibration loop of a given calibration workflow.')
+    parser.add_argument('-c', '--calibration', type=str, help='Calibration workflow to process: e.g. SiStripBad or EcalPedestals.', required=True, choices=['SiStripBad', 'EcalPedestals'])
+    parser.add_argument('--metricsPort', type=int, help='Serve the metrics of the loop on http://localhost:<port>/metrics (default: no endpoint).', default=None)
+    args = parser.parse_args()
+
+    loop = NGTLoopStep4("Step4", args.calibration)
+    StartMetricsServer(args.metricsPort)
+    scheduler = EventScheduler()
+    AddSources(scheduler, loop)
+    scheduler.Run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Metrics of the NGT calibration loop, in the Prometheus text format.
+#
+# The loops (or the engine) serve them on a local HTTP endpoint, which a
+# Prometheus server can scrape, or that we can simply look at with curl:
+#   curl -s localhost:9400/metrics
+# Counters and histograms (job durations, OMS and xrdfs latencies) are updated
+# as things happen. The gauges (queue depths, running jobs, time since the
+# last upload) are collected from the loops when the endpoint is scraped.
+
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In seconds: from a quick OMS query to a long cmsRun job
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def LabelString(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def FormatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        # sorted label items -> value
+        self.values = {}
+
+    def Inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def Samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Histogram(object):
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # sorted label items -> (counts per bucket, sum, count)
+        self.values = {}
+
+    def Observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def Time(self, **labels):
+        # with histogram.Time(resource="runs"): ...
+        return HistogramTimer(self, labels)
+
+    def Samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, n in zip(self.buckets, counts):
+                    samples.append((self.name + "_bucket", key + (("le", FormatValue(float(bound))),), n))
+                samples.append((self.name + "_bucket", key + (("le", "+Inf"),), count))
+                samples.append((self.name + "_sum", key, total))
+                samples.append((self.name + "_count", key, count))
+        return samples
+
+
+class HistogramTimer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.Observe(time.monotonic() - self.start, **self.labels)
+        return False
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> Counter or Histogram
+        self.metrics = {}
+        # name -> help of the gauges that the collectors report
+        self.gauges = {}
+        self.collectors = []
+
+    def Counter(self, name, help):
+        with self.lock:
+            return self.metrics.setdefault(name, Counter(name, help))
+
+    def Histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        with self.lock:
+            return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def Gauge(self, name, help):
+        self.gauges[name] = help
+
+    def AddCollector(self, collector):
+        # collector() returns the current (name, labels dict, value) of some gauges
+        with self.lock:
+            self.collectors.append(collector)
+
+    def Exposition(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors)
+        for metric in metrics:
+            samples = metric.Samples()
+            if not samples:
+                continue
+            kind = "counter" if isinstance(metric, Counter) else "histogram"
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{LabelString(labels)} {FormatValue(value)}")
+
+        # The gauges are read from the loops, which keep running meanwhile:
+        # a collector that trips over a change is skipped for this scrape
+        gauges = {}
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                logging.warning(f"Could not collect metrics from {collector}: {e}")
+        for name, samples in sorted(gauges.items()):
+            lines.append(f"# HELP {name} {self.gauges.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{LabelString(labels)} {FormatValue(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of the whole process: every module declares its own here
+METRICS = MetricsRegistry()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    registry = METRICS
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.Exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every scrape would end up in the logs otherwise
+        logging.debug(f"Metrics endpoint: {format % args}")
+
+
+def StartMetricsServer(port, host="127.0.0.1", registry=METRICS):
+    # Serves the metrics on http://host:port/metrics from a background
+    # thread. Returns the server, or None if no port was given.
+    if not port:
+        return None
+    handler = type("Handler", (MetricsRequestHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
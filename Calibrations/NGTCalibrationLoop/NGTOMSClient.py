@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# A long-lived OMS client for the NGT calibration loop.
+#
+# One object is shared by all the FSM predicates: it keeps a persistent HTTP
+# session, caches the per-run records for a short time (so that one fetch
+# serves every predicate within a tick), spaces out the requests and retries
+# failed ones with an exponential backoff. The URL is configurable, so it can
+# be pointed to a local stub server.
+
+import logging
+import threading
+import time
+
+import requests
+import urllib3
+
+from NGTMetrics import METRICS
+
+OMS_URL = "https://cmsoms.cms/agg/api"
+OMS_VERSION = "v1"
+
+omsRequestSeconds = METRICS.Histogram("ngt_oms_request_seconds", "Latency of the OMS requests, per resource.")
+omsRequestFailures = METRICS.Counter("ngt_oms_request_failures_total", "Failed OMS requests (before any retry), per resource.")
+
+
+class OMSError(Exception):
+    pass
+
+
+class OMSClient(object):
+
+    def __init__(
+        self,
+        url=OMS_URL,
+        version=OMS_VERSION,
+        verify=False,
+        runRecordTTL=10,
+        minRequestInterval=0.5,
+        maxRetries=3,
+        backoffSeconds=1,
+        timeout=30,
+    ):
+        self.baseUrl = f"{url.rstrip('/')}/{version}"
+        self.verify = verify
+        self.runRecordTTL = runRecordTTL
+        self.minRequestInterval = minRequestInterval
+        self.maxRetries = maxRetries
+        self.backoffSeconds = backoffSeconds
+        self.timeout = timeout
+        if not verify:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.lastRequestTime = 0
+        # run_number -> (fetch time, attributes)
+        self.runCache = {}
+        self.numberOfRequests = 0
+
+    def BuildParams(self, filters=None, sort=None, asc=True, page=1, perPage=None):
+        # Same query string as the omsapi client builds
+        params = {}
+        for attribute, value in (filters or {}).items():
+            params[f"filter[{attribute}][EQ]"] = value
+        if sort is not None:
+            params["sort"] = sort if asc else f"-{sort}"
+        if perPage is not None:
+            params["page[offset]"] = (page - 1) * perPage
+            params["page[limit]"] = perPage
+        return params
+
+    def WaitForRateLimit(self):
+        elapsed = time.monotonic() - self.lastRequestTime
+        if elapsed < self.minRequestInterval:
+            time.sleep(self.minRequestInterval - elapsed)
+        self.lastRequestTime = time.monotonic()
+
+    def Get(self, resource, **query):
+        url = f"{self.baseUrl}/{resource}"
+        params = self.BuildParams(**query)
+        lastError = None
+        for attempt in range(self.maxRetries + 1):
+            if attempt > 0:
+                delay = self.backoffSeconds * 2 ** (attempt - 1)
+                logging.warning(
+                    f"OMS query {resource} failed ({lastError}), retrying in {delay} s"
+                )
+                time.sleep(delay)
+            with self.lock:
+                self.WaitForRateLimit()
+                self.numberOfRequests += 1
+                try:
+                    with omsRequestSeconds.Time(resource=resource):
+                        response = self.session.get(
+                            url, params=params, verify=self.verify, timeout=self.timeout
+                        )
+                except requests.RequestException as e:
+                    omsRequestFailures.Inc(resource=resource)
+                    lastError = e
+                    continue
+            if response.status_code != 200:
+                omsRequestFailures.Inc(resource=resource)
+            # Server-side trouble is worth a retry, client errors are not
+            if response.status_code == 429 or response.status_code >= 500:
+                lastError = f"HTTP {response.status_code}"
+                continue
+            if response.status_code != 200:
+                raise OMSError(f"OMS query {resource} returned HTTP {response.status_code}")
+            try:
+                return response.json()
+            except ValueError as e:
+                # e.g. an SSO login page or a truncated body: worth a retry too
+                omsRequestFailures.Inc(resource=resource)
+                lastError = f"invalid JSON ({e})"
+        raise OMSError(f"OMS query {resource} failed after {self.maxRetries} retries: {lastError}")
+
+    def CacheRuns(self, records):
+        now = time.monotonic()
+        for record in records:
+            attributes = record["attributes"]
+            self.runCache[int(attributes["run_number"])] = (now, attributes)
+
+    def GetRun(self, runNumber, maxAge=None):
+        # Returns the attributes of a run, or None if OMS does not know it
+        maxAge = self.runRecordTTL if maxAge is None else maxAge
+        cached = self.runCache.get(int(runNumber))
+        if cached is not None and time.monotonic() - cached[0] < maxAge:
+            return cached[1]
+        response = self.Get("runs", filters={"run_number": runNumber})
+        if "data" not in response or not response["data"]:
+            return None
+        self.CacheRuns(response["data"])
+        return response["data"][0]["attributes"]
+
+    def GetRuns(self, filters, perPage=50):
+        # The most recent runs matching the filters, newest first.
+        # Every run we get back also refreshes the per-run cache.
+        response = self.Get(
+            "runs", filters=filters, sort="run_number", asc=False, page=1, perPage=perPage
+        )
+        records = response.get("data") or []
+        self.CacheRuns(records)
+        return records
+
+    def Invalidate(self, runNumber=None):
+        if runNumber is None:
+            self.runCache = {}
+        else:
+            self.runCache.pop(int(runNumber), None)
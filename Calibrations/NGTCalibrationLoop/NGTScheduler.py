@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Event-driven scheduler for the NGT calibration loops.
+#
+# Instead of firing the FSM triggers with a fixed sleep in between, every
+# piece of work is a "source": a callback with an explicit polling interval,
+# active only while a predicate holds (e.g. while the FSM is NotRunning).
+# A source runs again right away as long as it makes progress, and can be
+# woken up from another thread (e.g. by a file watcher) through Notify().
+
+import logging
+import threading
+import time
+
+
+class Source(object):
+
+    def __init__(self, name, callback, interval, when=None):
+        self.name = name
+        self.callback = callback
+        # Either a number of seconds, or a callable returning one
+        self.interval = interval
+        self.when = when
+        self.nextDue = 0
+        # Bumped by every Notify(), so that a wake-up arriving while the
+        # callback runs is not lost
+        self.generation = 0
+
+    def IsActive(self):
+        return self.when is None or self.when()
+
+    def Interval(self):
+        return self.interval() if callable(self.interval) else self.interval
+
+
+class EventScheduler(object):
+
+    def __init__(self, maxSleep=60):
+        self.sources = []
+        self.maxSleep = maxSleep
+        self.wakeUp = threading.Event()
+        self.lock = threading.Lock()
+        self.stopRequested = False
+
+    def AddSource(self, name, callback, interval, when=None):
+        source = Source(name, callback, interval, when)
+        self.sources.append(source)
+        return source
+
+    def Notify(self, name=None):
+        # Thread-safe: makes one source (or all of them) due immediately
+        with self.lock:
+            for source in self.sources:
+                if name is None or source.name == name:
+                    source.nextDue = 0
+                    source.generation += 1
+        self.wakeUp.set()
+
+    def Stop(self):
+        self.stopRequested = True
+        self.wakeUp.set()
+
+    def RunOnce(self):
+        # Runs every active source that is due, and returns how long
+        # we can sleep before the next one is
+        now = time.monotonic()
+        for source in self.sources:
+            if not source.IsActive() or source.nextDue > now:
+                continue
+            with self.lock:
+                generation = source.generation
+            progressed = source.callback()
+            with self.lock:
+                if progressed or source.generation != generation:
+                    # Something happened (or we were notified in the
+                    # meantime), there may be more work right away
+                    source.nextDue = 0
+                else:
+                    source.nextDue = time.monotonic() + source.Interval()
+            now = time.monotonic()
+
+        pending = [
+            s.nextDue - time.monotonic() for s in self.sources if s.IsActive()
+        ]
+        return max(0.0, min(pending, default=self.maxSleep))
+
+    def Run(self):
+        logging.info("Starting the event-driven scheduler...")
+        while not self.stopRequested:
+            delay = min(self.RunOnce(), self.maxSleep)
+            if delay > 0:
+                self.wakeUp.wait(delay)
+            self.wakeUp.clear()
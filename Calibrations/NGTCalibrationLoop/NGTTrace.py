@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Timing trace of the NGT calibration loop.
+#
+# Every step writes structured events, keyed by run, LS and job, to the trace
+# of the run: /tmp/ngt/run<N>/trace.jsonl, one JSON object per line. Step 2
+# records when each file (and its LS) showed up on EOS and which job took it,
+# every step records when its jobs were queued, started and finished (with
+# their input and output files), step 4 records when the payloads were
+# uploaded, and all the FSMs record their state changes.
+#
+# Run as a script, it follows every LS through the chain of jobs and prints
+# the latency percentiles of each stage, from its arrival on EOS to the first
+# upload of a payload containing it:
+#   python3 NGTTrace.py            # all the runs in /tmp/ngt
+#   python3 NGTTrace.py 398600     # or only some of them
+
+import argparse
+import json
+import logging
+import os
+import shlex
+import threading
+import time
+from pathlib import Path
+
+TRACE_BASE = "/tmp/ngt"
+TRACE_FILE_NAME = "trace.jsonl"
+
+
+def TraceFile(run, base=TRACE_BASE):
+    return f"{base}/run{run}/{TRACE_FILE_NAME}"
+
+
+class RunTracer(object):
+
+    def __init__(self, step, calibration, base=TRACE_BASE):
+        self.step = step
+        self.calibration = calibration
+        self.base = base
+        # The loops of the engine share the trace files with the job
+        # callbacks, and the other processes of the node append to them too
+        self.lock = threading.Lock()
+
+    def Emit(self, run, event, **fields):
+        # Nothing to trace before we latched a run
+        if not run or str(run) == "0":
+            return
+        record = {
+            "time": time.time(),
+            "step": self.step,
+            "calibration": self.calibration,
+            "run": str(run),
+            "event": event,
+        }
+        record.update(fields)
+        line = json.dumps(record) + "\n"
+        path = TraceFile(run, self.base)
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                created = not os.path.exists(path)
+                # A single write in append mode: the lines of several writers
+                # don't get mixed up
+                with open(path, "a") as f:
+                    f.write(line)
+                # The steps run under different accounts, and all of them
+                # append to the trace of the run
+                if created:
+                    os.chmod(path, 0o666)
+            except OSError as e:
+                # The trace is for monitoring, it must not stop the loop
+                logging.warning(f"Could not write the {event} event to {path}: {e}")
+
+    def ShellEmit(self, run, event, **fields):
+        # The shell line that emits the event from a job script, with the time
+        # the line runs at, e.g. when a step 2 job is done with one of its blocks
+        record = {
+            "step": self.step,
+            "calibration": self.calibration,
+            "run": str(run),
+            "event": event,
+        }
+        record.update(fields)
+        # printf gets the rest of the record after the time as its format,
+        # in single quotes
+        rest = json.dumps(record)[1:]
+        rest = rest.replace("\\", "\\\\").replace("%", "%%").replace("'", "'\\''")
+        return f"printf '{{\"time\": %s, {rest}\\n' \"$(date +%s.%N)\" >> {shlex.quote(TraceFile(run, self.base))}\n"
+
+    def JobCallbacks(self, run, jobName, onStart=None, onFinish=None, **fields):
+        # Emits jobQueued now, and returns the onStart/onFinish callbacks of
+        # the job executor that emit jobStarted and jobFinished before
+        # calling the given ones
+        self.Emit(run, "jobQueued", job=jobName, **fields)
+
+        def OnStart(job):
+            self.Emit(run, "jobStarted", job=jobName)
+            if onStart is not None:
+                onStart(job)
+
+        def OnFinish(job):
+            self.Emit(
+                run, "jobFinished", job=jobName, exitCode=job.exitCode,
+                wallTimeInSeconds=job.WallTime(), maxRSSInKB=job.maxRSSInKB,
+            )
+            if onFinish is not None:
+                onFinish(job)
+
+        return OnStart, OnFinish
+
+
+class StateTracer(object):
+    # Records the state changes of an FSM (with the time spent in the state
+    # it left), except the idle back and forth of the polling loop, e.g.
+    # WaitingForLS -> CheckingLSForProcess -> WaitingForLS
+
+    def __init__(self, tracer, idleTransitions=()):
+        self.tracer = tracer
+        self.idleTransitions = set(idleTransitions)
+        self.state = None
+        self.since = time.time()
+        self.run = None
+
+    def Changed(self, run, state):
+        # Going back to NotRunning still belongs to the run we just left
+        if run and str(run) != "0":
+            self.run = run
+        now = time.time()
+        previous, self.state = self.state, state
+        secondsInPrevious, self.since = now - self.since, now
+        if previous == state or (previous, state) in self.idleTransitions:
+            return
+        self.tracer.Emit(
+            self.run, "state", state=state, previous=previous, secondsInPrevious=secondsInPrevious
+        )
+
+
+# --- Summary ---
+
+
+def ReadTrace(path):
+    events = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # A line being written while we read
+                continue
+    return events
+
+
+def Percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+STAGES = [
+    # (name, from, to): the latencies are between the times of the LS. The
+    # next step can see the outputs of a job before the job executor noticed
+    # its end, so the pickups can be slightly negative.
+    ("discovery", "onEOS", "seen"),
+    ("batching", "seen", "step2Queued"),
+    ("step2 queue", "step2Queued", "step2Started"),
+    ("step2 job", "step2Started", "step2Finished"),
+    ("step3 pickup", "step2Finished", "step3Queued"),
+    ("step3 queue", "step3Queued", "step3Started"),
+    ("step3 job", "step3Started", "step3Finished"),
+    ("harvest pickup", "step3Finished", "harvestQueued"),
+    ("harvest queue", "harvestQueued", "harvestStarted"),
+    ("harvest job", "harvestStarted", "harvestFinished"),
+    ("upload", "harvestFinished", "uploaded"),
+    ("total", "onEOS", "uploaded"),
+]
+
+
+class Job(object):
+
+    def __init__(self, record):
+        self.name = record["job"]
+        self.calibration = record["calibration"]
+        # The run directory is not always spelled the same, e.g. /tmp/ngt//run398600
+        self.inputs = {os.path.normpath(p) for p in record.get("inputs", [])}
+        self.outputs = {os.path.normpath(p) for p in record.get("outputs", [])}
+        self.lumisections = record.get("ls", [])
+        self.queued = record["time"]
+        self.started = None
+        self.finished = None
+        self.exitCode = None
+        # The streaming step 2 jobs publish their blocks one by one:
+        # (LS, outputs, time) of each block done
+        self.blocks = []
+
+
+def JobsOfStep(events, step):
+    jobs = {}
+    for e in events:
+        if e["step"] != step:
+            continue
+        key = (e["calibration"], e.get("job"))
+        if e["event"] == "jobQueued":
+            # A job queued again (e.g. after a restart) is followed from then on
+            jobs[key] = Job(e)
+        elif key in jobs and e["event"] == "jobStarted":
+            jobs[key].started = e["time"]
+        elif key in jobs and e["event"] == "jobFinished":
+            jobs[key].finished = e["time"]
+            jobs[key].exitCode = e["exitCode"]
+        elif key in jobs and e["event"] == "blockDone":
+            jobs[key].blocks.append(
+                (set(e["ls"]), {os.path.normpath(p) for p in e["outputs"]}, e["time"])
+            )
+    return sorted(jobs.values(), key=lambda j: j.queued)
+
+
+def FirstJobWithInput(jobs, calibration, files):
+    for job in jobs:
+        if job.calibration == calibration and job.exitCode == 0 and job.inputs & files:
+            return job
+    return None
+
+
+def LSTimelines(events):
+    # For every (calibration, LS) of the run, the time of each point of STAGES,
+    # following the first successful job of each step that got it. The step 2
+    # events are those of the pass of the calibration, e.g. "EcalPedestals+SiStripBad".
+    seen = {}
+    for e in events:
+        if e["step"] == "Step2" and e["event"] == "fileSeen":
+            for ls in e["ls"]:
+                seen.setdefault((e["calibration"], ls), (e.get("mtime") or e["time"], e["time"]))
+    step2Jobs = JobsOfStep(events, "Step2")
+    step3Jobs = JobsOfStep(events, "Step3")
+    harvests = JobsOfStep(events, "Step4")
+    uploads = {}
+    for e in events:
+        if e["step"] == "Step4" and e["event"] == "uploaded":
+            uploads.setdefault(os.path.normpath(e["dbFile"]), e["time"])
+    calibrations = sorted({job.calibration for job in step3Jobs + harvests})
+
+    timelines = {}
+    for (passName, ls), (onEOS, seenTime) in seen.items():
+        step2 = next(
+            (
+                j for j in step2Jobs
+                if j.calibration == passName and ls in j.lumisections and j.exitCode == 0
+            ),
+            None,
+        )
+        for calibration in calibrations:
+            if calibration not in passName.split("+"):
+                continue
+            timeline = {"onEOS": onEOS, "seen": seenTime}
+            timelines[(calibration, ls)] = timeline
+            if step2 is None:
+                continue
+            # With the streaming mode, the LS is done (and picked up by step 3)
+            # when its block is, not when the whole job is
+            block = next((b for b in step2.blocks if ls in b[0]), None)
+            outputs, finished = (block[1], block[2]) if block is not None else (step2.outputs, step2.finished)
+            timeline.update(step2Queued=step2.queued, step2Started=step2.started, step2Finished=finished)
+            step3 = FirstJobWithInput(step3Jobs, calibration, outputs)
+            if step3 is None:
+                continue
+            timeline.update(step3Queued=step3.queued, step3Started=step3.started, step3Finished=step3.finished)
+            harvest = FirstJobWithInput(harvests, calibration, step3.outputs)
+            if harvest is None:
+                continue
+            timeline.update(harvestQueued=harvest.queued, harvestStarted=harvest.started, harvestFinished=harvest.finished)
+            # Every later harvest of the run contains the LS as well, and the
+            # payload of this one may not have been uploaded (e.g. same hash)
+            uploaded = [
+                uploads[db]
+                for later in harvests
+                if later.calibration == calibration and later.queued >= harvest.queued
+                for db in later.outputs
+                if db in uploads
+            ]
+            if uploaded:
+                timeline["uploaded"] = min(uploaded)
+    return timelines
+
+
+def Summarize(runs, base=TRACE_BASE):
+    # calibration -> stage -> list of latencies, over all the LS of the runs
+    latencies = {}
+    for run in runs:
+        path = TraceFile(run, base)
+        if not os.path.exists(path):
+            continue
+        for (calibration, _), timeline in LSTimelines(ReadTrace(path)).items():
+            stages = latencies.setdefault(calibration, {name: [] for name, _, _ in STAGES})
+            for name, start, end in STAGES:
+                if timeline.get(start) is not None and timeline.get(end) is not None:
+                    stages[name].append(timeline[end] - timeline[start])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the latency percentiles of each stage of the NGT calibration loop, from the traces of the runs.')
+    parser.add_argument('runs', type=str, nargs='*', help='Runs to summarize (default: all the runs with a trace in /tmp/ngt).')
+    args = parser.parse_args()
+
+    runs = args.runs or sorted(
+        p.parent.name[len("run"):] for p in Path(TRACE_BASE).glob(f"run*/{TRACE_FILE_NAME}")
+    )
+    latencies = Summarize(runs)
+    if not latencies:
+        print(f"No trace found for run(s) {', '.join(runs) or '-'}")
+        return
+    print(f"Latencies (s) over the LS of {len(runs)} run(s)")
+    for calibration, stages in sorted(latencies.items()):
+        print(f"\n{calibration}")
+        print(f"  {'stage':<16} {'LS':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+        for name, _, _ in STAGES:
+            values = stages[name]
+            cells = " ".join(
+                f"{Percentile(values, q):8.1f}" if values else f"{'-':>8}" for q in (0.5, 0.9, 0.99, 1)
+            )
+            print(f"  {name:<16} {len(values):>6} {cells}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Upload stage of the NGT calibration loop.
+#
+# The harvesting jobs only produce the conditions sqlite file and its
+# metadata; uploading is done here, asynchronously, one upload job at a time
+# per calibration. While an upload runs, the new payloads pile up and go
+# together in the next upload session (uploadConditions.py takes several
+# files at once). A payload whose hash is the same as the last one uploaded
+# to the tag is not uploaded again, and a newer payload for the same IOV
+# replaces the one still waiting.
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+
+UPLOAD_BASE = "/tmp/ngt/uploads"
+
+
+def PayloadHash(dbFile, tag):
+    # The payload hash of the last IOV of a tag in a conditions sqlite file,
+    # or None if we can't read it
+    try:
+        conn = sqlite3.connect(f"file:{dbFile}?mode=ro", uri=True)
+    except sqlite3.Error as e:
+        logging.warning(f"Could not open {dbFile}: {e}")
+        return None
+    try:
+        row = conn.execute(
+            "SELECT PAYLOAD_HASH FROM IOV WHERE TAG_NAME=? "
+            "ORDER BY SINCE DESC, INSERTION_TIME DESC LIMIT 1",
+            (tag,),
+        ).fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"Could not read the IOVs of {tag} in {dbFile}: {e}")
+        return None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+class PayloadUploader(object):
+
+    def __init__(self, calibration, jobExecutor, environmentScript, uploadBase=UPLOAD_BASE, onUploaded=None, tracer=None):
+        self.calibration = calibration
+        self.jobExecutor = jobExecutor
+        self.environmentScript = environmentScript
+        self.uploadDir = Path(uploadBase) / calibration
+        self.uploadDir.mkdir(parents=True, exist_ok=True)
+        self.stateFile = str(self.uploadDir / "uploads.json")
+        # Called with (runs, endTime) after every successful upload
+        self.onUploaded = onUploaded
+        # The uploads go to the trace of their run, if we have one
+        self.tracer = tracer
+        self.inFlight = None
+        # pending is a dict of since -> payload, lastHash is the hash of the
+        # last payload that made it to the tag
+        self.state = {"uploadNumber": 0, "lastHash": None, "lastUploadTime": None, "pending": {}, "inFlight": {}}
+        self.Load()
+
+    def Load(self):
+        if not os.path.exists(self.stateFile):
+            return
+        try:
+            with open(self.stateFile, "r") as f:
+                self.state.update(json.load(f))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read upload state {self.stateFile}: {e}")
+        # An upload that was running when we stopped is done again,
+        # unless a newer payload for the same IOV is waiting
+        for since, payload in self.state["inFlight"].items():
+            self.state["pending"].setdefault(since, payload)
+        self.state["inFlight"] = {}
+
+    def Save(self):
+        # Write-then-rename, so that a crash never leaves a truncated state behind
+        tmpFile = self.stateFile + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmpFile, self.stateFile)
+
+    def HasPending(self):
+        return bool(self.state["pending"])
+
+    def Add(self, run, dbFile, metadataFile, tag):
+        with open(metadataFile, "r") as f:
+            since = str(json.load(f)["since"])
+        payload = {
+            "run": str(run),
+            "dbFile": str(dbFile),
+            "metadataFile": str(metadataFile),
+            "hash": PayloadHash(dbFile, tag),
+            "time": time.time(),
+        }
+        if since in self.state["pending"]:
+            logging.info(f"Payload of {dbFile} replaces the one waiting for IOV {since}")
+        self.state["pending"][since] = payload
+        self.Save()
+        self.Flush()
+
+    def Flush(self):
+        # Starts an upload job with everything that is waiting, unless one
+        # is running already. Returns True if it started one.
+        if self.inFlight is not None or not self.state["pending"]:
+            return False
+
+        toUpload = {}
+        lastHash = self.state["lastHash"]
+        for since in sorted(self.state["pending"], key=int):
+            payload = self.state["pending"][since]
+            if payload["hash"] is not None and payload["hash"] == lastHash:
+                logging.info(
+                    f"Payload of {payload['dbFile']} is identical to the last one uploaded "
+                    f"({payload['hash']}), not uploading it"
+                )
+                continue
+            toUpload[since] = payload
+            lastHash = payload["hash"]
+        self.state["pending"] = {}
+        if not toUpload:
+            self.Save()
+            return False
+
+        jobDir = self.uploadDir / f"upload{self.state['uploadNumber']:04}"
+        self.state["uploadNumber"] += 1
+        jobDir.mkdir(parents=True, exist_ok=True)
+        # uploadConditions.py finds the metadata of x.db in x.txt, so every
+        # payload gets its own pair of files in the upload directory
+        dbFiles = []
+        for since, payload in toUpload.items():
+            stem = f"{Path(payload['dbFile']).stem}_{since}"
+            shutil.copy(payload["dbFile"], jobDir / f"{stem}.db")
+            shutil.copy(payload["metadataFile"], jobDir / f"{stem}.txt")
+            dbFiles.append(f"{stem}.db")
+        with open(jobDir / "UPLOAD.sh", "w") as f:
+            f.write("#!/bin/bash -ex\n\n")
+            f.write(f"source {self.environmentScript}\n\n")
+            f.write("# One upload session for all the payloads that were waiting\n")
+            f.write(f"uploadConditions.py {' '.join(dbFiles)}\n")
+
+        self.state["inFlight"] = toUpload
+        self.Save()
+
+        def OnFinish(job):
+            self.inFlight = None
+            if job.exitCode == 0:
+                self.state["lastHash"] = lastHash
+                self.state["lastUploadTime"] = job.endTime
+                self.state["inFlight"] = {}
+                self.Save()
+                logging.info(f"Uploaded {len(toUpload)} payload(s) of {self.calibration} in one session")
+                if self.tracer is not None:
+                    for since, payload in toUpload.items():
+                        self.tracer.Emit(
+                            payload["run"], "uploaded",
+                            dbFile=payload["dbFile"], since=since, upload=jobDir.name,
+                        )
+                if self.onUploaded is not None:
+                    self.onUploaded({payload["run"] for payload in toUpload.values()}, job.endTime)
+            else:
+                # We try again with the next flush, unless newer payloads
+                # for the same IOVs came in the meantime
+                logging.warning(f"Upload {jobDir.name} of {self.calibration} failed, will retry")
+                for since, payload in self.state["inFlight"].items():
+                    self.state["pending"].setdefault(since, payload)
+                self.state["inFlight"] = {}
+                self.Save()
+
+        logging.info(f"Uploading {len(toUpload)} payload(s) of {self.calibration} from {jobDir}")
+        self.inFlight = self.jobExecutor.Submit(
+            f"{self.calibration}/{jobDir.name}",
+            ["bash", "UPLOAD.sh"],
+            cwd=str(jobDir),
+            slots=1,
+            stdout=str(jobDir / "stdout.log"),
+            stderr=str(jobDir / "stderr.log"),
+            onFinish=OnFinish,
+            kind="upload",
+        )
+        return True
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Directory watchers for the NGT calibration loop.
+#
+# XRootDDirectoryWatcher keeps the previous "xrdfs ls -l" listing of an EOS
+# directory and only reports the files that newly appeared (and whose size
+# is stable), backing off when nothing changes. WitnessWatcher does the same
+# for the witness files of the local run directories, with inotify, and
+# RunDirectoryLister lists the run directories once for all the loops.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import struct
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+
+from NGTLSInventory import XROOTD_PREFIX
+from NGTMetrics import METRICS
+
+xrdfsRequestSeconds = METRICS.Histogram("ngt_xrdfs_request_seconds", "Latency of the xrdfs listings of the EOS directories.")
+xrdfsRequestFailures = METRICS.Counter("ngt_xrdfs_request_failures_total", "xrdfs listings that failed (e.g. the directory does not exist yet).")
+
+# "xrdfs ls -l" prints either
+#   -r-- 2025-10-27 20:10:13   4026745379 /eos/cms/.../file.root
+# or, for newer servers,
+#   -rw-r--r-- cmst0 zh 4026745379 2025-10-27 20:10:13 /eos/cms/.../file.root
+LONG_LISTING_LINE = re.compile(
+    r"^\S+\s+(?:\S+\s+\S+\s+(?P<size1>\d+)\s+)?"
+    r"(?P<date>\d{4}-\d{2}-\d{2})\s+(?P<time>\d{2}:\d{2}:\d{2})\s+"
+    r"(?:(?P<size2>\d+)\s+)?(?P<path>\S+)\s*$"
+)
+
+
+def ParseLongListing(stdout):
+    # Returns a dict of path -> (size, mtime), mtime in seconds since the epoch
+    listing = {}
+    for line in stdout.splitlines():
+        m = LONG_LISTING_LINE.match(line)
+        if not m:
+            continue
+        size = int(m.group("size1") or m.group("size2") or 0)
+        mtime = datetime.strptime(
+            f"{m.group('date')} {m.group('time')}", "%Y-%m-%d %H:%M:%S"
+        ).replace(tzinfo=timezone.utc)
+        listing[m.group("path")] = (size, int(mtime.timestamp()))
+    return listing
+
+
+class XRootDDirectoryWatcher(object):
+
+    def __init__(
+        self,
+        path,
+        prefix=XROOTD_PREFIX,
+        useStat=True,
+        minInterval=1,
+        maxInterval=60,
+        backoffFactor=2,
+        settleSeconds=30,
+    ):
+        self.path = path
+        self.prefix = prefix
+        self.useStat = useStat
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoffFactor = backoffFactor
+        # A file whose mtime is older than this is taken as closed right away
+        self.settleSeconds = settleSeconds
+        self.interval = minInterval
+        self.nextPoll = 0
+        self.previousListing = {}
+        self.readyFiles = {}
+
+    def ListDirectory(self):
+        if self.useStat:
+            cmd = ["xrdfs", self.prefix, "ls", "-l", self.path]
+        else:
+            cmd = ["xrdfs", self.prefix, "ls", self.path]
+        with xrdfsRequestSeconds.Time():
+            result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            xrdfsRequestFailures.Inc()
+            # The directory may just not exist yet, e.g. at the start of a run
+            logging.info(f"Could not list {self.path}: {result.stderr.strip()}")
+            return None
+        if self.useStat:
+            return ParseLongListing(result.stdout)
+        return {line: None for line in result.stdout.strip().splitlines() if line}
+
+    def IsDue(self, now=None):
+        now = time.time() if now is None else now
+        return now >= self.nextPoll
+
+    def SecondsUntilDue(self, now=None):
+        now = time.time() if now is None else now
+        return max(0.0, self.nextPoll - now)
+
+    def Poll(self, force=False):
+        # Returns only the files that became ready since the last poll,
+        # as a dict of path -> (size, mtime) (or None without --stat)
+        now = time.time()
+        if not force and not self.IsDue(now):
+            return {}
+
+        listing = self.ListDirectory()
+        if listing is None:
+            self.BackOff(now)
+            return {}
+
+        newFiles = {}
+        for path, signature in listing.items():
+            if path in self.readyFiles:
+                continue
+            if (
+                signature is None
+                or self.previousListing.get(path) == signature
+                or now - signature[1] > self.settleSeconds
+            ):
+                newFiles[path] = signature
+        self.readyFiles.update(newFiles)
+
+        # Files still being written keep us polling at the fastest rate
+        stillGrowing = any(path not in self.readyFiles for path in listing)
+        changed = listing != self.previousListing
+        self.previousListing = listing
+        if newFiles or changed or stillGrowing:
+            self.interval = self.minInterval
+            self.nextPoll = now + self.interval
+        else:
+            self.BackOff(now)
+
+        if newFiles:
+            logging.info(f"{len(newFiles)} new files appeared in {self.path}")
+        return newFiles
+
+    def BackOff(self, now):
+        self.interval = min(self.interval * self.backoffFactor, self.maxInterval)
+        self.nextPoll = now + self.interval
+
+    def ReadyFiles(self):
+        return dict(self.readyFiles)
+
+
+# --- Local witness files ---
+#
+# WitnessWatcher reports the creation of the witness files that steps 2 and 3
+# touch when their jobs are done (e.g. "run*_ecalPedsStep2_job.txt" or
+# "apJob*/ecalPedsStep3_job.txt"). It uses inotify where available, and falls
+# back to polling the directory on filesystems without it.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def LoadInotify():
+    # Returns the libc handle if inotify is usable here, None otherwise
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class WitnessWatcher(object):
+
+    def __init__(
+        self,
+        directory,
+        matcher,
+        subdirMatcher=None,
+        callback=None,
+        usePolling=False,
+        pollInterval=10,
+    ):
+        self.directory = str(directory)
+        # matcher(name) tells if a file name is a witness file. If subdirMatcher
+        # is given, the witness files are looked for in the matching immediate
+        # subdirectories as well (e.g. the apJobNNN directories).
+        self.matcher = matcher
+        self.subdirMatcher = subdirMatcher
+        self.callback = callback
+        self.pollInterval = pollInterval
+        self.lock = threading.Lock()
+        self.availableFiles = set()
+        self.newFiles = set()
+        self.stopRequested = threading.Event()
+        self.thread = None
+        self.inotifyFd = None
+        self.watchedDirs = {}
+        self.libc = None if usePolling else LoadInotify()
+
+    def Start(self):
+        if self.libc is not None and self.StartInotify():
+            target = self.InotifyLoop
+            logging.info(f"Watching {self.directory} for witness files with inotify")
+        else:
+            target = self.PollingLoop
+            logging.info(f"Polling {self.directory} for witness files every {self.pollInterval} s")
+        # The initial scan happens after the watches are in place, so we
+        # don't miss the files created in between
+        self.Scan()
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        self.stopRequested.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.inotifyFd is not None:
+            os.close(self.inotifyFd)
+            self.inotifyFd = None
+
+    def AvailableFiles(self):
+        with self.lock:
+            return set(self.availableFiles)
+
+    def NewFiles(self):
+        # Only the witness files that appeared since the last call
+        with self.lock:
+            newFiles = self.newFiles
+            self.newFiles = set()
+        return newFiles
+
+    def Found(self, paths):
+        with self.lock:
+            paths = set(paths) - self.availableFiles
+            self.availableFiles |= paths
+            self.newFiles |= paths
+        if paths and self.callback is not None:
+            self.callback()
+
+    def ScanDirectory(self, directory):
+        found = set()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file() and self.matcher(entry.name):
+                        found.add(entry.path)
+        except FileNotFoundError:
+            pass
+        return found
+
+    def Subdirectories(self):
+        if self.subdirMatcher is None:
+            return []
+        try:
+            with os.scandir(self.directory) as it:
+                return [e.path for e in it if e.is_dir() and self.subdirMatcher(e.name)]
+        except FileNotFoundError:
+            return []
+
+    def Scan(self):
+        found = self.ScanDirectory(self.directory)
+        for subdir in self.Subdirectories():
+            self.AddWatch(subdir)
+            found |= self.ScanDirectory(subdir)
+        self.Found(found)
+
+    def PollingLoop(self):
+        while not self.stopRequested.wait(self.pollInterval):
+            self.Scan()
+
+    def StartInotify(self):
+        fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            logging.warning(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+            return False
+        self.inotifyFd = fd
+        if not self.AddWatch(self.directory):
+            os.close(fd)
+            self.inotifyFd = None
+            return False
+        return True
+
+    def AddWatch(self, directory):
+        if self.inotifyFd is None or directory in self.watchedDirs.values():
+            return True
+        wd = self.libc.inotify_add_watch(
+            self.inotifyFd, os.fsencode(directory), INOTIFY_MASK
+        )
+        if wd < 0:
+            logging.warning(
+                f"inotify_add_watch failed for {directory}: {os.strerror(ctypes.get_errno())}"
+            )
+            return False
+        self.watchedDirs[wd] = directory
+        return True
+
+    def InotifyLoop(self):
+        while not self.stopRequested.is_set():
+            ready, _, _ = select.select([self.inotifyFd], [], [], 1)
+            if not ready:
+                continue
+            try:
+                buffer = os.read(self.inotifyFd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            found = set()
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # We lost events, so we look at everything again
+                    self.Scan()
+                    continue
+                if mask & IN_IGNORED:
+                    self.watchedDirs.pop(wd, None)
+                    continue
+                directory = self.watchedDirs.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if directory == self.directory and self.subdirMatcher is not None and self.subdirMatcher(name):
+                        # A new job directory: watch it, and pick up whatever
+                        # was created in it before the watch was in place
+                        self.AddWatch(path)
+                        found |= self.ScanDirectory(path)
+                elif self.matcher(name):
+                    found.add(path)
+            self.Found(found)
+
+
+class RunDirectoryLister(object):
+    # The run directories (e.g. /tmp/ngt/run398600) found by one listing of
+    # the base directory. When several loops run in the same process, they
+    # all look for new runs through the same lister, which lists the base
+    # directory at most once every maxAge seconds.
+
+    def __init__(self, path, maxAge=5):
+        self.path = str(path)
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.runDirectories = None
+        self.listedAt = 0
+
+    def RunDirectories(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.runDirectories is None or now - self.listedAt >= self.maxAge:
+                try:
+                    with os.scandir(self.path) as it:
+                        self.runDirectories = {
+                            e.name for e in it if e.is_dir() and e.name.startswith("run")
+                        }
+                except FileNotFoundError:
+                    self.runDirectories = set()
+                self.listedAt = now
+            return set(self.runDirectories)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Dry-run replay of the NGT calibration loop.
+#
+# The real NGTLoopEngine (i.e. the NGTLoopStep2/3/4 FSMs, their scheduler,
+# job executor and uploader) runs against simulated surroundings:
+# - a fake OMS server, that replays the runs and LS of a timeline file,
+# - a fake EOS, where the RAW files of the timeline appear as the LS go by,
+#   listed and probed by the fake xrdfs and edmFileUtil of replay/bin,
+# - a fake cmsRun, that sleeps as long as the events/s model of the timeline
+#   says the job would take, and writes its outputs,
+# - a fake uploadConditions.py, that records which LS went into each payload.
+# Everything goes --speedup times faster than real time, the intervals of
+# the loops and the latencies of the YAMLs included. At the end we get the
+# latency from the arrival of each LS on EOS to its upload to the condDB.
+#
+# The loops work in /tmp/ngt as always, so the replay wipes it: never run it
+# on a node where the calibration loop is running.
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import yaml
+
+REPLAY_CODE = Path(__file__).resolve().parent
+LOOP_CODE = REPLAY_CODE.parent
+sys.path.insert(0, str(LOOP_CODE))
+
+import NGTCompleteness
+import NGTLoopEngine
+import NGTLoopStep2
+import NGTLoopStep3
+import NGTLoopStep4
+from NGTLoopBase import NGT_BASE
+from NGTMetrics import StartMetricsServer
+from NGTTrace import Percentile
+
+REPLAY_BASE = "/tmp/ngt_replay"
+
+# How long (in real time) each kind of fake job takes
+CMSRUN_DEFAULTS = {
+    "eventsPerSecond": {"step2": 300, "alca": 3000, "merge": 50000, "harvest": 20000},
+    "startupSeconds": {"step2": 60, "alca": 30, "merge": 10, "harvest": 30},
+    "uploadSeconds": 20,
+}
+
+# The loops never wait less than this between two polls, whatever the speedup
+MIN_INTERVAL_IN_SECONDS = 0.2
+
+
+def WallTimeISO(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Timeline(object):
+    # The runs to replay, in seconds of replay time since the start of the
+    # replay, mapped to the wall clock with the speedup
+
+    def __init__(self, config, speedup):
+        self.config = config
+        self.speedup = speedup
+        self.lsSeconds = config.get("lumisectionSeconds", 23.3)
+        self.runs = config["runs"]
+        self.startTime = None
+
+    def Start(self):
+        self.startTime = time.time()
+
+    def WallTime(self, replaySeconds):
+        return self.startTime + replaySeconds / self.speedup
+
+    def ReplaySeconds(self, wallTime):
+        return (wallTime - self.startTime) * self.speedup
+
+    def RunEndSeconds(self, run):
+        return run["startSeconds"] + run["lumisections"] * self.lsSeconds
+
+    def EndSeconds(self):
+        # When the last file of the timeline arrives on EOS
+        return max((arrival for arrival, _, _ in self.Files()), default=0)
+
+    def RunRecord(self, run, now):
+        # What OMS says about the run at wall time now, or None if it did not start yet
+        elapsed = self.ReplaySeconds(now) - run["startSeconds"]
+        if elapsed < 0:
+            return None
+        ended = elapsed >= run["lumisections"] * self.lsSeconds
+        return {
+            "run_number": run["run"],
+            "fill_type_runtime": run.get("fill_type_runtime", "PROTONS"),
+            "l1_hlt_mode": run.get("l1_hlt_mode", "collisions2025"),
+            "start_time": WallTimeISO(self.WallTime(run["startSeconds"])),
+            "end_time": WallTimeISO(self.WallTime(self.RunEndSeconds(run))) if ended else None,
+            "last_lumisection_number": min(run["lumisections"], int(elapsed // self.lsSeconds)),
+        }
+
+    def RunRecords(self, now):
+        records = [self.RunRecord(run, now) for run in self.runs]
+        return [record for record in records if record is not None]
+
+    def Files(self):
+        # (arrival in replay seconds, run, {LS: nEvents}) of every RAW file.
+        # A run either lists its files (e.g. as recorded on EOS), or they are
+        # made of lumisectionsPerFile LS each, arriving fileDelaySeconds after
+        # the end of their last LS.
+        files = []
+        for run in self.runs:
+            if "files" in run:
+                for f in run["files"]:
+                    lumisections = {int(ls): nEvents for ls, nEvents in f["lumisections"].items()}
+                    files.append((run["startSeconds"] + f["arrivalSeconds"], run["run"], lumisections))
+                continue
+            perFile = run.get("lumisectionsPerFile", 1)
+            eventsPerLS = run.get("eventsPerLumisection", 1000)
+            for first in range(1, run["lumisections"] + 1, perFile):
+                last = min(first + perFile - 1, run["lumisections"])
+                arrival = (
+                    run["startSeconds"] + last * self.lsSeconds + run.get("fileDelaySeconds", 60)
+                )
+                files.append((arrival, run["run"], {ls: eventsPerLS for ls in range(first, last + 1)}))
+        return sorted(files, key=lambda f: f[0])
+
+
+class FakeOMSServer(object):
+    # Answers the "runs" queries of NGTOMSClient from the timeline
+
+    def __init__(self, timeline, port=0):
+        self.timeline = timeline
+        timeline_ = timeline
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if not url.path.rstrip("/").endswith("/runs"):
+                    self.send_error(404)
+                    return
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                records = timeline_.RunRecords(time.time())
+                for key, value in query.items():
+                    if key.startswith("filter["):
+                        attribute = key[len("filter["):].split("]")[0]
+                        records = [r for r in records if str(r[attribute]) == value]
+                sort = query.get("sort")
+                if sort:
+                    records.sort(key=lambda r: r[sort.lstrip("-")], reverse=sort.startswith("-"))
+                offset = int(query.get("page[offset]", 0))
+                limit = int(query.get("page[limit]", len(records)))
+                data = [
+                    {"id": str(r["run_number"]), "attributes": r}
+                    for r in records[offset:offset + limit]
+                ]
+                body = json.dumps({"data": data}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/agg/api"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def Start(self):
+        self.thread.start()
+
+    def Stop(self):
+        self.server.shutdown()
+
+
+class FakeEOS(object):
+    # Writes the RAW files of the timeline in the fake EOS as time goes by,
+    # in the directory of every stream we replay, and records when each LS
+    # arrived
+
+    def __init__(self, timeline, eosRoot, streams, arrivalsFile):
+        self.timeline = timeline
+        self.eosRoot = eosRoot
+        self.streams = streams
+        self.arrivalsFile = arrivalsFile
+        self.arrivals = {}
+        self.stopRequested = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.Play, daemon=True)
+
+    def Start(self):
+        self.thread.start()
+
+    def Stop(self):
+        self.stopRequested.set()
+
+    def FileDirectory(self, stream, runNumber):
+        run = str(runNumber)
+        return Path(f"{self.eosRoot}/{stream.strip('/')}/{run[:3]}/{run[3:]}/00000")
+
+    def Play(self):
+        for arrival, runNumber, lumisections in self.timeline.Files():
+            delay = self.timeline.WallTime(arrival) - time.time()
+            if delay > 0 and self.stopRequested.wait(delay):
+                return
+            fileName = f"{uuid.uuid4()}.root"
+            content = "".join(
+                f"{runNumber:>14} {ls:>12} {nEvents:>13}\n" for ls, nEvents in sorted(lumisections.items())
+            )
+            for stream in self.streams:
+                directory = self.FileDirectory(stream, runNumber)
+                directory.mkdir(parents=True, exist_ok=True)
+                # Write-then-rename, the listing only shows complete files
+                tmpFile = directory / f".{fileName}.tmp"
+                tmpFile.write_text(content)
+                os.replace(tmpFile, directory / fileName)
+            now = time.time()
+            with open(self.arrivalsFile, "a") as f:
+                for ls, nEvents in sorted(lumisections.items()):
+                    self.arrivals[(runNumber, ls)] = now
+                    f.write(json.dumps({"run": runNumber, "ls": ls, "events": nEvents, "time": now}) + "\n")
+            logging.info(f"Replay: {fileName} of run {runNumber} with LS {min(lumisections)}-{max(lumisections)} on EOS")
+        self.done.set()
+
+
+def ReadUploads(uploadsFile):
+    if not os.path.exists(uploadsFile):
+        return []
+    with open(uploadsFile, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def FirstUploads(uploads, tag):
+    # (run, LS) -> the time of the first upload to the tag with that LS in it
+    firstUpload = {}
+    for upload in sorted(uploads, key=lambda u: u["time"]):
+        if upload["tag"] != tag:
+            continue
+        for run, ls in upload["lumisections"]:
+            firstUpload.setdefault((run, ls), upload["time"])
+    return firstUpload
+
+
+def LatencyReport(timeline, arrivals, uploads, tags):
+    # For every calibration, the latency from the arrival of each LS on EOS
+    # to the first upload of a payload containing it, in replay seconds
+    report = {}
+    for calibration, tag in tags.items():
+        firstUpload = FirstUploads(uploads, tag)
+        latencies = [
+            (firstUpload[key] - arrival) * timeline.speedup
+            for key, arrival in arrivals.items()
+            if key in firstUpload
+        ]
+        report[calibration] = {
+            "tag": tag,
+            "lumisections": len(arrivals),
+            "uploaded": len(latencies),
+            "uploads": len([u for u in uploads if u["tag"] == tag]),
+            "latencyInSeconds": {
+                "min": Percentile(latencies, 0),
+                "p50": Percentile(latencies, 0.5),
+                "p90": Percentile(latencies, 0.9),
+                "p99": Percentile(latencies, 0.99),
+                "max": Percentile(latencies, 1),
+            },
+        }
+    return report
+
+
+def PrintReport(report, wallSeconds, replaySeconds):
+    print(f"Replayed {replaySeconds:.0f} s of data taking in {wallSeconds:.0f} s")
+    print(f"{'calibration':<20} {'LS':>6} {'uploaded':>9} {'uploads':>8} {'p50':>8} {'p90':>8} {'max':>8}")
+    for calibration, r in report.items():
+        latency = r["latencyInSeconds"]
+        cells = [f"{latency[q]:8.0f}" if latency[q] is not None else f"{'-':>8}" for q in ("p50", "p90", "max")]
+        print(f"{calibration:<20} {r['lumisections']:>6} {r['uploaded']:>9} {r['uploads']:>8} {' '.join(cells)}")
+    print("(latencies from the LS arrival on EOS to its upload, in seconds of replay time)")
+
+
+def PrepareNGTBase(calibrations, speedup):
+    # A fresh /tmp/ngt with the YAMLs of the repository, where the latencies
+    # the loops wait for on purpose go as fast as the rest of the replay
+    shutil.rmtree(NGT_BASE, ignore_errors=True)
+    yamlDir = Path(NGT_BASE) / "calibrationYAML"
+    yamlDir.mkdir(parents=True)
+    shutil.copy(LOOP_CODE / "ngtParameters.jsn", NGT_BASE)
+    configs = {}
+    for calibration in calibrations:
+        with open(LOOP_CODE / "calibrationYAML" / f"{calibration}.yaml", "r") as f:
+            config = yaml.safe_load(f)
+        batching = config["step_2_config"].get("batching") or {}
+        for key in ("max_latency_seconds", "target_wall_time_seconds"):
+            if batching.get(key) is not None:
+                batching[key] = batching[key] / speedup
+        completeness = config["step_2_config"].get("completeness") or {}
+        for key in ("stall_seconds", "default_latency_seconds"):
+            if completeness.get(key) is not None:
+                completeness[key] = completeness[key] / speedup
+        step4 = config["step_4_config"]
+        if step4.get("min_upload_interval_seconds"):
+            step4["min_upload_interval_seconds"] = step4["min_upload_interval_seconds"] / speedup
+        with open(yamlDir / f"{calibration}.yaml", "w") as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+        configs[calibration] = config
+    return configs
+
+
+def ScaleLoopIntervals(speedup):
+    # The polling intervals of the loops are module constants, read when the
+    # scheduler sources are added
+    for module in (NGTLoopStep2, NGTLoopStep3, NGTLoopStep4, NGTLoopEngine):
+        for name in dir(module):
+            if name.endswith("IntervalInSeconds"):
+                scaled = max(MIN_INTERVAL_IN_SECONDS, getattr(module, name) / speedup)
+                setattr(module, name, scaled)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a timeline of runs through the NGT calibration loop, with a fake OMS, EOS and cmsRun, and measures the latency from LS arrival to upload.')
+    parser.add_argument('timeline', type=str, help='JSON file with the runs to replay (see replay/timeline_example.json).')
+    parser.add_argument('-c', '--calibrations', type=str, nargs='+', help='Calibration workflows to replay (default: all those in calibrationYAML).', default=None)
+    parser.add_argument('--speedup', type=float, help='How much faster than real time the replay goes (default: 20).', default=20)
+    parser.add_argument('--slots', type=int, help='Number of threads the fake jobs may use at once (default: all cores).', default=None)
+    parser.add_argument('--maxRuns', type=int, help='Number of runs step 2 processes at the same time, per pass over the RAW (default: 3).', default=3)
+    parser.add_argument('--grace', type=float, help='How long (in replay seconds) we wait for the uploads after the last file arrived (default: 3600).', default=3600)
+    parser.add_argument('--metricsPort', type=int, help='Serve the metrics of the replayed loops on http://localhost:<port>/metrics (default: no endpoint).', default=None)
+    parser.add_argument('--clean', action='store_true', help=f'Wipe {NGT_BASE} and {REPLAY_BASE} first. The replay refuses to start without it if they exist.')
+    args = parser.parse_args()
+
+    if not args.clean and (os.path.exists(NGT_BASE) or os.path.exists(REPLAY_BASE)):
+        parser.error(f"{NGT_BASE} or {REPLAY_BASE} exists, pass --clean to wipe them")
+    with open(args.timeline, "r") as f:
+        timeline = Timeline(json.load(f), args.speedup)
+    calibrations = args.calibrations or NGTLoopEngine.DeclaredCalibrations(LOOP_CODE / "calibrationYAML")
+
+    # The fakes find their settings in the replay directory
+    shutil.rmtree(REPLAY_BASE, ignore_errors=True)
+    eosRoot = f"{REPLAY_BASE}/eos"
+    Path(eosRoot).mkdir(parents=True)
+    settings = {
+        "eosRoot": eosRoot,
+        "speedup": args.speedup,
+        "cmsRun": dict(CMSRUN_DEFAULTS, **timeline.config.get("cmsRun", {})),
+    }
+    with open(f"{REPLAY_BASE}/settings.json", "w") as f:
+        json.dump(settings, f, indent=2)
+    os.environ["NGT_REPLAY_DIR"] = REPLAY_BASE
+    os.environ["PATH"] = f"{REPLAY_CODE / 'bin'}:{os.environ['PATH']}"
+
+    configs = PrepareNGTBase(calibrations, args.speedup)
+    NGTLoopStep2.SetupLogging("NGTReplay")
+    ScaleLoopIntervals(args.speedup)
+    # The LS of the completeness tracker go by as fast as those of the timeline
+    NGTCompleteness.LS_DURATION_SECONDS = timeline.lsSeconds / args.speedup
+
+    timeline.Start()
+    omsServer = FakeOMSServer(timeline)
+    omsServer.Start()
+    streams = sorted({config["file_in_path"] for config in configs.values()})
+    eos = FakeEOS(timeline, eosRoot, streams, f"{REPLAY_BASE}/arrivals.jsonl")
+    eos.Start()
+
+    engine = NGTLoopEngine.NGTLoopEngine(
+        calibrations, omsUrl=omsServer.url, slots=args.slots, maxRuns=args.maxRuns
+    )
+    # The OMS records only live for a moment of replay time as well
+    engine.omsClient.runRecordTTL /= args.speedup
+    engine.omsClient.minRequestInterval /= args.speedup
+    StartMetricsServer(args.metricsPort)
+
+    tags = {
+        calibration: config["step_4_config"]["upload_metadata"]["inputTag"]
+        for calibration, config in configs.items()
+    }
+    uploadsFile = f"{REPLAY_BASE}/uploads.jsonl"
+    deadline = timeline.WallTime(timeline.EndSeconds() + args.grace)
+
+    def AllUploaded():
+        if not eos.done.is_set():
+            return False
+        uploads = ReadUploads(uploadsFile)
+        return all(
+            set(eos.arrivals) <= set(FirstUploads(uploads, tag)) for tag in tags.values()
+        )
+
+    def Watch():
+        # We stop the engine once every LS made it to the condDB, or at the deadline
+        while not AllUploaded():
+            if time.time() > deadline:
+                logging.warning("Replay: deadline reached before every LS was uploaded")
+                break
+            time.sleep(1)
+        engine.scheduler.Stop()
+
+    threading.Thread(target=Watch, daemon=True).start()
+    logging.info(
+        f"Replay of {len(timeline.runs)} run(s) for {', '.join(calibrations)} "
+        f"at {args.speedup}x, OMS at {omsServer.url}"
+    )
+    engine.Run()
+    eos.Stop()
+    omsServer.Stop()
+
+    wallSeconds = time.time() - timeline.startTime
+    report = LatencyReport(timeline, eos.arrivals, ReadUploads(uploadsFile), tags)
+    with open(f"{REPLAY_BASE}/report.json", "w") as f:
+        json.dump(
+            {"speedup": args.speedup, "wallSeconds": wallSeconds, "calibrations": report}, f, indent=2
+        )
+    PrintReport(report, wallSeconds, wallSeconds * args.speedup)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# The fake CMS tools of the NGT loop replay.
+#
+# The scripts in replay/bin (xrdfs, edmFileUtil, cmsDriver.py, cmsRun, scram
+# and uploadConditions.py) are thin wrappers around the functions here. They
+# find the replay directory in $NGT_REPLAY_DIR, and read its settings.json
+# (where the fake EOS is, how much faster than real time we go, and how fast
+# the fake cmsRun processes events).
+#
+# A fake ROOT file is a text file with one "run LS nEvents" line per LS, i.e.
+# what "edmFileUtil --eventsInLumi" prints. Every fake cmsRun writes the LS of
+# all its inputs to all its outputs, so that the LS are followed from the
+# RAW on EOS, through steps 2, 3 and 4, up to the payload that gets uploaded.
+# A fake DQMIO file starts with a DQMIO_HEADER line: it holds histograms,
+# which take the same time to read whatever the number of events in them.
+
+import copy
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import types
+from datetime import datetime, timezone
+from pathlib import Path
+
+XROOTD_URL = re.compile(r"^root://[^/]+/+")
+DQMIO_HEADER = "# DQMIO histograms"
+
+
+def ReadSettings():
+    replayDir = os.environ["NGT_REPLAY_DIR"]
+    with open(os.path.join(replayDir, "settings.json"), "r") as f:
+        settings = json.load(f)
+    settings["replayDir"] = replayDir
+    return settings
+
+
+def AppendRecord(settings, name, record):
+    # One JSON line per call: short lines in append mode don't get mixed up
+    with open(os.path.join(settings["replayDir"], name), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def Sleep(settings, replaySeconds):
+    time.sleep(max(0.0, replaySeconds) / settings["speedup"])
+
+
+# --- Fake ROOT files ---
+
+
+def LocalPath(settings, fileName):
+    # "root://eoscms.cern.ch//eos/..." is in the fake EOS, "file:x.root" is local
+    if XROOTD_URL.match(fileName):
+        return settings["eosRoot"] + "/" + XROOTD_URL.sub("", fileName)
+    if fileName.startswith("file:"):
+        return fileName[len("file:"):]
+    return fileName
+
+
+def ReadFakeFile(path):
+    # Returns a dict of (run, LS) -> nEvents
+    lumisections = {}
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and all(field.isdigit() for field in fields):
+                key = (int(fields[0]), int(fields[1]))
+                lumisections[key] = lumisections.get(key, 0) + int(fields[2])
+    return lumisections
+
+
+def IsHistogramFile(path):
+    with open(path, "r") as f:
+        return f.readline().rstrip("\n") == DQMIO_HEADER
+
+
+def WriteFakeFile(path, lumisections, histograms=False):
+    with open(path, "w") as f:
+        if histograms:
+            f.write(DQMIO_HEADER + "\n")
+        for (run, ls), nEvents in sorted(lumisections.items()):
+            f.write(f"{run:>14} {ls:>12} {nEvents:>13}\n")
+
+
+# --- xrdfs and edmFileUtil ---
+
+
+def Xrdfs(args):
+    # xrdfs PREFIX ls [-l] PATH
+    settings = ReadSettings()
+    if len(args) < 3 or args[1] != "ls":
+        print(f"Fake xrdfs only knows 'ls', not {' '.join(args)}", file=sys.stderr)
+        return 1
+    path = args[-1]
+    directory = Path(settings["eosRoot"] + "/" + path.lstrip("/"))
+    if not directory.is_dir():
+        print("[ERROR] Server responded with an error: [3011] No such file or directory", file=sys.stderr)
+        return 1
+    for entry in sorted(directory.glob("*.root")):
+        if "-l" in args:
+            stat = entry.stat()
+            mtime = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+            print(f"-r-- {mtime:%Y-%m-%d %H:%M:%S} {stat.st_size:>12} {path.rstrip('/')}/{entry.name}")
+        else:
+            print(f"{path.rstrip('/')}/{entry.name}")
+    return 0
+
+
+def EdmFileUtil(args):
+    # edmFileUtil URL --eventsInLumi
+    settings = ReadSettings()
+    path = LocalPath(settings, args[0])
+    if not os.path.exists(path):
+        print(f"Fake edmFileUtil: {args[0]} not found", file=sys.stderr)
+        return 1
+    lumisections = ReadFakeFile(path)
+    runs = {run for run, _ in lumisections}
+    print(
+        f"{args[0]} ({len(runs)} runs, {len(lumisections)} lumis, "
+        f"{sum(lumisections.values())} events, {os.path.getsize(path)} bytes)"
+    )
+    print(f"{'Run':>14} {'Lumi':>12} {'# Events':>13}")
+    with open(path, "r") as f:
+        sys.stdout.write(f.read())
+    return 0
+
+
+# --- cmsDriver.py and cmsRun ---
+#
+# The configurations are real python: the templates of the fake cmsDriver.py,
+# the overrides of the loop and the python_config_mods of the YAMLs all run
+# against the small FWCore.ParameterSet.Config below.
+
+
+class Parameter(object):
+
+    def __init__(self, *args, **kwargs):
+        self.value = args[0] if len(args) == 1 else list(args)
+        self.__dict__.update(kwargs)
+
+
+class PSet(object):
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Component(PSet):
+    # Modules, services and anything else we don't care about: the
+    # python_config_mods may set any parameter of them
+
+    def __init__(self, typeName=None, *args, **kwargs):
+        super().__init__(**kwargs)
+        self.typeName = typeName
+
+    def clone(self, **kwargs):
+        clone = copy.copy(self)
+        clone.__dict__.update(kwargs)
+        return clone
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = Component()
+        setattr(self, name, value)
+        return value
+
+
+class OutputModule(Component):
+    pass
+
+
+class Schedule(list):
+
+    def __init__(self, *paths, **kwargs):
+        super().__init__(paths)
+
+
+class Process(Component):
+
+    def __init__(self, name, *modifiers):
+        super().__init__("Process")
+        self.name_ = name
+
+    def load(self, moduleName):
+        # The modules it would define spring into existence when used
+        pass
+
+    def outputModules_(self):
+        return {
+            name: value for name, value in vars(self).items() if isinstance(value, OutputModule)
+        }
+
+
+def FakeConfigModule():
+    cms = types.ModuleType("FWCore.ParameterSet.Config")
+    cms.Process = Process
+    cms.Source = Component
+    cms.Service = Component
+    cms.ESSource = Component
+    cms.EDProducer = Component
+    cms.EDFilter = Component
+    cms.EDAnalyzer = Component
+    cms.OutputModule = OutputModule
+    cms.Path = Component
+    cms.EndPath = Component
+    cms.Sequence = Component
+    cms.Task = Component
+    cms.Schedule = Schedule
+    cms.PSet = PSet
+    cms.VPSet = lambda *psets, **kwargs: list(psets)
+    cms.untracked = types.SimpleNamespace()
+    for name in ("string", "vstring", "int32", "uint32", "int64", "uint64", "double", "bool", "InputTag", "VInputTag"):
+        setattr(cms, name, Parameter)
+        setattr(cms.untracked, name, Parameter)
+    cms.untracked.PSet = PSet
+    cms.untracked.VPSet = cms.VPSet
+    return cms
+
+
+def MergeProcess(*inputFiles, **kwargs):
+    # Same signature as Configuration.DataProcessing.Merge.mergeProcess
+    process = Process("Merging")
+    dqmio = kwargs.get("newDQMIO", False)
+    process.source = Component(
+        "DQMRootSource" if dqmio else "PoolSource", fileNames=Parameter(*inputFiles)
+    )
+    process.Merged = OutputModule(
+        "DQMRootOutputModule" if dqmio else "PoolOutputModule",
+        fileName=Parameter(kwargs.get("output_file", "Merged.root")),
+    )
+    process.ngtReplayKind = "merge"
+    return process
+
+
+def InstallFakeCMSSW():
+    modules = {
+        "FWCore": types.ModuleType("FWCore"),
+        "FWCore.ParameterSet": types.ModuleType("FWCore.ParameterSet"),
+        "FWCore.ParameterSet.Config": FakeConfigModule(),
+        "Configuration": types.ModuleType("Configuration"),
+        "Configuration.DataProcessing": types.ModuleType("Configuration.DataProcessing"),
+        "Configuration.DataProcessing.Merge": types.ModuleType("Configuration.DataProcessing.Merge"),
+    }
+    modules["FWCore"].ParameterSet = modules["FWCore.ParameterSet"]
+    modules["FWCore.ParameterSet"].Config = modules["FWCore.ParameterSet.Config"]
+    modules["Configuration"].DataProcessing = modules["Configuration.DataProcessing"]
+    modules["Configuration.DataProcessing"].Merge = modules["Configuration.DataProcessing.Merge"]
+    modules["Configuration.DataProcessing.Merge"].mergeProcess = MergeProcess
+    sys.modules.update(modules)
+
+
+def SequencesOf(step, name):
+    # e.g. SequencesOf("ALCAOUTPUT:A+B,ALCA:C", "ALCA") -> ["C"]
+    for part in step.split(","):
+        if part.split(":")[0] == name and ":" in part:
+            return part.split(":", 1)[1].split("+")
+    return []
+
+
+def CmsDriver(args):
+    # We only write a template with the inputs, outputs and conditions that
+    # cmsDriver.py would put in it, for the fake cmsRun
+    options = {}
+    i = 0
+    while i < len(args):
+        if args[i].startswith("-") and i + 1 < len(args) and not args[i + 1].startswith("-"):
+            options[args[i]] = args[i + 1]
+            i += 2
+        else:
+            i += 1
+    step = options.get("-s", options.get("--step", ""))
+    fileNames = [f for f in options.get("--filein", "").split(",") if f]
+    source = "DQMRootSource" if options.get("--filetype") == "DQM" else "PoolSource"
+
+    lines = [
+        "import FWCore.ParameterSet.Config as cms",
+        "",
+        f"process = cms.Process({options.get('--process', 'RERECO')!r})",
+        f"process.source = cms.Source({source!r}, fileNames=cms.untracked.vstring(*{fileNames!r}))",
+        "process.schedule = cms.Schedule()",
+    ]
+    if SequencesOf(step, "ALCAHARVEST"):
+        lines.append(
+            "process.PoolDBOutputService = cms.Service('PoolDBOutputService', "
+            "connect=cms.string('sqlite_file:promptCalibConditions.db'), "
+            f"toPut=cms.VPSet(cms.PSet(record=cms.string({SequencesOf(step, 'ALCAHARVEST')[0]!r}), tag=cms.string(''))))"
+        )
+    elif SequencesOf(step, "ALCA") or SequencesOf(step, "ALCAOUTPUT"):
+        for name in SequencesOf(step, "ALCAOUTPUT") + SequencesOf(step, "ALCA"):
+            lines.append(
+                f"process.ALCARECOStream{name} = cms.OutputModule('PoolOutputModule', "
+                f"fileName=cms.untracked.string('{name}.root'))"
+            )
+    elif "--fileout" in options:
+        lines.append(
+            "process.ALCARECOoutput = cms.OutputModule('PoolOutputModule', "
+            f"fileName=cms.untracked.string({options['--fileout']!r}))"
+        )
+
+    with open(options["--python_filename"], "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return 0
+
+
+def JobKind(process, inputs):
+    if vars(process).get("ngtReplayKind") == "merge":
+        return "merge"
+    if "PoolDBOutputService" in vars(process):
+        return "harvest"
+    # Turning the histograms of the step 3 outputs into DQMIO costs as much as a merge
+    outputModules = process.outputModules_().values()
+    if outputModules and all(module.typeName == "DQMRootOutputModule" for module in outputModules):
+        return "merge"
+    if any(XROOTD_URL.match(fileName) for fileName in inputs):
+        return "step2"
+    return "alca"
+
+
+def WriteConditions(path, tag, lumisections):
+    # The same IOV table as the conditions sqlite files, plus the LS that
+    # went into the payload
+    if os.path.exists(path):
+        os.remove(path)
+    payload = json.dumps(sorted(lumisections.items())).encode()
+    since = min((run for run, _ in lumisections), default=1)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("CREATE TABLE IOV (TAG_NAME TEXT, SINCE INTEGER, PAYLOAD_HASH TEXT, INSERTION_TIME REAL)")
+        conn.execute("CREATE TABLE LUMISECTIONS (RUN INTEGER, LS INTEGER, EVENTS INTEGER)")
+        conn.execute(
+            "INSERT INTO IOV VALUES (?, ?, ?, ?)",
+            (tag, since, hashlib.sha1(payload).hexdigest(), time.time()),
+        )
+        conn.executemany(
+            "INSERT INTO LUMISECTIONS VALUES (?, ?, ?)",
+            [(run, ls, nEvents) for (run, ls), nEvents in lumisections.items()],
+        )
+    conn.close()
+
+
+def CmsRun(args):
+    settings = ReadSettings()
+    startTime = time.time()
+    configFile = args[0]
+    InstallFakeCMSSW()
+    namespace = {"__name__": "__main__", "__file__": configFile}
+    with open(configFile, "r") as f:
+        exec(compile(f.read(), configFile, "exec"), namespace)
+    process = namespace["process"]
+
+    inputs = process.source.fileNames.value
+    inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+    lumisections = {}
+    # The events we go through: none for the histograms of DQMIO files
+    nEvents = 0
+    for fileName in inputs:
+        path = LocalPath(settings, fileName)
+        if not os.path.exists(path):
+            print(f"Fake cmsRun: input {fileName} not found", file=sys.stderr)
+            return 1
+        histograms = IsHistogramFile(path)
+        for key, events in ReadFakeFile(path).items():
+            lumisections[key] = lumisections.get(key, 0) + events
+            if not histograms:
+                nEvents += events
+
+    # The time the job would take, at the speed of the model
+    kind = JobKind(process, inputs)
+    model = settings["cmsRun"]
+    Sleep(settings, model["startupSeconds"][kind] + nEvents / model["eventsPerSecond"][kind])
+
+    outputs = []
+    for outputModule in process.outputModules_().values():
+        path = LocalPath(settings, outputModule.fileName.value)
+        WriteFakeFile(path, lumisections, histograms=outputModule.typeName == "DQMRootOutputModule")
+        outputs.append(path)
+    if kind == "harvest":
+        dbOutput = process.PoolDBOutputService
+        path = dbOutput.connect.value.replace("sqlite_file:", "")
+        WriteConditions(path, dbOutput.toPut[0].tag.value, lumisections)
+        outputs.append(path)
+
+    AppendRecord(settings, "cmsRun.jsonl", {
+        "config": os.path.abspath(configFile),
+        "kind": kind,
+        "startTime": startTime,
+        "endTime": time.time(),
+        "inputs": len(inputs),
+        "events": nEvents,
+        "outputs": outputs,
+    })
+    return 0
+
+
+# --- scram and uploadConditions.py ---
+
+
+def Scram(args):
+    # scram project -d BASE CMSSW VERSION, or scram runtime -sh
+    if args[:1] == ["project"]:
+        Path(args[2], args[4], "src").mkdir(parents=True, exist_ok=True)
+        return 0
+    if args[:1] == ["runtime"]:
+        print(f'export CMSSW_BASE="{os.path.dirname(os.getcwd())}";')
+        return 0
+    print(f"Fake scram does not know {' '.join(args)}", file=sys.stderr)
+    return 1
+
+
+def UploadConditions(args):
+    settings = ReadSettings()
+    Sleep(settings, settings["cmsRun"]["uploadSeconds"])
+    for dbFile in args:
+        conn = sqlite3.connect(f"file:{dbFile}?mode=ro", uri=True)
+        tag, since = conn.execute("SELECT TAG_NAME, SINCE FROM IOV").fetchone()
+        lumisections = conn.execute("SELECT RUN, LS FROM LUMISECTIONS").fetchall()
+        conn.close()
+        AppendRecord(settings, "uploads.jsonl", {
+            "time": time.time(),
+            "dbFile": os.path.abspath(dbFile),
+            "tag": tag,
+            "since": since,
+            "lumisections": sorted(lumisections),
+        })
+        print(f"Fake upload of {dbFile} to {tag} (IOV {since})")
+    return 0
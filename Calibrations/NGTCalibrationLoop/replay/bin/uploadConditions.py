@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+# Fake uploadConditions.py of the NGT loop replay, see NGTReplayFakes.py
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from NGTReplayFakes import UploadConditions
+
+sys.exit(UploadConditions(sys.argv[1:]))
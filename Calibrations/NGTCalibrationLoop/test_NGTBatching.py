@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the batching policies of steps 2, 3 and 4 (NGTBatching.py)
+
+from NGTBatching import BatchPolicy, SplitByEvents, StatisticsGate, StreamingPolicy
+
+
+def test_batches_are_cut_at_the_target_events():
+    policy = BatchPolicy(targetEvents=100, minFiles=1, maxFiles=10, maxLatencyInSeconds=300)
+    pending = [("a", 60, 0), ("b", 60, 0), ("c", 30, 0), ("d", 80, 0), ("e", 10, 0)]
+    # "e" stays pending: its batch is not full and has not waited long enough
+    assert policy.FormBatches(pending, now=100) == [["a", "b"], ["c", "d"]]
+
+
+def test_batches_are_cut_at_max_files():
+    policy = BatchPolicy(targetEvents=10**6, minFiles=1, maxFiles=2, maxLatencyInSeconds=300)
+    pending = [(name, 1, 0) for name in "abcde"]
+    assert policy.FormBatches(pending, now=100) == [["a", "b"], ["c", "d"]]
+
+
+def test_min_files_holds_a_batch_with_enough_events():
+    policy = BatchPolicy(targetEvents=100, minFiles=3, maxFiles=5, maxLatencyInSeconds=300)
+    pending = [("a", 500, 0), ("b", 500, 0)]
+    assert policy.FormBatches(pending, now=100) == []
+
+
+def test_a_partial_batch_is_flushed_after_max_latency():
+    policy = BatchPolicy(targetEvents=1000, minFiles=1, maxFiles=5, maxLatencyInSeconds=300)
+    pending = [("a", 10, 50), ("b", 10, 200)]
+    assert policy.FormBatches(pending, now=349) == []
+    assert policy.FormBatches(pending, now=350) == [["a", "b"]]
+
+
+def test_the_final_batch_takes_everything_pending():
+    policy = BatchPolicy(targetEvents=1000, minFiles=1, maxFiles=5, maxLatencyInSeconds=300)
+    pending = [("a", 10, 0), ("b", 10, 0)]
+    assert policy.FormBatches(pending, final=True, now=1) == [["a", "b"]]
+
+
+def test_the_wall_time_target_wins_once_the_rate_is_known():
+    policy = BatchPolicy(targetEvents=1000, targetWallTimeInSeconds=60)
+    assert policy.TargetEvents() == 1000
+    policy.ObserveJob(nEvents=600, wallTimeInSeconds=60)
+    assert policy.TargetEvents() == 600
+    # Jobs that processed nothing don't teach us anything
+    policy.ObserveJob(nEvents=0, wallTimeInSeconds=60)
+    assert policy.TargetEvents() == 600
+
+
+def test_batching_defaults_fill_in_the_missing_keys():
+    policy = BatchPolicy.FromConfig({"max_files": 3})
+    assert policy.maxFiles == 3
+    assert policy.minFiles == 1
+
+
+def test_split_by_events_balances_the_shards():
+    files = [("a", 100), ("b", 60), ("c", 50), ("d", 40), ("e", 10)]
+    shards = SplitByEvents(files, 2)
+    events = dict(files)
+    assert sorted(sum(events[p] for p in shard) for shard in shards) == [120, 140]
+    assert sorted(p for shard in shards for p in shard) == ["a", "b", "c", "d", "e"]
+
+
+def test_split_by_events_drops_the_empty_shards():
+    assert SplitByEvents([("a", 10)], 4) == [["a"]]
+
+
+def test_streaming_is_off_without_its_config():
+    assert StreamingPolicy.FromConfig(None) is None
+    assert StreamingPolicy.FromConfig({"enabled": False, "ls_per_block": 5}) is None
+    assert StreamingPolicy.FromConfig({"enabled": True, "ls_per_block": 5}).lsPerBlock == 5
+
+
+def test_streaming_launches_the_closed_blocks_only():
+    policy = StreamingPolicy(lsPerBlock=5, maxBlocksPerJob=2, maxLatencyInSeconds=300)
+    assert policy.BlockRange(1) == (1, 5)
+    assert policy.BlockRange(7) == (6, 10)
+    pending = [
+        ("ls1", [1, 2], 0),
+        ("ls3", [3, 4, 5], 0),
+        ("ls6", [6], 0),
+        ("ls11", [11], 0),
+        ("ls16", [16], 0),
+    ]
+    present = {1, 2, 3, 4, 5, 6, 11, 16}
+    # LS 1-5 are all there, 6-10 and 11-15 are closed by a later LS,
+    # 16-20 is still open. Two blocks per job.
+    jobs = policy.FormJobs(pending, present, now=100)
+    assert jobs == [[["ls1", "ls3"], ["ls6"]], [["ls11"]]]
+
+
+def test_streaming_flushes_an_open_block_after_max_latency():
+    policy = StreamingPolicy(lsPerBlock=5, maxBlocksPerJob=1, maxLatencyInSeconds=300)
+    pending = [("ls1", [1], 0)]
+    assert policy.FormJobs(pending, {1}, now=299) == []
+    assert policy.FormJobs(pending, {1}, now=300) == [[["ls1"]]]
+    assert policy.FormJobs(pending, {1}, final=True, now=0) == [[["ls1"]]]
+
+
+def test_statistics_gate_backs_off():
+    assert StatisticsGate.FromConfig(None) is None
+    gate = StatisticsGate.FromConfig({"min_events": 20000})
+    assert [gate.Threshold(n) for n in range(3)] == [20000, 40000, 80000]
+    assert not gate.IsOpen(19999, 0)
+    assert gate.IsOpen(20000, 0)
+    assert not gate.IsOpen(20000, 1)
+    # Events we could not count don't hold the payloads back
+    assert gate.IsOpen(None, 5)
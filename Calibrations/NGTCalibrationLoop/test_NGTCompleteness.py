@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the completeness of the step 2 runs (NGTCompleteness.py)
+
+from NGTCompleteness import LS_DURATION_SECONDS, CompletenessTracker, Tier0LatencyHistory
+
+
+class FakeInventory(object):
+    # Stands for the LS inventory: path -> set of LS
+
+    def __init__(self, lumisections):
+        self.lumisections = lumisections
+
+    def LSForFiles(self, files):
+        return set().union(*(self.lumisections[path] for path in files))
+
+
+def Tracker(**kwargs):
+    return CompletenessTracker(runStartTime=0, **kwargs)
+
+
+def test_complete_once_every_ls_is_there():
+    tracker = Tracker()
+    inventory = FakeInventory({"a": {1, 2}, "b": {3}})
+    tracker.Add(["a"], inventory, now=10)
+    assert not tracker.IsComplete(3, now=10)
+    assert tracker.MissingLS() == [3]
+    tracker.Add(["b"], inventory, now=20)
+    assert tracker.IsComplete(3, now=20)
+
+
+def test_coverage_threshold():
+    tracker = Tracker(coverageThreshold=0.5)
+    tracker.Add(["a"], FakeInventory({"a": {1, 2}}), now=0)
+    assert tracker.IsComplete(4, now=0)
+    assert not tracker.IsComplete(5, now=0)
+
+
+def test_no_last_ls_from_oms_is_never_complete():
+    tracker = Tracker(coverageThreshold=0.0)
+    tracker.Add(["a"], FakeInventory({"a": {1}}), now=0)
+    assert not tracker.IsComplete(0, now=10**9)
+    # And it does not forget the last LS it knew of
+    tracker.SetLastLS(4)
+    tracker.SetLastLS(0)
+    assert tracker.lastLS == 4
+
+
+def test_ls_beyond_the_last_ls_are_counted_once_it_grows():
+    tracker = Tracker()
+    tracker.Add(["a"], FakeInventory({"a": {1, 2, 3}}), now=0)
+    tracker.SetLastLS(2)
+    assert tracker.Coverage() == 1.0
+    tracker.SetLastLS(6)
+    assert tracker.Coverage() == 0.5
+
+
+def test_stalled_and_overdue_run_is_complete():
+    tracker = Tracker(stallSeconds=120, defaultLatencySeconds=900)
+    tracker.Add(["a"], FakeInventory({"a": {1}}), now=0)
+    overdue = 2 * LS_DURATION_SECONDS + 900
+    # Nothing new for long enough, but LS 2 may still be on its way
+    assert not tracker.IsComplete(2, now=overdue - 1)
+    assert tracker.IsComplete(2, now=overdue)
+
+
+def test_overdue_but_not_stalled_run_waits():
+    tracker = Tracker(stallSeconds=120, defaultLatencySeconds=0)
+    inventory = FakeInventory({"a": {1}, "b": {2}})
+    tracker.Add(["a"], inventory, now=0)
+    tracker.Add(["b"], inventory, now=1000)
+    assert not tracker.IsComplete(3, now=1119)
+    assert tracker.IsComplete(3, now=1120)
+
+
+def test_the_latency_history_sets_when_the_ls_are_overdue(tmp_path):
+    history = Tier0LatencyHistory(str(tmp_path / "latencies.json"))
+    tracker = Tracker(history=history, stallSeconds=0, latencyPercentile=1.0, defaultLatencySeconds=10**6)
+    # File "a" (LS 1) arrived 60 s after the end of its LS
+    inventory = FakeInventory({"a": {1}})
+    tracker.Add(["a"], inventory, arrivalTime=lambda path: LS_DURATION_SECONDS + 60, now=0)
+    assert tracker.Tier0Latency() == 60
+    assert tracker.IsComplete(2, now=2 * LS_DURATION_SECONDS + 60)
+    # The history outlives the tracker
+    assert Tier0LatencyHistory(str(tmp_path / "latencies.json")).latencies == [60]
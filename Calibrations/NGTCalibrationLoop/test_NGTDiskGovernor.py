@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the deletion rules of the disk governor (NGTDiskGovernor.py)
+
+import json
+
+import pytest
+
+import NGTDiskGovernor
+from NGTDiskGovernor import DiskGovernor
+from NGTLedger import JobLedger
+
+RUN = "398600"
+
+
+@pytest.fixture
+def ledgerPath(tmp_path):
+    return str(tmp_path / "ngtLedger.db")
+
+
+@pytest.fixture
+def governor(tmp_path, ledgerPath, monkeypatch):
+    monkeypatch.setattr(NGTDiskGovernor, "JobLedger", lambda: JobLedger(path=ledgerPath))
+    (tmp_path / "ngt" / f"run{RUN}").mkdir(parents=True)
+    return DiskGovernor(
+        base=tmp_path / "ngt", runQuotaInGB=0, totalQuotaInGB=0, minFreeInGB=0, uploadBase=tmp_path / "uploads"
+    )
+
+
+def Ledger(ledgerPath, step, calibration="EcalPedestals"):
+    return JobLedger(step, calibration, path=ledgerPath)
+
+
+def MakeFile(path, text="x" * 100):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return path
+
+
+def test_step2_outputs_go_once_their_alca_job_is_done(governor, ledgerPath):
+    runDir = governor.RunDirectory(RUN)
+    output = MakeFile(runDir / "run398600_LS1To5_ecalPedsStep2.root")
+    step3 = Ledger(ledgerPath, "Step3")
+    step3.RecordJob(RUN, "apJob000_EcalPedestals", "running", {"inputs": [str(output)]})
+    governor.Poll()
+    assert output.exists()
+    step3.RecordJob(RUN, "apJob000_EcalPedestals", "done")
+    governor.Poll()
+    assert not output.exists()
+
+
+def test_step2_job_script_and_configs_go_once_the_job_is_done(governor, ledgerPath):
+    runDir = governor.RunDirectory(RUN)
+    script = MakeFile(runDir / "job_abc.sh", "cmsRun job_abc_LS1.py\ncmsRun job_abc_LS2.py\n")
+    configs = [MakeFile(runDir / "job_abc_LS1.py"), MakeFile(runDir / "job_abc_LS2.py")]
+    Ledger(ledgerPath, "Step2").RecordJob(RUN, "job_abc.sh", "done", {})
+    governor.Poll()
+    assert not script.exists()
+    assert not any(config.exists() for config in configs)
+
+
+def test_only_the_last_histograms_so_far_stays(governor, ledgerPath):
+    runDir = governor.RunDirectory(RUN)
+    step4 = Ledger(ledgerPath, "Step4")
+    sums = []
+    for number in range(3):
+        jobDir = runDir / f"harvestJob{number:03}_EcalPedestals"
+        sums.append(MakeFile(jobDir / "histogramsSoFar.root"))
+        step4.RecordJob(RUN, jobDir.name, "done", {"jobDir": str(jobDir)})
+    governor.Poll()
+    assert [s.exists() for s in sums] == [False, False, True]
+
+
+def test_nothing_outside_of_the_run_directory_is_deleted(governor, ledgerPath, tmp_path):
+    outside = MakeFile(tmp_path / "elsewhere.root")
+    Ledger(ledgerPath, "Step3").RecordJob(RUN, "apJob000_EcalPedestals", "done", {"inputs": [str(outside)]})
+    governor.Poll()
+    assert outside.exists()
+
+
+def test_the_leftovers_go_once_every_step_closed_the_run(governor, ledgerPath):
+    runDir = governor.RunDirectory(RUN)
+    leftover = MakeFile(runDir / "apJob000_EcalPedestals" / "PromptCalibProdEcalPedestals.root")
+    log = MakeFile(runDir / "apJob000_EcalPedestals" / "stdout.log")
+    ledgers = {step: Ledger(ledgerPath, step) for step in ("Step2", "Step3", "Step4")}
+    for ledger in ledgers.values():
+        ledger.OpenRun(RUN)
+    ledgers["Step4"].RecordJob(RUN, "harvestJob000_EcalPedestals", "running", {})
+    for ledger in ledgers.values():
+        ledger.CloseRun(RUN)
+    # A job of the run is still running
+    governor.Poll()
+    assert leftover.exists()
+    ledgers["Step4"].RecordJob(RUN, "harvestJob000_EcalPedestals", "done")
+    governor.Poll()
+    assert not leftover.exists()
+    assert log.exists()
+    assert RUN in governor.runsDone
+
+
+def test_the_run_waits_for_every_step_of_every_calibration(governor, ledgerPath):
+    runDir = governor.RunDirectory(RUN)
+    leftover = MakeFile(runDir / "leftover.root")
+    # The step 2 pass is shared by two calibrations, only one went through step 4
+    Ledger(ledgerPath, "Step2", "EcalPedestals+SiStripBad").OpenRun(RUN)
+    for step in ("Step3", "Step4"):
+        Ledger(ledgerPath, step, "EcalPedestals").OpenRun(RUN)
+    Ledger(ledgerPath, "Step3", "SiStripBad").OpenRun(RUN)
+    for step, calibration in (
+        ("Step2", "EcalPedestals+SiStripBad"), ("Step3", "EcalPedestals"),
+        ("Step4", "EcalPedestals"), ("Step3", "SiStripBad"),
+    ):
+        Ledger(ledgerPath, step, calibration).CloseRun(RUN)
+    governor.Poll()
+    assert leftover.exists()
+
+
+def test_make_room_keeps_the_runs_with_pending_uploads(governor, tmp_path):
+    done, uploading = "398500", "398501"
+    for run in (done, uploading):
+        MakeFile(governor.RunDirectory(run) / "runStart.log")
+        governor.runsDone.add(run)
+    MakeFile(
+        tmp_path / "uploads" / "EcalPedestals" / "uploads.json",
+        json.dumps({"pending": {"iov": {"run": int(uploading)}}, "inFlight": {}}),
+    )
+    # Always over quota
+    governor.OverQuota = lambda: "over quota"
+    governor.MakeRoom()
+    assert not governor.RunDirectory(done).exists()
+    assert governor.RunDirectory(uploading).exists()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the cached CMSSW environment of the jobs (NGTEnvironment.py)
+
+import os
+import time
+
+import pytest
+
+import NGTEnvironment
+from NGTEnvironment import PrepareEnvironment
+
+FAKE_SCRAM = """#!/bin/bash
+echo "$@" >> {log}
+if [ "$1" == "project" ]; then mkdir -p "$3/$5/src" "$3/$5/.SCRAM"; fi
+if [ "$1" == "runtime" ]; then echo "export CMSSW_BASE=$(dirname $PWD)"; fi
+"""
+
+
+@pytest.fixture
+def scramCalls(tmp_path, monkeypatch):
+    # A fake scram in the PATH, that records how it was called
+    log = tmp_path / "scram.log"
+    binDir = tmp_path / "bin"
+    binDir.mkdir()
+    (binDir / "scram").write_text(FAKE_SCRAM.format(log=log))
+    (binDir / "scram").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{binDir}:{os.environ['PATH']}")
+    base = tmp_path / "cmssw"
+    monkeypatch.setattr(NGTEnvironment, "ENVIRONMENT_BASE", str(base))
+
+    def Calls():
+        return log.read_text().splitlines() if log.exists() else []
+
+    return Calls
+
+
+def Prepare():
+    return PrepareEnvironment("el9_amd64_gcc12", "CMSSW_15_0_16", releaseBase=NGTEnvironment.ENVIRONMENT_BASE)
+
+
+def test_the_environment_is_prepared_once(scramCalls):
+    script = Prepare()
+    assert "export SCRAM_ARCH=el9_amd64_gcc12" in open(script).read()
+    assert [call.split()[0] for call in scramCalls()] == ["project", "runtime"]
+    # The other loops (and the restarted ones) just source it
+    assert Prepare() == script
+    assert len(scramCalls()) == 2
+
+
+def test_the_environment_is_shared_with_the_other_accounts(scramCalls):
+    script = Prepare()
+    assert os.stat(script).st_mode & 0o777 == 0o666
+    assert os.stat(script + ".lock").st_mode & 0o777 == 0o666
+    assert os.stat(NGTEnvironment.ENVIRONMENT_BASE).st_mode & 0o777 == 0o777
+
+
+def test_the_environment_is_cached_again_once_the_release_changed(scramCalls):
+    script = Prepare()
+    later = time.time() + 10
+    os.utime(os.path.join(NGTEnvironment.ENVIRONMENT_BASE, "CMSSW_15_0_16", ".SCRAM"), (later, later))
+    Prepare()
+    assert [call.split()[0] for call in scramCalls()] == ["project", "runtime", "runtime"]
+    assert os.path.exists(script)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the LS inventory of step 2 (NGTLSInventory.py)
+
+import subprocess
+
+from NGTLSInventory import LSInventory
+
+
+class FakeProbe(object):
+    # Stands for edmFileUtil: the paths with "bad" in them fail
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, path):
+        self.calls.append(path)
+        if "bad" in path:
+            return subprocess.CompletedProcess([], 1, stdout="", stderr="ERR")
+        return subprocess.CompletedProcess([], 0, stdout="  398600  1  100\n  398600  2  50\n", stderr="")
+
+
+def test_files_are_probed_once(tmp_path):
+    probe = FakeProbe()
+    inventory = LSInventory(str(tmp_path / "inventory.json"), probe=probe)
+    assert inventory.Update({"a": (10, 1)}) == 1
+    assert inventory.Update({"a": (10, 1)}) == 0
+    assert inventory.LSForFiles(["a"]) == {1, 2}
+    assert inventory.EventsForFiles(["a"]) == 150
+    # Nor again after a restart
+    restarted = LSInventory(str(tmp_path / "inventory.json"), probe=probe)
+    assert restarted.Update({"a": (10, 1)}) == 0
+    assert probe.calls == ["a"]
+
+
+def test_a_file_that_changed_is_probed_again(tmp_path):
+    probe = FakeProbe()
+    inventory = LSInventory(None, probe=probe)
+    inventory.Update({"a": (10, 1)})
+    inventory.Update({"a": (20, 2)})
+    assert probe.calls == ["a", "a"]
+
+
+def test_failed_probes_are_cached_until_the_file_changes(tmp_path):
+    probe = FakeProbe()
+    inventory = LSInventory(None, probe=probe)
+    inventory.Update({"bad": (10, 1), "good": (10, 1)})
+    assert inventory.GoodFiles(["bad", "good"]) == ["good"]
+    assert inventory.LSForFiles(["bad"]) == set()
+    inventory.Update({"bad": (10, 1), "good": (10, 1)})
+    assert probe.calls.count("bad") == 1
+    inventory.Update({"bad": (20, 2)})
+    assert probe.calls.count("bad") == 2
+
+
+def test_failed_probes_without_a_signature_are_retried():
+    probe = FakeProbe()
+    inventory = LSInventory(None, probe=probe)
+    inventory.Update(["bad"])
+    inventory.Update(["bad"])
+    assert probe.calls == ["bad", "bad"]
+    assert inventory.GoodFiles() == []
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the job ledger shared by the steps (NGTLedger.py)
+
+import os
+
+from NGTLedger import JobLedger
+
+
+def test_the_ledger_is_writable_by_every_account(tmp_path):
+    path = str(tmp_path / "ngtLedger.db")
+    ledger = JobLedger("Step2", "EcalPedestals", path=path)
+    ledger.OpenRun("398600")
+    for name in (path, path + "-wal", path + "-shm"):
+        assert os.stat(name).st_mode & 0o777 == 0o666
+
+
+def test_a_restarted_loop_resumes_its_run(tmp_path):
+    path = str(tmp_path / "ngtLedger.db")
+    ledger = JobLedger("Step2", "EcalPedestals", path=path)
+    ledger.OpenRun("398600", {"pathWhereFilesAppear": "/eos/somewhere"})
+    ledger.Record("398600", items={"file": ["a.root"]}, counters={"jobNumber": 3})
+    restarted = JobLedger("Step2", "EcalPedestals", path=path)
+    assert restarted.ActiveRun() == ("398600", {"pathWhereFilesAppear": "/eos/somewhere"})
+    assert restarted.Items("398600", "file") == {"a.root"}
+    assert restarted.Counter("398600", "jobNumber") == 3
+    # The other steps and calibrations have their own bookkeeping
+    assert JobLedger("Step3", "EcalPedestals", path=path).ActiveRun() is None
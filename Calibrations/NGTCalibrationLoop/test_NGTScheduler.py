@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the event-driven scheduler of the loops (NGTScheduler.py)
+
+from NGTScheduler import EventScheduler
+
+
+def test_a_source_without_progress_waits_for_its_interval():
+    scheduler = EventScheduler()
+    calls = []
+    scheduler.AddSource("poll", lambda: calls.append(1) or False, interval=30)
+    delay = scheduler.RunOnce()
+    assert len(calls) == 1
+    assert 29 < delay <= 30
+    # Not due yet
+    scheduler.RunOnce()
+    assert len(calls) == 1
+
+
+def test_a_source_that_progresses_runs_again_right_away():
+    scheduler = EventScheduler()
+    scheduler.AddSource("busy", lambda: True, interval=30)
+    assert scheduler.RunOnce() == 0
+
+
+def test_notify_makes_a_source_due():
+    scheduler = EventScheduler()
+    calls = []
+    scheduler.AddSource("poll", lambda: calls.append(1) or False, interval=30)
+    scheduler.RunOnce()
+    scheduler.Notify("poll")
+    assert scheduler.RunOnce() > 0
+    assert len(calls) == 2
+
+
+def test_notify_during_the_callback_is_not_lost():
+    # e.g. the file watcher thread sees a new file while the FSM is busy
+    scheduler = EventScheduler()
+    calls = []
+
+    def Callback():
+        calls.append(1)
+        if len(calls) == 1:
+            scheduler.Notify("poll")
+        return False
+
+    scheduler.AddSource("poll", Callback, interval=30)
+    assert scheduler.RunOnce() == 0
+    scheduler.RunOnce()
+    assert len(calls) == 2
+
+
+def test_notify_only_wakes_up_the_named_source():
+    scheduler = EventScheduler()
+    calls = {"a": 0, "b": 0}
+
+    def Callback(name):
+        def Run():
+            calls[name] += 1
+            return False
+        return Run
+
+    scheduler.AddSource("a", Callback("a"), interval=30)
+    scheduler.AddSource("b", Callback("b"), interval=30)
+    scheduler.RunOnce()
+    scheduler.Notify("a")
+    scheduler.RunOnce()
+    assert calls == {"a": 2, "b": 1}
+
+
+def test_inactive_sources_are_skipped():
+    scheduler = EventScheduler(maxSleep=60)
+    active = [False]
+    calls = []
+    scheduler.AddSource("poll", lambda: calls.append(1) or False, interval=30, when=lambda: active[0])
+    assert scheduler.RunOnce() == 60
+    assert calls == []
+    active[0] = True
+    scheduler.RunOnce()
+    assert calls == [1]
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Unit tests of the traces of the runs (NGTTrace.py)
+
+import json
+import os
+
+from NGTTrace import RunTracer, TraceFile
+
+
+def test_the_trace_is_writable_by_every_account(tmp_path):
+    tracer = RunTracer("Step2", "EcalPedestals", base=str(tmp_path))
+    tracer.Emit("398600", "fileSeen", path="a.root")
+    tracer.Emit("398600", "jobQueued", job="job_a")
+    path = TraceFile("398600", str(tmp_path))
+    assert os.stat(path).st_mode & 0o777 == 0o666
+    with open(path) as f:
+        assert [json.loads(line)["event"] for line in f] == ["fileSeen", "jobQueued"]
+
+
+def test_a_trace_that_cannot_be_written_does_not_stop_the_loop(tmp_path):
+    # e.g. a trace created by the account of another step
+    (tmp_path / "run398600").write_text("not a directory")
+    tracer = RunTracer("Step3", "EcalPedestals", base=str(tmp_path))
+    tracer.Emit("398600", "jobStarted", job="apJob000_EcalPedestals")
+
+
+def test_nothing_is_traced_before_a_run_is_latched(tmp_path):
+    tracer = RunTracer("Step2", "EcalPedestals", base=str(tmp_path))
+    tracer.Emit(0, "stateChanged")
+    assert os.listdir(tmp_path) == []